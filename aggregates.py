@@ -0,0 +1,103 @@
+import math
+from collections import Counter
+from dataclasses import dataclass, field
+
+
+@dataclass
+class UserTotals:
+    user_id: int
+    username: str = ''
+    spent: float = 0
+    count: int = 0
+    largest: float = 0
+    prices: Counter = field(default_factory=Counter)  # price -> number of this user's items at that price
+
+    def add(self, price):
+        self.spent += price
+        self.count += 1
+        self.prices[price] += 1
+        self.largest = max(self.largest, price)
+
+    def remove(self, price):
+        self.spent -= price
+        self.count -= 1
+        self.prices[price] -= 1
+        if not self.prices[price]:
+            del self.prices[price]
+            if price == self.largest:
+                # Only the user's own distinct prices are looked at, never the whole basket
+                self.largest = max(self.prices, default=0)
+
+
+class BasketStats:
+    """Running totals of a basket: overall and per user, kept current by its change events.
+
+    An add, remove or price update costs O(1) (removing a user's largest item looks through
+    that user's distinct prices); 'reset' rebuilds from the items, as after a reload.
+    """
+
+    def __init__(self, basket, listen=True):
+        self.basket = basket
+        if listen:
+            basket.listeners.append(self._on_change)
+        self._rebuild()
+
+    def _rebuild(self):
+        self.spent = 0
+        self.count = 0
+        self.users = {}  # user_id -> UserTotals
+        self._counted = {}  # item id -> (user_id, price) as counted in the totals
+        for item in self.basket.items:
+            self._add(item)
+
+    def _add(self, item):
+        totals = self.users.get(item['user_id'])
+        if totals is None:
+            totals = self.users[item['user_id']] = UserTotals(item['user_id'])
+        totals.username = item['username'] or totals.username
+        totals.add(item['price'])
+        self.spent += item['price']
+        self.count += 1
+        self._counted[item['id']] = (item['user_id'], item['price'])
+
+    def _remove(self, item_id):
+        user_id, price = self._counted.pop(item_id)
+        totals = self.users[user_id]
+        totals.remove(price)
+        if not totals.count:
+            del self.users[user_id]
+        self.spent -= price
+        self.count -= 1
+
+    def _on_change(self, event, item):
+        if event == 'add':
+            self._add(item)
+        elif event == 'remove':
+            self._remove(item['id'])
+        elif event == 'update':
+            # Items are updated in place, so the counted price is the only record of the old one
+            if self._counted.get(item['id']) != (item['user_id'], item['price']):
+                self._remove(item['id'])
+                self._add(item)
+        elif event == 'reset':
+            self._rebuild()
+
+    def by_user(self):
+        """Per-user totals, biggest spender first."""
+        return sorted(self.users.values(), key=lambda totals: (-totals.spent, totals.user_id))
+
+    def check(self):
+        """Compare the running totals with a full recompute; returns the differences found."""
+        expected = BasketStats(self.basket, listen=False)
+        problems = []
+        if not math.isclose(self.spent, expected.spent, abs_tol=0.01) or self.count != expected.count:
+            problems.append(f"totals {self.count} items / {self.spent} != {expected.count} items / {expected.spent}")
+        for user_id in self.users.keys() | expected.users.keys():
+            actual, wanted = self.users.get(user_id), expected.users.get(user_id)
+            if actual is None or wanted is None:
+                problems.append(f"user {user_id}: {actual} != {wanted}")
+            elif (actual.count, actual.largest, actual.prices) != (wanted.count, wanted.largest, wanted.prices) \
+                    or not math.isclose(actual.spent, wanted.spent, abs_tol=0.01):
+                problems.append(f"user {user_id}: {actual.count} items / {actual.spent} (largest {actual.largest}) "
+                                f"!= {wanted.count} items / {wanted.spent} (largest {wanted.largest})")
+        return problems
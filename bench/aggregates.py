@@ -0,0 +1,99 @@
+"""Check the running basket statistics against a full recompute under random changes.
+
+Random adds, removes, link edits, resets and reloads are applied to a basket backed by a
+temporary database; after every change BasketStats.check() compares the running totals
+with a recompute. Also times reading the per-user totals against recomputing them.
+Exits 1 on the first mismatch.
+
+    python -m bench.aggregates --operations 5000 --users 50
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from datetime import datetime, timezone
+
+from storage import Storage, Basket
+from aggregates import BasketStats
+
+CAMPAIGN_ID = 'bench'
+# Relative weights of the basket operations
+OPERATIONS = {'add': 10, 'bulk': 2, 'remove': 6, 'edit': 3, 'reset': 0.05, 'reload': 0.2}
+
+
+def apply(basket, storage, rng, args, serial):
+    operation = rng.choices(list(OPERATIONS), weights=list(OPERATIONS.values()))[0]
+    user_id = rng.randrange(args.users)
+    # Repeated prices exercise the per-user maximum when one of several equal items goes
+    price = rng.choice((100, 250, 250, 990, 1500.5, 3000))
+    if operation == 'add':
+        basket.add_item(f"https://www.ozon.ru/product/agg-{serial}/", price, f"Item {serial}", f"user{user_id}", user_id)
+    elif operation == 'bulk':
+        entries = [(f"https://www.ozon.ru/product/agg-{serial}-{n}/", rng.choice((100, 990)), f"Item {serial}.{n}")
+                   for n in range(rng.randint(2, 5))]
+        basket.add_items(entries, f"user{user_id}", user_id)
+    elif operation == 'remove' and basket.items:
+        basket.remove_item(rng.randrange(len(basket.items)))
+    elif operation == 'edit' and basket.items:
+        basket.update_link(rng.randrange(len(basket.items)), f"https://www.ozon.ru/product/agg-{serial}-edited/")
+    elif operation == 'reset':
+        basket.reset()
+    elif operation == 'reload':
+        items, users = storage.load_baskets().get(CAMPAIGN_ID, ((), ()))
+        basket.reload(items, users)
+    return operation
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='hb_aggregates_')
+    storage = Storage(os.path.join(workdir, 'aggregates.db'))
+    storage.insert_campaign(CAMPAIGN_ID, 'Bench', 10 ** 9, datetime(2100, 1, 1, tzinfo=timezone.utc), 0)
+    basket = Basket(storage, CAMPAIGN_ID)
+    stats = BasketStats(basket)
+    rng = random.Random(args.seed)
+    counts = {}
+    for serial in range(args.operations):
+        operation = apply(basket, storage, rng, args, serial)
+        counts[operation] = counts.get(operation, 0) + 1
+        problems = stats.check()
+        if problems:
+            return [f"after {operation} #{serial}: {problem}" for problem in problems]
+    print(f"{args.operations} operations ({', '.join(f'{n} {op}' for op, n in sorted(counts.items()))}), "
+          f"{stats.count} items of {len(stats.users)} users left", flush=True)
+
+    # Read cost on a big basket: running totals against the full recompute /budget_by_user would need
+    entries = [(f"https://www.ozon.ru/product/agg-big-{n}/", 100 + n % 50, f"Big {n}") for n in range(args.big)]
+    for first in range(0, args.big, 1000):
+        basket.add_items(entries[first:first + 1000], 'big', rng.randrange(args.users))
+    for label, read in (('running totals', stats.by_user), ('full recompute', lambda: BasketStats(basket, False).by_user())):
+        started = time.perf_counter()
+        for _ in range(args.reads):
+            read()
+        print(f"{label}: {(time.perf_counter() - started) / args.reads * 1000:.3f} ms per read "
+              f"over {len(basket.items)} items", flush=True)
+    problems = stats.check()
+    storage.close()
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--operations', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--big', type=int, default=20000, help='items in the basket for the read timing')
+    parser.add_argument('--reads', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    problems = run(args)
+    for problem in problems:
+        print(f"FAIL: {problem}", flush=True)
+    if problems:
+        sys.exit(1)
+    print("Running totals matched the recompute after every change", flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+"""Run several bot workers on one database behind the update router and check they agree.
+
+Each worker is a separate process with its own fake Bot API. Users run the add flow through
+the router while the budget runs out; then a one-off daily reminder falls due, optionally
+after the leader was killed. Exits 1 if the committed spending exceeds the budget or any
+participant got the reminder other than exactly once.
+
+    python -m bench.cluster --workers 3 --users 300 --kill-leader
+"""
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+
+from bench.fake_bot import FakeRequest
+from bench.handlers import UpdateFactory, FIRST_USER_ID
+
+SECRET = 'bench-cluster-secret'
+PATH = '/telegram'
+FIRST_PORT = 18601
+ROUTER_PORT = 18600
+
+
+def worker_env(args, port):
+    env = dict(os.environ)
+    env.update({
+        'DB_PATH': args.db,
+        'MEDIA_CACHE_PATH': os.path.join(args.workdir, f'media_cache_{port}.json'),
+        'WORKER_PORT': str(port),
+        'WEBHOOK_SECRET': SECRET,
+        'WEBHOOK_PATH': PATH,
+        'LEASE_TTL': str(args.lease_ttl),
+        # Every bench user sends a quick burst, flood protection is not under test here
+        'THROTTLE_BURST': '1000',
+    })
+    env.pop('MEDIA_PREWARM_CHAT_ID', None)
+    return env
+
+
+def run_worker(args):
+    """Worker process: the real application on a fake Bot API, serving forwarded updates."""
+    import birthday_bot as bot
+    from telegram.ext import Application
+    from webhook import serve_webhook
+
+    fake = FakeRequest(latency=args.latency)
+    builder = Application.builder().token('123456:BENCH').request(fake).get_updates_request(FakeRequest())
+    application = bot.build_application(builder)
+    asyncio.run(serve_webhook(
+        application, url=None, host='127.0.0.1', port=args.port, path=PATH, secret_token=SECRET,
+    ))
+    # Monotonic times of the sends as wall-clock times, comparable between processes
+    offset = time.time() - time.monotonic()
+    with open(args.out, 'w') as f:
+        json.dump([(method, chat_id, sent_at + offset) for method, chat_id, sent_at in fake.sent], f)
+
+
+def prepare(args):
+    """Create the database with the default campaign open and the reminder due at `reminder_at`."""
+    os.environ['DB_PATH'] = args.db
+    os.environ['MEDIA_CACHE_PATH'] = os.path.join(args.workdir, 'media_cache.json')
+    import birthday_bot as bot
+
+    campaign = bot.campaigns.get(bot.DEFAULT_CAMPAIGN_ID)
+    bot.campaigns.set_deadline(campaign.id, datetime.now(bot.MOSCOW_TZ) + timedelta(days=30))
+    reminder_at = (datetime.now(bot.MOSCOW_TZ) + timedelta(seconds=args.reminder_in)).replace(microsecond=0)
+    job = bot.scheduler.ensure('daily_reminder', campaign.id, '12:00')
+    bot.scheduler.set_schedule(job.name, reminder_at.isoformat())
+    bot.storage.close()
+    return bot, reminder_at.timestamp()
+
+
+async def drive(bot, args):
+    """Send every user's add flow through the router over `connections` parallel lanes, each user in order."""
+    import httpx
+    from webhook import UpdateRouter
+
+    router = UpdateRouter([f"http://127.0.0.1:{FIRST_PORT + n}" for n in range(args.workers)],
+                          '127.0.0.1', ROUTER_PORT, PATH, SECRET)
+    await router.start()
+    factory = UpdateFactory()
+
+    async def lane(first):
+        # One connection per lane: a few clients with their own connection keep the driver cheap
+        async with httpx.AsyncClient(timeout=30) as client:
+            for n in range(first, args.users, args.connections):
+                user_id = FIRST_USER_ID + n
+                for text in (bot.BUTTON_ADD, f"https://www.ozon.ru/product/cluster-{user_id}/", str(args.price),
+                             f"Cluster item {user_id}"):
+                    response = await client.post(
+                        f"http://127.0.0.1:{ROUTER_PORT}{PATH}", json=factory.message(user_id, text),
+                        headers={'x-telegram-bot-api-secret-token': SECRET},
+                    )
+                    response.raise_for_status()
+
+    await asyncio.gather(*(lane(first) for first in range(args.connections)))
+    await router.stop()
+
+
+async def wait_ready(ports, timeout=30):
+    import httpx
+
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        for port in ports:
+            while True:
+                try:
+                    if (await client.get(f"http://127.0.0.1:{port}/readyz")).status_code == 200:
+                        break
+                except httpx.HTTPError:
+                    pass
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"Worker on port {port} did not become ready")
+                await asyncio.sleep(0.2)
+
+
+def leader_pid(db):
+    import sqlite3
+
+    conn = sqlite3.connect(db)
+    row = conn.execute("SELECT holder, expires_at FROM leases WHERE name = 'scheduler'").fetchone()
+    conn.close()
+    return int(row[0].rsplit(':', 1)[1]) if row and row[1] > time.time() else None
+
+
+def wait_leader(db, timeout=30):
+    """PID of the scheduler leader, waiting for the first election if nobody holds the lease yet."""
+    deadline = time.monotonic() + timeout
+    while True:
+        pid = leader_pid(db)
+        if pid is not None:
+            return pid
+        if time.monotonic() > deadline:
+            raise RuntimeError("No worker took the scheduler lease")
+        time.sleep(0.2)
+
+
+def wait_broadcast(db, prefix, timeout=300):
+    import sqlite3
+
+    deadline = time.monotonic() + timeout
+    conn = sqlite3.connect(db)
+    try:
+        while time.monotonic() < deadline:
+            row = conn.execute(
+                "SELECT finished_at FROM broadcasts WHERE substr(id, 1, ?) = ?", (len(prefix), prefix)
+            ).fetchone()
+            if row and row[0]:
+                return
+            time.sleep(0.5)
+    finally:
+        conn.close()
+    raise RuntimeError(f"Broadcast {prefix}... did not finish")
+
+
+def check(args, reminder_at, outputs):
+    import sqlite3
+
+    problems = []
+    conn = sqlite3.connect(args.db)
+    spent, items = conn.execute("SELECT COALESCE(SUM(price), 0), COUNT(*) FROM items").fetchone()
+    budget = conn.execute("SELECT budget_limit FROM campaigns WHERE id = 'default'").fetchone()[0]
+    participants = {row[0] for row in conn.execute("SELECT user_id FROM participants")}
+    conn.close()
+    print(f"{items} items, spent {spent:.0f} of {budget:.0f}, {len(participants)} participants", flush=True)
+    if spent > budget:
+        problems.append(f"budget exceeded: spent {spent} of {budget}")
+
+    reminders = {}
+    for sends in outputs:
+        for method, chat_id, sent_at in sends:
+            if sent_at >= reminder_at and method in ('sendMessage', 'sendAnimation'):
+                reminders[chat_id] = reminders.get(chat_id, 0) + 1
+    print(f"Reminder reached {len(reminders)} chats, {sum(reminders.values())} messages", flush=True)
+    missing = participants - set(reminders)
+    if missing:
+        problems.append(f"{len(missing)} participants got no reminder")
+    repeated = [chat_id for chat_id, count in reminders.items() if count > 1]
+    if repeated:
+        problems.append(f"{len(repeated)} participants got the reminder more than once")
+    return problems
+
+
+def run(args):
+    args.workdir = tempfile.mkdtemp(prefix='hb_cluster_')
+    args.db = os.path.join(args.workdir, 'cluster.db')
+    bot, reminder_at = prepare(args)
+
+    ports = [FIRST_PORT + n for n in range(args.workers)]
+    workers = {}
+    for port in ports:
+        out = os.path.join(args.workdir, f'worker_{port}.json')
+        command = [sys.executable, '-m', 'bench.cluster', 'worker', '--port', str(port), '--out', out,
+                   '--latency', str(args.latency)]
+        workers[port] = (subprocess.Popen(command, env=worker_env(args, port)), out)
+    problems = []
+    try:
+        asyncio.run(wait_ready(ports))
+        started = time.monotonic()
+        asyncio.run(drive(bot, args))
+        print(f"{args.users} add flows through {args.workers} workers in {time.monotonic() - started:.2f} s", flush=True)
+
+        if args.kill_leader:
+            # A short drive can end before the first election tick
+            pid = wait_leader(args.db)
+            port = next((port for port, (process, _) in workers.items() if process.pid == pid), None)
+            if port is None:
+                # Without a kill the failover check would pass without having run
+                problems.append(f"the scheduler lease is held by pid {pid}, none of the workers")
+            else:
+                print(f"Killing the leader (worker on port {port})", flush=True)
+                process = workers.pop(port)[0]
+                process.kill()
+                process.wait()
+
+        # A fresh leader takes over the reminder if the old one was killed
+        time.sleep(max(0, reminder_at - time.time()))
+        wait_broadcast(args.db, 'daily_reminder:default@')
+    finally:
+        for process, _ in workers.values():
+            process.send_signal(signal.SIGTERM)
+        for process, _ in workers.values():
+            process.wait(timeout=30)
+
+    outputs = []
+    for _, out in workers.values():
+        with open(out) as f:
+            outputs.append(json.load(f))
+    return problems + check(args, reminder_at, outputs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('role', nargs='?', default='driver', choices=('driver', 'worker'))
+    parser.add_argument('--workers', type=int, default=3)
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--price', type=int, default=100)
+    parser.add_argument('--connections', type=int, default=20, help='parallel connections to the router')
+    parser.add_argument('--latency', type=float, default=0.002, help='fake Bot API latency per call, seconds')
+    parser.add_argument('--lease-ttl', type=float, default=3.0)
+    parser.add_argument('--reminder-in', type=float, default=15.0, help='seconds from start until the reminder')
+    parser.add_argument('--kill-leader', action='store_true', help='kill the leader before the reminder is due')
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--out')
+    args = parser.parse_args()
+
+    if args.role == 'worker':
+        run_worker(args)
+        return
+    problems = run(args)
+    for problem in problems:
+        print(f"FAIL: {problem}", flush=True)
+    if problems:
+        sys.exit(1)
+    print("Budget and single delivery held across workers", flush=True)
+
+
+if __name__ == '__main__':
+    main()
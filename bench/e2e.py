@@ -0,0 +1,194 @@
+"""Run the unmodified bot (`python birthday_bot.py`) against the local fake Bot API.
+
+The bot long-polls bench/fake_api.py through BOT_API_URL. Every user goes through /start,
+the add flow, the basket list and a tap on the first remove button, each step sent only
+after the bot answered the previous one; --noise adds that many my_chat_member updates
+(which no handler consumes) before every step. Reports update-to-reply latency per step and
+the outbound call rate; exits 1 if more than --max-lost of the steps got no reply.
+
+    python -m bench.e2e --users 200 --latency 0.005
+    python -m bench.e2e --error-rate 0.02 --max-lost 0.05
+    python -m bench.e2e --noise 3
+"""
+import os
+import sys
+import time
+import signal
+import asyncio
+import argparse
+import tempfile
+from collections import Counter
+from datetime import datetime, timedelta
+
+from bench.fake_api import FakeBotApi, REPLY_METHODS, inline_buttons
+from bench.fake_bot import BOT_USER
+from bench.handlers import UpdateFactory, FIRST_USER_ID, percentile
+
+TOKEN = '123456:E2E'
+STEPS = ('start', 'add', 'link', 'price', 'name', 'items', 'remove', 'tap')
+
+
+def prepare(args):
+    """Create the database with the default campaign open for another month."""
+    os.environ['DB_PATH'] = args.db
+    os.environ['MEDIA_CACHE_PATH'] = os.path.join(args.workdir, 'media_cache.json')
+    os.environ['LOG_LEVEL'] = 'WARNING'
+    import birthday_bot as bot
+
+    bot.campaigns.set_deadline(bot.DEFAULT_CAMPAIGN_ID, datetime.now(bot.MOSCOW_TZ) + timedelta(days=30))
+    bot.storage.close()
+    return bot
+
+
+def bot_env(args, api_url):
+    env = dict(os.environ)
+    for name in ('WEBHOOK_URL', 'WORKER_URLS', 'WORKER_PORT', 'METRICS_PORT', 'MEDIA_PREWARM_CHAT_ID'):
+        env.pop(name, None)
+    env.update({
+        'BOT_TOKEN': TOKEN,
+        'BOT_API_URL': api_url,
+        'DB_PATH': args.db,
+        'MEDIA_CACHE_PATH': os.path.join(args.workdir, 'media_cache.json'),
+        'LOG_DIR': '',
+        'LOG_LEVEL': 'WARNING',
+        # Scripted users answer instantly, far faster than flood protection lets anyone through
+        'THROTTLE_BURST': '1000',
+    })
+    return env
+
+
+def member_update(factory, user_id):
+    """A my_chat_member update (the user blocked or unblocked the bot); no handler consumes it."""
+    factory.update_id += 1
+    user = {"id": user_id, "is_bot": False, "first_name": "Bench"}
+    return {
+        "update_id": factory.update_id,
+        "my_chat_member": {
+            "chat": {"id": user_id, "type": "private"},
+            "from": user,
+            "date": int(time.time()),
+            "old_chat_member": {"user": BOT_USER, "status": "member"},
+            "new_chat_member": {"user": BOT_USER, "status": "kicked", "until_date": 0},
+        },
+    }
+
+
+async def user_session(bot, api, factory, user_id, args, latencies, lost, answers):
+    texts = {
+        'start': '/start',
+        'add': bot.BUTTON_ADD,
+        'link': f"https://www.ozon.ru/product/e2e-{user_id}/",
+        'price': str(args.price),
+        'name': f"E2E item {user_id}",
+        'items': bot.BUTTON_ITEMS,
+        'remove': bot.BUTTON_REMOVE,
+    }
+    buttons = []
+    for step in STEPS:
+        # Update IDs must grow in queue order: the bot confirms everything below the last one it got
+        for _ in range(args.noise):
+            api.push(member_update(factory, user_id))
+        if step == 'tap':
+            removes = [data for data in buttons if data.startswith('rm:')]
+            if not removes:
+                break  # Somebody emptied the basket in the meantime
+            update = factory.callback(user_id, removes[0])
+        else:
+            update = factory.message(user_id, texts[step])
+        reply = await api.send_update(update, user_id, args.step_timeout)
+        if reply is None:
+            lost[step] += 1
+            continue
+        latency, method, params = reply
+        latencies[step].append(latency)
+        answers[method] += 1
+        buttons = inline_buttons(params)
+
+
+async def drive(bot, args):
+    api = FakeBotApi(latency=args.latency, error_rate=args.error_rate, retry_after=args.retry_after, seed=args.seed,
+                     upload_rate=args.upload_rate)
+    await api.start()
+    log_path = os.path.join(args.workdir, 'bot.log')
+    with open(log_path, 'w') as log:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, bot.__file__, env=bot_env(args, api.url), stdout=log, stderr=log,
+            cwd=os.path.dirname(bot.__file__),
+        )
+        try:
+            await asyncio.wait_for(api.polled.wait(), args.startup_timeout)
+            factory = UpdateFactory()
+            latencies = {step: [] for step in STEPS}
+            lost = {step: 0 for step in STEPS}
+            answers = Counter()
+            api.calls.clear()
+            started = time.monotonic()
+            await asyncio.gather(*(
+                user_session(bot, api, factory, FIRST_USER_ID + n, args, latencies, lost, answers)
+                for n in range(args.users)
+            ))
+            elapsed = time.monotonic() - started
+        finally:
+            if process.returncode is None:
+                process.send_signal(signal.SIGINT)
+                try:
+                    await asyncio.wait_for(process.wait(), 30)
+                except asyncio.TimeoutError:
+                    process.kill()
+            await api.stop()
+    return api, latencies, lost, answers, elapsed, log_path
+
+
+def report(api, latencies, lost, answers, elapsed, args):
+    everything = sorted(latency for step in STEPS for latency in latencies[step])
+    print(f"{args.users} users, {len(everything)} replies in {elapsed:.2f} s "
+          f"({len(everything) / elapsed:.1f} steps/s)", flush=True)
+    for step, values in [('all', everything)] + [(step, sorted(latencies[step])) for step in STEPS]:
+        if values:
+            print(f"  {step:<6} p50 {percentile(values, 50) * 1000:7.1f} ms  p95 {percentile(values, 95) * 1000:7.1f} ms  "
+                  f"p99 {percentile(values, 99) * 1000:7.1f} ms  lost {lost.get(step, sum(lost.values()))}", flush=True)
+    replies = sum(api.calls[method] for method in REPLY_METHODS)
+    outbound = sum(count for method, count in api.calls.items() if method != 'getUpdates')
+    print(f"Outbound: {outbound / elapsed:.1f} calls/s, {replies / elapsed:.1f} replies/s; "
+          + ", ".join(f"{method} {count}" for method, count in sorted(api.calls.items())), flush=True)
+    print("Steps answered with: " + ", ".join(f"{method} {count}" for method, count in sorted(answers.items())),
+          flush=True)
+    if api.filtered:
+        print(f"Not delivered (type not in allowed_updates): {api.filtered} updates", flush=True)
+    if api.errors:
+        print("Injected errors: " + ", ".join(f"{status} x{count}" for status, count in sorted(api.errors.items())),
+              flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--price', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.0, help='fake Bot API latency per call, seconds')
+    parser.add_argument('--upload-rate', type=float, help='fake upload link speed, bytes per second')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of replies failing with 429 or 403')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--step-timeout', type=float, default=5.0, help='seconds to wait for a reply before a step counts as lost')
+    parser.add_argument('--startup-timeout', type=float, default=60.0)
+    parser.add_argument('--max-lost', type=float, default=0.0, help='share of steps allowed to go unanswered')
+    parser.add_argument('--noise', type=int, default=0, help='unconsumed updates queued before every step')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    args.workdir = tempfile.mkdtemp(prefix='hb_e2e_')
+    args.db = os.path.join(args.workdir, 'e2e.db')
+    bot = prepare(args)
+    try:
+        api, latencies, lost, answers, elapsed, log_path = asyncio.run(drive(bot, args))
+    except asyncio.TimeoutError:
+        print(f"The bot never polled for updates, see {os.path.join(args.workdir, 'bot.log')}", flush=True)
+        sys.exit(1)
+    report(api, latencies, lost, answers, elapsed, args)
+    steps = sum(len(values) for values in latencies.values()) + sum(lost.values())
+    if steps and sum(lost.values()) / steps > args.max_lost:
+        print(f"FAIL: {sum(lost.values())} of {steps} steps got no reply, see {log_path}", flush=True)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""Local stand-in for the Telegram Bot API over HTTP, for end-to-end runs of the real bot.
+
+Serves `<url>/bot<token>/<method>` like api.telegram.org, so the unmodified bot reaches it
+through BOT_API_URL (or Application.builder().base_url(f"{api.url}/bot")). Updates are
+scripted: send_update() queues one for getUpdates and waits for the bot's first reply to
+that chat. Like Telegram, only update types in the bot's last `allowed_updates` are handed
+out. Latency, a slow upload link and errors (429 with retry_after, 403 Forbidden) can be
+injected.
+"""
+import json
+import time
+import random
+import asyncio
+from collections import Counter
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import parse_qsl
+
+from http_server import HttpServer, json_response
+from bench.fake_bot import fake_result, injected_error
+
+# Calls that answer a user; the first one to a chat completes send_update()
+REPLY_METHODS = frozenset({'sendMessage', 'sendAnimation', 'sendDocument', 'editMessageText'})
+# Calls that can fail with an injected error (getUpdates, getMe and webhook calls never do)
+FALLIBLE_METHODS = REPLY_METHODS | {'answerCallbackQuery'}
+MAX_UPLOAD_SIZE = 50 * 1024 * 1024  # Bot API limit for bot uploads
+
+
+def call_params(request):
+    """Parameters of a Bot API call, sent as a form, a multipart upload or JSON."""
+    content_type = request.headers.get('content-type', '')
+    if content_type.startswith('multipart/form-data'):
+        message = BytesParser(policy=HTTP).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + request.body)
+        params = {}
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            # Uploaded files are kept as bytes, the other fields as text
+            params[name] = part.get_payload(decode=True) if part.get_filename() else part.get_content()
+        return params
+    if content_type.startswith('application/json'):
+        return request.json()
+    return dict(parse_qsl(request.body.decode('utf-8')))
+
+
+class FakeBotApi(HttpServer):
+    """Bot API server answering getUpdates from a scripted queue and recording every call.
+
+    `error_rate` of the calls in FALLIBLE_METHODS fail, half with 429 (`retry_after` seconds)
+    and half with 403; every call first waits `latency` seconds, and uploads also as long as
+    their body takes at `upload_rate` bytes per second.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0, retry_after=1, seed=0,
+                 upload_rate=None):
+        super().__init__(host, port, max_body_size=MAX_UPLOAD_SIZE)
+        self.latency = latency
+        self.upload_rate = upload_rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.errors = Counter()
+        self.sent = []  # (method, chat_id, monotonic time) of every successful reply
+        self.polled = asyncio.Event()  # Set by the first getUpdates: the bot is up
+        self._message_id = 0
+        self._updates = []
+        self._new_updates = asyncio.Event()
+        self.allowed_updates = None  # As last requested by getUpdates; None or empty: every type
+        self.filtered = 0  # Updates never handed out because their type was not allowed
+        self._waiting = {}  # chat_id -> (future of the first reply, monotonic time the update was queued)
+        self.add_prefix_route('POST', '/bot', self.handle_call)
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    async def stop(self):
+        # Let pending long polls return instead of being cancelled with the server
+        self._new_updates.set()
+        await super().stop()
+
+    def push(self, update):
+        """Queue a raw update dict for the next getUpdates (dropped if its type is not allowed)."""
+        if self._allowed(update):
+            self._updates.append(update)
+            self._new_updates.set()
+
+    async def send_update(self, update, chat_id, timeout):
+        """Queue `update` and wait for the first reply to `chat_id`.
+
+        Returns (seconds from queueing to reply, method, params), or None after `timeout`.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[chat_id] = (future, time.monotonic())
+        self.push(update)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self._waiting.pop(chat_id, None)
+
+    def _allowed(self, update):
+        if not self.allowed_updates:
+            return True
+        if any(kind in update for kind in self.allowed_updates):
+            return True
+        self.filtered += 1
+        return False
+
+    async def get_updates(self, params):
+        offset = int(params.get('offset', 0))
+        if 'allowed_updates' in params:
+            allowed = params['allowed_updates']
+            self.allowed_updates = json.loads(allowed) if isinstance(allowed, str) else allowed
+        # Updates before the offset were confirmed by the bot
+        self._updates = [update for update in self._updates if update['update_id'] >= offset]
+        if not self._updates:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), float(params.get('timeout', 0)))
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:int(params.get('limit', 100))]
+
+    async def handle_call(self, request):
+        _, _, method = request.params['tail'].partition('/')
+        params = call_params(request)
+        self.calls[method] += 1
+        if method == 'getUpdates':
+            self.polled.set()
+            return json_response({"ok": True, "result": await self.get_updates(params)})
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.upload_rate and request.headers.get('content-type', '').startswith('multipart/form-data'):
+            await asyncio.sleep(len(request.body) / self.upload_rate)
+
+        error = injected_error(self.random, self.error_rate, self.retry_after) if method in FALLIBLE_METHODS else None
+        if error is not None:
+            self.errors[error[0]] += 1
+            return json_response(error[1], error[0])
+
+        self._message_id += 1
+        result = fake_result(method, params, self._message_id)
+        if method in REPLY_METHODS:
+            chat_id = int(params['chat_id'])
+            now = time.monotonic()
+            self.sent.append((method, chat_id, now))
+            future, queued_at = self._waiting.get(chat_id, (None, None))
+            if future is not None and not future.done():
+                future.set_result((now - queued_at, method, params))
+        return json_response({"ok": True, "result": result})
+
+
+def inline_buttons(params):
+    """Callback data of every inline button of a reply's `reply_markup`."""
+    markup = params.get('reply_markup')
+    if isinstance(markup, str):
+        markup = json.loads(markup)
+    return [button['callback_data'] for row in (markup or {}).get('inline_keyboard', ()) for button in row
+            if 'callback_data' in button]
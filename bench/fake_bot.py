@@ -0,0 +1,98 @@
+import json
+import time
+import random
+import asyncio
+from collections import Counter
+from telegram.request import BaseRequest
+
+BOT_USER = {"id": 1000000001, "is_bot": True, "first_name": "BenchBot", "username": "bench_bot"}
+
+# Methods answered with a plain `true`
+TRUE_METHODS = frozenset({
+    'answerCallbackQuery', 'deleteMessage', 'setWebhook', 'deleteWebhook', 'setMyCommands',
+})
+
+
+def fake_message(method, params, message_id):
+    """A well-formed Message answering `method` called with `params`."""
+    chat_id = int(params.get('chat_id', 0))
+    message = {
+        "message_id": int(params.get('message_id', message_id)),
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": BOT_USER,
+    }
+    if method == 'sendAnimation':
+        animation = params.get('animation')
+        # A file_id is sent back as is; an upload ("attach://..." or raw bytes) gets a new one
+        file_id = animation if isinstance(animation, str) and not animation.startswith('attach://') else f"anim{message_id}"
+        message["animation"] = {
+            "file_id": file_id, "file_unique_id": file_id, "width": 320, "height": 240, "duration": 3,
+        }
+        message["caption"] = params.get('caption', '')
+    elif method == 'sendDocument':
+        message["document"] = {"file_id": f"doc{message_id}", "file_unique_id": f"doc{message_id}"}
+    else:
+        message["text"] = params.get('text', '')
+    return message
+
+
+def fake_result(method, params, message_id):
+    if method == 'getMe':
+        return BOT_USER
+    if method in TRUE_METHODS:
+        return True
+    return fake_message(method, params, message_id)
+
+
+def injected_error(rng, error_rate, retry_after):
+    """(status, error payload) for a call picked to fail, half 429 and half 403; None otherwise."""
+    if not error_rate or rng.random() >= error_rate:
+        return None
+    if rng.random() < 0.5:
+        return 429, {"ok": False, "error_code": 429, "description": "Too Many Requests",
+                     "parameters": {"retry_after": retry_after}}
+    return 403, {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+
+
+class FakeRequest(BaseRequest):
+    """In-process stand-in for the Bot API transport.
+
+    Records every call, answers with well-formed results and can inject latency and errors:
+    `error_rate` of calls fail, half of them with 429 (`retry_after` seconds), half with 403.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, retry_after=1, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.sent = []  # (method, chat_id, monotonic time) of every successful send
+        self._message_id = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def reset(self):
+        self.calls.clear()
+        self.sent.clear()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[api_method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        error = injected_error(self.random, self.error_rate, self.retry_after) if api_method != 'getMe' else None
+        if error is not None:
+            return error[0], json.dumps(error[1]).encode()
+
+        self.sent.append((api_method, params.get('chat_id'), time.monotonic()))
+        self._message_id += 1
+        return 200, json.dumps({"ok": True, "result": fake_result(api_method, params, self._message_id)}).encode()
@@ -0,0 +1,273 @@
+"""Benchmark the real handlers and broadcast jobs against an in-process fake Bot API.
+
+Synthetic updates go through the Application built by birthday_bot.build_application(), so
+the ConversationHandler, routing and storage are exactly what production runs.
+
+    python -m bench.handlers --users 200 --output bench_results.json
+    python -m bench.handlers --compare bench_results.json   # fail on regressions
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import asyncio
+import platform
+import tempfile
+import tracemalloc
+from datetime import datetime, timezone, timedelta
+
+from bench.fake_bot import FakeRequest
+
+FIRST_USER_ID = 500000000
+FIRST_BROADCAST_CHAT_ID = 900000000
+
+# Metrics where a larger value is an improvement; everything else compared is "lower is better"
+HIGHER_IS_BETTER = ('updates_per_sec', 'msgs_per_sec')
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def latency_summary(latencies):
+    return {
+        'count': len(latencies),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+class UpdateFactory:
+    """Builds raw update dicts the way Telegram sends them."""
+
+    def __init__(self):
+        self.update_id = 0
+        self.message_id = 0
+
+    def message(self, user_id, text):
+        self.update_id += 1
+        self.message_id += 1
+        message = {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench", "username": f"user{user_id}"},
+            "text": text,
+        }
+        if text.startswith('/'):
+            command = text.split()[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        return {"update_id": self.update_id, "message": message}
+
+    def callback(self, user_id, data):
+        self.update_id += 1
+        return {
+            "update_id": self.update_id,
+            "callback_query": {
+                "id": str(self.update_id),
+                "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": {
+                    "message_id": 1,
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "text": "page",
+                },
+            },
+        }
+
+
+def add_flow(bot, factory, user_id, n):
+    """The full add-item conversation of one user plus viewing and paging the basket."""
+    return [
+        ('start', factory.message(user_id, '/start')),
+        ('menu_add', factory.message(user_id, bot.BUTTON_ADD)),
+        ('link', factory.message(user_id, f"https://www.ozon.ru/product/bench-{user_id}-{n}/?utm_source=bench")),
+        ('price', factory.message(user_id, '1')),
+        ('name', factory.message(user_id, f"Bench item {n}")),
+        ('items', factory.message(user_id, bot.BUTTON_ITEMS)),
+        ('page', factory.callback(user_id, f"{bot.PAGE_CALLBACK_PREFIX}:items:1")),
+    ]
+
+
+async def run_updates(application, steps, trace_allocations=False):
+    """Process (step, update dict) pairs one by one; returns latencies per step and alloc peaks."""
+    from telegram import Update
+
+    latencies = {}
+    allocations = []
+    for step, data in steps:
+        update = Update.de_json(data, application.bot)
+        if trace_allocations:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        await application.process_update(update)
+        latencies.setdefault(step, []).append(time.perf_counter() - started)
+        if trace_allocations:
+            allocations.append(tracemalloc.get_traced_memory()[1] - before)
+    return latencies, allocations
+
+
+async def bench_handlers(bot, application, users):
+    factory = UpdateFactory()
+    steps = []
+    for n in range(users):
+        steps.extend(add_flow(bot, factory, FIRST_USER_ID + n, n))
+
+    started = time.perf_counter()
+    latencies, _ = await run_updates(application, steps)
+    elapsed = time.perf_counter() - started
+
+    # Allocation pass on a smaller sample, tracemalloc slows everything down
+    sample = []
+    for n in range(min(users, 50)):
+        sample.extend(add_flow(bot, factory, FIRST_USER_ID + users + n, users + n))
+    tracemalloc.start()
+    _, allocations = await run_updates(application, sample, trace_allocations=True)
+    tracemalloc.stop()
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    result = latency_summary(all_latencies)
+    result['updates_per_sec'] = round(len(all_latencies) / elapsed, 1)
+    result['alloc_peak_kib_per_update'] = round(sum(allocations) / len(allocations) / 1024, 2)
+    result['steps'] = {step: latency_summary(values) for step, values in latencies.items()}
+    return result
+
+
+async def bench_broadcasts(bot, application, sizes):
+    from telegram.ext import CallbackContext
+    from broadcast import Broadcaster
+
+    # Measure the engine itself, not Telegram's rate limits
+    bot.broadcaster = Broadcaster(global_rate=1e9, per_chat_interval=0, journal=bot.storage)
+    campaign = bot.campaigns.get(bot.DEFAULT_CAMPAIGN_ID)
+    context = CallbackContext(application)
+    results = {}
+    for size in sizes:
+        recipients = range(FIRST_BROADCAST_CHAT_ID, FIRST_BROADCAST_CHAT_ID + size)
+        started = time.perf_counter()
+        outcome = await bot.broadcast_reminder(
+            context, campaign, f"bench_{size}", recipients, broadcast_id=f"bench_{size}@{time.time()}"
+        )
+        wall = time.perf_counter() - started
+        results[str(size)] = {
+            'wall_s': round(wall, 3),
+            'msgs_per_sec': round(outcome.sent / wall, 1) if wall else 0.0,
+            'sent': outcome.sent,
+            'failed': outcome.failed,
+            'retried': outcome.retried,
+        }
+    return results
+
+
+def load_bot(fake):
+    """Import birthday_bot against a throwaway database and build its Application on `fake`."""
+    workdir = tempfile.mkdtemp(prefix='hb_bench_')
+    os.environ['DB_PATH'] = os.path.join(workdir, 'bench.db')
+    os.environ['MEDIA_CACHE_PATH'] = os.path.join(workdir, 'media_cache.json')
+    os.environ.pop('MEDIA_PREWARM_CHAT_ID', None)
+    import birthday_bot as bot
+    from telegram.ext import Application
+
+    builder = Application.builder().token('123456:BENCH').request(fake).get_updates_request(FakeRequest())
+    application = bot.build_application(builder)
+    # Benchmarks add thousands of items and must run before the deadline
+    campaign = bot.campaigns.get(bot.DEFAULT_CAMPAIGN_ID)
+    campaign.budget_limit = float('inf')
+    bot.campaigns.set_deadline(campaign.id, datetime.now(bot.MOSCOW_TZ) + timedelta(days=30))
+    return bot, application
+
+
+async def run(args):
+    fake = FakeRequest(latency=args.latency, error_rate=args.error_rate, retry_after=args.retry_after)
+    bot, application = load_bot(fake)
+
+    async with application:
+        handlers = await bench_handlers(bot, application, args.users)
+        broadcasts = await bench_broadcasts(bot, application, args.broadcast_sizes)
+
+    return {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'users': args.users,
+            'latency_s': args.latency,
+            'error_rate': args.error_rate,
+        },
+        'handlers': handlers,
+        'broadcast': broadcasts,
+        'api_calls': dict(fake.calls),
+    }
+
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if key in ('meta', 'api_calls'):
+            continue
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(current, previous, tolerance):
+    """Print metric deltas against a previous run; return names of regressed metrics."""
+    regressions = []
+    old = flatten(previous)
+    for name, value in sorted(flatten(current).items()):
+        if name not in old or not old[name] or name.endswith(('count', 'sent', 'failed', 'retried')):
+            continue
+        change = (value - old[name]) / old[name]
+        worse = -change if name.rsplit('.', 1)[-1] in HIGHER_IS_BETTER else change
+        marker = ' REGRESSION' if worse > tolerance else ''
+        print(f"{name:45} {old[name]:>12} -> {value:>12} ({change:+.1%}){marker}")
+        if marker:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200, help='synthetic users running the add flow')
+    parser.add_argument('--latency', type=float, default=0.0, help='fake Bot API latency per call, seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of API calls failing with 429/403')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after of injected 429 errors')
+    parser.add_argument('--broadcast-sizes', type=int, nargs='*', default=[10, 1000, 100000])
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help='previous results JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative slowdown before failing')
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    handlers = results['handlers']
+    print(f"Handlers: {handlers['updates_per_sec']} updates/s, p50 {handlers['p50_ms']} ms, "
+          f"p95 {handlers['p95_ms']} ms, p99 {handlers['p99_ms']} ms, "
+          f"{handlers['alloc_peak_kib_per_update']} KiB/update", flush=True)
+    for size, outcome in results['broadcast'].items():
+        print(f"Broadcast to {size}: {outcome['wall_s']} s ({outcome['msgs_per_sec']} msg/s)", flush=True)
+    print(f"Results written to {args.output}", flush=True)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            previous = json.load(f)
+        regressions = compare(results, previous, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} metrics regressed by more than {args.tolerance:.0%}", flush=True)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""Stress the budget under parallel add flows, dispatched the way Application does with concurrent updates.
+
+Every user runs link -> price -> name (some abandon via a menu button or /cancel after the
+price); their updates arrive interleaved and are processed concurrently through the
+application's update processor. Exits 1 if the budget was exceeded, a reservation leaked
+or any user's updates were handled out of order.
+
+    python -m bench.stress --users 300 --budget 5000 --price 100
+"""
+import sys
+import random
+import asyncio
+import argparse
+
+from bench.fake_bot import FakeRequest
+from bench.handlers import UpdateFactory, load_bot, FIRST_USER_ID
+
+# Share of users leaving the flow after the price was reserved
+ABANDON_RATE = 0.25
+
+
+def user_flow(bot, factory, user_id, price, abandon):
+    steps = [
+        factory.message(user_id, bot.BUTTON_ADD),
+        factory.message(user_id, f"https://www.ozon.ru/product/stress-{user_id}/"),
+        factory.message(user_id, str(price)),
+    ]
+    if abandon == 'button':
+        steps.append(factory.message(user_id, bot.BUTTON_ITEMS))
+    elif abandon == 'cancel':
+        steps.append(factory.message(user_id, '/cancel'))
+    else:
+        steps.append(factory.message(user_id, f"Stress item {user_id}"))
+    return steps
+
+
+def interleave(flows, rng):
+    """Random arrival order that keeps each user's own updates in sequence."""
+    pending = [list(flow) for flow in flows]
+    arrival = []
+    while pending:
+        flow = rng.choice(pending)
+        arrival.append(flow.pop(0))
+        if not flow:
+            pending.remove(flow)
+    return arrival
+
+
+async def run_round(bot, application, args, rng, first_user_id):
+    from telegram import Update
+
+    campaign = bot.campaigns.get(bot.DEFAULT_CAMPAIGN_ID)
+    async with campaign.lock:
+        campaign.basket.reset()
+    campaign.budget_limit = args.budget
+
+    factory = UpdateFactory()
+    completers = set()
+    flows = []
+    for n in range(args.users):
+        user_id = first_user_id + n
+        abandon = None
+        if rng.random() < ABANDON_RATE:
+            abandon = rng.choice(('button', 'cancel'))
+        else:
+            completers.add(user_id)
+        flows.append(user_flow(bot, factory, user_id, args.price, abandon))
+
+    processor = application.update_processor
+    tasks = []
+    for data in interleave(flows, rng):
+        update = Update.de_json(data, application.bot)
+        # Same dispatch as Application's update fetcher with concurrent_updates enabled
+        tasks.append(asyncio.create_task(processor.process_update(update, application.process_update(update))))
+    await asyncio.gather(*tasks)
+
+    problems = []
+    basket = campaign.basket
+    if basket.spent > campaign.budget_limit:
+        problems.append(f"budget exceeded: spent {basket.spent} of {campaign.budget_limit}")
+    if campaign.reserved:
+        problems.append(f"{campaign.reserved} still reserved after every flow finished")
+    for item in basket.items:
+        user_id = item['user_id']
+        if user_id not in completers:
+            problems.append(f"user {user_id} abandoned the flow but has an item")
+        elif item['name'] != f"Stress item {user_id}" or f"stress-{user_id}" not in item['link']:
+            problems.append(f"user {user_id} got a mixed up item: {item['name']!r} {item['link']!r}")
+    problems.extend(f"stats: {problem}" for problem in campaign.stats.check())
+    added = len(basket.items)
+    if added > len(completers) or added > args.budget // args.price:
+        problems.append(f"{added} items added for {len(completers)} completed flows")
+    return {
+        'completed_flows': len(completers),
+        'items': added,
+        'spent': basket.spent,
+        'budget': campaign.budget_limit,
+    }, problems
+
+
+async def run(args):
+    bot, application = load_bot(FakeRequest(latency=args.latency))
+    rng = random.Random(args.seed)
+    problems = []
+    async with application:
+        for round_number in range(args.rounds):
+            outcome, round_problems = await run_round(
+                bot, application, args, rng, FIRST_USER_ID + round_number * args.users
+            )
+            print(f"Round {round_number + 1}: {outcome['items']} items for {outcome['completed_flows']} "
+                  f"completed flows, spent {outcome['spent']:.0f} of {outcome['budget']:.0f}", flush=True)
+            problems.extend(round_problems)
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--budget', type=float, default=5000)
+    parser.add_argument('--price', type=int, default=100)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.002, help='fake Bot API latency per call, seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    problems = asyncio.run(run(args))
+    for problem in problems:
+        print(f"FAIL: {problem}", flush=True)
+    if problems:
+        sys.exit(1)
+    print("Budget held under parallel load", flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,42 @@
 import os
-import re
-import random
-from datetime import datetime, timezone, timedelta
-from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler
+import asyncio
+import logging
+import secrets
+import warnings
+from datetime import datetime, timezone, timedelta, time as dt_time
+from telegram import Bot, Update, InputFile, InlineKeyboardMarkup
+from telegram.ext import (
+    Application, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, ContextTypes, ConversationHandler,
+)
+from telegram.error import BadRequest, TelegramError
+from telegram.request import HTTPXRequest
+from telegram.warnings import PTBUserWarning
 from dotenv import load_dotenv
+from media import FileIdCache, MediaRegistry, send_animation_cached, prewarm
+import gif_optimizer
+from broadcast import Broadcaster
+from storage import Storage, BudgetExceeded, utc_now, JOBS_SCOPE
+from campaigns import CampaignRegistry, DEFAULT_CAMPAIGN_ID, CAMPAIGN_ID_PATTERN
+from webhook import serve_webhook, serve_router
+from views import BasketView, PAGE_CALLBACK_PREFIX, ITEM_CALLBACK_PREFIXES, MESSAGE_LIMIT
+from links import canonical_key
+from metrics import metrics, instrument_handler, InstrumentedRequest
+from http_server import HttpServer, text_response
+from update_processor import PerUserUpdateProcessor
+from scheduler import Scheduler
+import cluster
+from cluster import LeaderElection
+from persistence import SQLitePersistence
+from export import export_rows, EXPORT_FORMATS
+import logs
+import transport
+from transport import PollingBot
+import throttle
+from throttle import UserBuckets
+from router import (
+    MenuRouter, MENU_KEYBOARD, TEXT_MESSAGES, URL_RE, PRICE_RE, parse_bulk_lines,
+    BUTTON_ADD, BUTTON_ITEMS, BUTTON_EDIT, BUTTON_REMOVE,
+)
 
 # Load environment variables from .env or sample_env.txt
 if os.path.exists('.env'):
@@ -12,20 +44,114 @@ if os.path.exists('.env'):
 elif os.path.exists('sample_env.txt'):
     load_dotenv('sample_env.txt')
 
+# Logging: JSON lines written by a background thread to stdout and, with LOG_DIR, a size-rotated
+# LOG_DIR/bot.log; LOG_SAMPLE overrides the sampling of high-volume events ("handler=100,...")
+DEFAULT_LOG_DIR = '/home/birthdaybot/logs'  # Created by deploy.sh
+LOG_DIR = os.getenv('LOG_DIR', DEFAULT_LOG_DIR if os.path.isdir(DEFAULT_LOG_DIR) else '')
+logs.setup(
+    LOG_DIR or None,
+    level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+    max_bytes=int(os.getenv('LOG_MAX_BYTES', logs.MAX_BYTES)),
+    backup_count=int(os.getenv('LOG_BACKUPS', logs.BACKUP_COUNT)),
+    sample_rates=logs.parse_rates(os.getenv('LOG_SAMPLE', '')),
+)
+logger = logging.getLogger('birthday_bot')
+
 # Bot configuration
 BOT_TOKEN = os.getenv('BOT_TOKEN')
-ADMIN_ID = 315292335  # Your Telegram ID - only you can use admin commands
-BUDGET_LIMIT = 5000  # Hidden budget limit in rubles
-current_spent = 0  # Track current spending
-added_items = []  # List of added items: [{"link": "...", "price": 1500, "name": "..."}, ...]
+# Bot API server: a self-hosted telegram-bot-api, or bench/fake_api.py for end-to-end runs
+BOT_API_URL = os.getenv('BOT_API_URL', 'https://api.telegram.org').rstrip('/')
+ADMIN_ID = 315292335  # Your Telegram ID - admin of the default campaign, can create new campaigns
+BUDGET_LIMIT = 5000  # Hidden budget limit of the default campaign in rubles
 
 # Deadline configuration
 DEADLINE_MESSAGE = "Заявки больше не принимаются, время истекло!"
+FLOOD_MESSAGE = "🐢 Не так быстро! Подожди пару секунд и повтори"
+ITEM_GONE_MESSAGE = "🤷 Этой ссылки уже нет в корзине, кто-то успел её удалить"
 # December 19, 2025, 09:00 Moscow time (UTC+3)
 MOSCOW_TZ = timezone(timedelta(hours=3))
 DEADLINE_DATETIME = datetime(2025, 12, 19, 9, 0, 0, tzinfo=MOSCOW_TZ)
-deadline_passed = False  # Flag to track if deadline has passed
-active_users = set()  # Track users who have interacted with bot
+REMINDER_TIME = dt_time(hour=12, minute=0, second=0, tzinfo=MOSCOW_TZ)
+
+# Campaigns, their baskets and participants survive restarts in this SQLite database
+DB_PATH = os.getenv('DB_PATH', os.path.join(os.path.dirname(__file__), 'birthday_bot.db'))
+storage = Storage(DB_PATH)
+campaigns = CampaignRegistry(storage)
+# The original single campaign; chats without a deep-link campaign are routed here
+campaigns.ensure(DEFAULT_CAMPAIGN_ID, "🎂 День рождения", BUDGET_LIMIT, DEADLINE_DATETIME, ADMIN_ID)
+
+# Media configuration
+STATIC_DIR = os.path.join(os.path.dirname(__file__), 'static')
+# Telegram file_ids of already uploaded GIFs, keyed by content hash
+MEDIA_CACHE_PATH = os.getenv('MEDIA_CACHE_PATH', os.path.join(os.path.dirname(__file__), 'media_cache.json'))
+# Optional chat to upload all GIFs to on startup so the first real send is already cached
+MEDIA_PREWARM_CHAT_ID = os.getenv('MEDIA_PREWARM_CHAT_ID')
+media_cache = FileIdCache(MEDIA_CACHE_PATH)
+# Size-capped GIF variants produced by gif_optimizer (build time, or startup with MEDIA_OPTIMIZE=1)
+MEDIA_VARIANTS_DIR = os.getenv('MEDIA_VARIANTS_DIR', os.path.join(STATIC_DIR, '.optimized'))
+MEDIA_MAX_BYTES = int(os.getenv('MEDIA_MAX_BYTES', gif_optimizer.DEFAULT_MAX_BYTES))
+MEDIA_MAX_SIDE = int(os.getenv('MEDIA_MAX_SIDE', gif_optimizer.DEFAULT_MAX_SIDE))
+if os.getenv('MEDIA_OPTIMIZE') == '1':
+    if gif_optimizer.available():
+        report = gif_optimizer.optimize_directory(STATIC_DIR, MEDIA_VARIANTS_DIR, MEDIA_MAX_BYTES, MEDIA_MAX_SIDE)
+        logger.info("%s", gif_optimizer.format_report(report))
+    else:
+        logger.warning("MEDIA_OPTIMIZE is set but Pillow is not installed, sending original GIFs")
+# All GIFs are read (or memory-mapped) once here, handlers never block the loop on disk I/O
+media = MediaRegistry(
+    STATIC_DIR, variant_dir=gif_optimizer.budget_dir(MEDIA_VARIANTS_DIR, MEDIA_MAX_BYTES, MEDIA_MAX_SIDE)
+).scan()
+WELCOME_GIF = 'saw-jigsaw.gif'
+REMINDER_GIF = 'time1.gif'
+REFUND_GIF = 'meme6.gif'
+# Success memes are whatever meme*.gif files are actually present
+MEME_GIFS = [name for name in media.names('meme') if name != REFUND_GIF]
+# Seconds between writes of conversation state to the database (changes are batched)
+PERSISTENCE_INTERVAL = float(os.getenv('PERSISTENCE_INTERVAL', '10'))
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', '64'))  # Updates handled in parallel
+# Flood protection: per-user token buckets checked before an update takes a concurrency slot
+THROTTLE_RATE = float(os.getenv('THROTTLE_RATE', throttle.RATE))  # Tokens per second
+THROTTLE_BURST = float(os.getenv('THROTTLE_BURST', throttle.BURST))
+THROTTLE_MAX_DELAY = float(os.getenv('THROTTLE_MAX_DELAY', throttle.MAX_DELAY))  # Seconds, 0 drops right away
+# Cost overrides as "action=cost,...", e.g. THROTTLE_COSTS=gif=6,callback=0.5
+THROTTLE_COSTS = dict(throttle.ACTION_COSTS)
+for override in filter(None, os.getenv('THROTTLE_COSTS', '').split(',')):
+    action, cost = override.split('=')
+    THROTTLE_COSTS[action.strip()] = float(cost)
+flood_buckets = UserBuckets(THROTTLE_RATE, THROTTLE_BURST, THROTTLE_MAX_DELAY)
+# Shared rate-limited sender for reminders and deadline notices, checkpointed in the database
+broadcaster = Broadcaster(journal=storage)
+
+# Webhook configuration: set WEBHOOK_URL to serve updates over HTTPS instead of long polling
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Public base URL, e.g. https://bot.example.com
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '127.0.0.1')  # Behind the reverse proxy
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+# Telegram echoes this in every webhook request; a random one is generated if not configured
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+
+# Bot API transport: small calls and uploads get separate HTTP pools and timeouts; long polling
+# holds getUpdates open POLL_TIMEOUT seconds and takes up to POLL_LIMIT (1-100) updates at once
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', transport.POOL_SIZE))
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', transport.TIMEOUT))
+MEDIA_POOL_SIZE = int(os.getenv('MEDIA_POOL_SIZE', transport.MEDIA_POOL_SIZE))
+MEDIA_TIMEOUT = float(os.getenv('MEDIA_TIMEOUT', transport.MEDIA_TIMEOUT))
+POLL_TIMEOUT = int(os.getenv('POLL_TIMEOUT', transport.POLL_TIMEOUT))
+POLL_LIMIT = int(os.getenv('POLL_LIMIT', transport.POLL_LIMIT))
+
+# Multi-worker mode: a router process (WORKER_URLS set) receives the webhook and forwards each
+# user's updates to always the same worker; workers (WORKER_PORT set) share DB_PATH and elect
+# a leader that alone runs the scheduled jobs. Both need the same explicit WEBHOOK_SECRET.
+WORKER_URLS = [url for url in os.getenv('WORKER_URLS', '').split(',') if url]
+WORKER_LISTEN = os.getenv('WORKER_LISTEN', '127.0.0.1')
+WORKER_PORT = os.getenv('WORKER_PORT')
+LEASE_TTL = float(os.getenv('LEASE_TTL', cluster.LEASE_TTL))
+election = LeaderElection(storage, ttl=LEASE_TTL) if WORKER_PORT else None
+
+# Metrics: set METRICS_PORT to serve Prometheus text format on http://METRICS_LISTEN:METRICS_PORT/metrics
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = os.getenv('METRICS_PORT')
+metrics_server = None
 
 # Conversation states
 WAITING_FOR_PRICE = 1
@@ -33,112 +159,244 @@ WAITING_FOR_NAME = 2
 WAITING_FOR_REMOVE = 3
 WAITING_FOR_EDIT_ITEM = 4
 WAITING_FOR_NEW_LINK = 5
+STATE_NAMES = {
+    WAITING_FOR_PRICE: 'price',
+    WAITING_FOR_NAME: 'name',
+    WAITING_FOR_REMOVE: 'remove',
+    WAITING_FOR_EDIT_ITEM: 'edit_item',
+    WAITING_FOR_NEW_LINK: 'new_link',
+}
 
-# Menu keyboard
-def get_menu_keyboard():
-    keyboard = [
-        [KeyboardButton("🛒 Закинуть в корзину")],
-        [KeyboardButton("📋 Мои ссылки"), KeyboardButton("✏️ Изменить ссылку")],
-        [KeyboardButton("❌ Удалить ссылку")],
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-
+metrics.describe('bot_active_users', 'Participants per campaign')
+metrics.describe('bot_basket_items', 'Items in the basket per campaign')
+metrics.describe('bot_basket_spent', 'Rubles spent per campaign')
+metrics.gauge('bot_active_users', lambda: [((('campaign', c.id),), len(c.basket.active_users)) for c in campaigns])
+metrics.gauge('bot_basket_items', lambda: [((('campaign', c.id),), len(c.basket.items)) for c in campaigns])
+metrics.gauge('bot_basket_spent', lambda: [((('campaign', c.id),), c.basket.spent) for c in campaigns])
 
-def is_deadline_passed():
-    """Check if deadline has passed."""
-    global deadline_passed
-    if not deadline_passed:
-        now = datetime.now(MOSCOW_TZ)
-        if now >= DEADLINE_DATETIME:
-            deadline_passed = True
-    return deadline_passed
+def get_campaign(update: Update):
+    """Return the campaign the update's chat belongs to."""
+    return campaigns.for_chat(update.effective_chat.id)
 
 
 async def send_deadline_message(update: Update):
     """Send deadline message to user."""
-    await update.message.reply_text(DEADLINE_MESSAGE)
+    await update.effective_message.reply_text(DEADLINE_MESSAGE)
 
 
-async def notify_all_users_deadline_job(context: ContextTypes.DEFAULT_TYPE):
-    """Send deadline message to all active users (job queue callback)."""
-    global deadline_passed
-    deadline_passed = True
-    
-    print(f"Deadline reached! Notifying {len(active_users)} users...", flush=True)
-    
-    # Try to send to all tracked users
-    for user_id in active_users.copy():
+async def reply_gif(update: Update, gif, **kwargs):
+    """Reply with a cached GIF, billing the sender's flood protection bucket for the upload."""
+    flood_buckets.charge(update.effective_user.id, THROTTLE_COSTS['gif'])
+    await send_animation_cached(media_cache, update.message.reply_animation, gif, **kwargs)
+
+
+def update_action(update: Update):
+    """Flood protection cost class of an incoming update."""
+    if update.callback_query is not None:
+        return 'callback'
+    message = update.effective_message
+    if message is not None and message.text and message.text.startswith('/'):
+        return 'command'
+    return 'message'
+
+
+async def throttle_update(update: Update) -> bool:
+    """Delay or drop updates of a user who is over their token bucket; False drops the update.
+
+    Runs in PerUserUpdateProcessor under the user's lock but before the update takes one of the
+    MAX_CONCURRENT_UPDATES slots, so a flooding user's waits hold up nobody else.
+    """
+    user = update.effective_user
+    if user is None:
+        return True
+    action = update_action(update)
+    delay = flood_buckets.take(user.id, THROTTLE_COSTS[action])
+    if delay is None:
+        metrics.inc('bot_throttled_updates_total', (('action', action), ('outcome', 'dropped')))
+        # Only the first dropped update of a burst gets the warning; every dropped button press
+        # is still answered, or the user's client keeps its spinner until it times out
+        first = flood_buckets.dropped(user.id) == 1
         try:
-            await context.bot.send_message(chat_id=user_id, text=DEADLINE_MESSAGE)
-            print(f"Sent deadline message to {user_id}", flush=True)
-        except Exception as e:
-            print(f"Error sending deadline message to {user_id}: {e}", flush=True)
+            if update.callback_query is not None:
+                await update.callback_query.answer(FLOOD_MESSAGE if first else None)
+            elif first and update.effective_message is not None:
+                await update.effective_message.reply_text(FLOOD_MESSAGE)
+        except TelegramError as e:
+            logger.warning("Error answering a dropped update of %s: %s", user.id, e, extra={'user_id': user.id})
+        return False
+    if delay:
+        metrics.inc('bot_throttled_updates_total', (('action', action), ('outcome', 'delayed')))
+        # Only this user's later updates wait behind it
+        await asyncio.sleep(delay)
+    return True
 
 
-async def send_daily_reminder(context: ContextTypes.DEFAULT_TYPE):
-    """Send daily reminder about days left until deadline."""
-    if is_deadline_passed():
-        return
+def prune_user(user_id):
+    """Drop a user who blocked the bot (or whose chat is gone) from every campaign's audience."""
+    for campaign in campaigns:
+        if user_id in campaign.basket.active_users:
+            campaign.basket.remove_user(user_id)
+    logger.info("User %s is unreachable, removed from broadcasts", user_id, extra={'user_id': user_id})
+
+
+async def notify_all_users_deadline_job(context: ContextTypes.DEFAULT_TYPE, run_id):
+    """Send deadline message to all active users of the job's campaign (scheduler job)."""
+    refresh_shared_state()
+    campaign = campaigns.get(context.job.data)
+    campaign.mark_deadline_passed()
+    
+    logger.info(
+        "Deadline of %s reached! Notifying %d users...", campaign.id, len(campaign.basket.active_users),
+        extra={'campaign': campaign.id},
+    )
     
+    async def send(user_id):
+        await context.bot.send_message(chat_id=user_id, text=DEADLINE_MESSAGE)
+    
+    await broadcaster.broadcast(
+        f"deadline:{campaign.id}", campaign.basket.active_users.copy(), send,
+        broadcast_id=run_id, on_unreachable=prune_user
+    )
+
+
+def build_reminder_text(campaign):
+    """Build reminder text with days/hours left until the campaign deadline."""
     now = datetime.now(MOSCOW_TZ)
-    time_left = DEADLINE_DATETIME - now
+    time_left = campaign.deadline - now
     days_left = time_left.days
     hours_left = time_left.seconds // 3600
     
     if days_left > 0:
         if days_left == 1:
-            reminder_text = f"⏰ Остался {days_left} день до окончания приёма заявок!\n\nУспей выбрать подарки! 🎁"
+            return f"⏰ Остался {days_left} день до окончания приёма заявок!\n\nУспей выбрать подарки! 🎁"
         elif days_left < 5:
-            reminder_text = f"⏰ Осталось {days_left} дня до окончания приёма заявок!\n\nУспей выбрать подарки! 🎁"
+            return f"⏰ Осталось {days_left} дня до окончания приёма заявок!\n\nУспей выбрать подарки! 🎁"
         else:
-            reminder_text = f"⏰ Осталось {days_left} дней до окончания приёма заявок!\n\nУспей выбрать подарки! 🎁"
-    else:
-        reminder_text = f"⏰ Остались последние часы! До окончания приёма заявок: {hours_left} ч.\n\nСкорее выбирай подарки! 🎁"
+            return f"⏰ Осталось {days_left} дней до окончания приёма заявок!\n\nУспей выбрать подарки! 🎁"
+    return f"⏰ Остались последние часы! До окончания приёма заявок: {hours_left} ч.\n\nСкорее выбирай подарки! 🎁"
+
+
+async def broadcast_reminder(context: ContextTypes.DEFAULT_TYPE, campaign, name, recipients, broadcast_id=None):
+    """Send reminder GIF (or text if GIF is missing/fails) to recipients, resumable by `broadcast_id`."""
+    reminder_text = build_reminder_text(campaign)
+    reminder_gif = media.get(REMINDER_GIF)
+    
+    async def send_text(user_id):
+        await context.bot.send_message(chat_id=user_id, text=reminder_text)
+    
+    if reminder_gif is None:
+        logger.warning("Reminder GIF not found: %s", REMINDER_GIF)
+        return await broadcaster.broadcast(
+            name, recipients, send_text, broadcast_id=broadcast_id, on_unreachable=prune_user
+        )
+    
+    async def send_gif(user_id):
+        await send_animation_cached(
+            media_cache,
+            context.bot.send_animation,
+            reminder_gif,
+            chat_id=user_id,
+            caption=reminder_text
+        )
     
-    print(f"Sending daily reminder to {len(active_users)} users: {days_left} days left", flush=True)
+    # Fallback to text message if GIF fails
+    return await broadcaster.broadcast(
+        name, recipients, send_gif, fallback=send_text, broadcast_id=broadcast_id, on_unreachable=prune_user
+    )
+
+
+async def send_daily_reminder(context: ContextTypes.DEFAULT_TYPE, run_id):
+    """Send daily reminder about days left until the campaign deadline (scheduler job)."""
+    refresh_shared_state()
+    campaign = campaigns.get(context.job.data)
+    if campaign.is_deadline_passed():
+        return
     
-    # Load reminder GIF
-    reminder_gif_path = os.path.join(os.path.dirname(__file__), 'static', 'time1.gif')
+    logger.info(
+        "Sending daily reminder of %s to %d users", campaign.id, len(campaign.basket.active_users),
+        extra={'campaign': campaign.id},
+    )
     
     # Send to all active users (except admin)
-    for user_id in active_users.copy():
-        if user_id != ADMIN_ID:  # Don't send reminder to admin
-            try:
-                if os.path.exists(reminder_gif_path):
-                    with open(reminder_gif_path, 'rb') as gif_file:
-                        await context.bot.send_animation(
-                            chat_id=user_id,
-                            animation=gif_file,
-                            caption=reminder_text
-                        )
-                else:
-                    await context.bot.send_message(chat_id=user_id, text=reminder_text)
-            except Exception as e:
-                print(f"Error sending reminder to {user_id}: {e}", flush=True)
-                # Fallback to text message
-                try:
-                    await context.bot.send_message(chat_id=user_id, text=reminder_text)
-                except:
-                    pass
+    recipients = [user_id for user_id in campaign.basket.active_users.copy() if not campaign.is_admin(user_id)]
+    await broadcast_reminder(context, campaign, f"daily_reminder:{campaign.id}", recipients, broadcast_id=run_id)
+
+
+# Deadline notices and reminders live in the jobs table and survive restarts
+scheduler = Scheduler(storage, {
+    'deadline_notification': notify_all_users_deadline_job,
+    'daily_reminder': send_daily_reminder,
+}, MOSCOW_TZ, is_leader=election.is_leader if election else None)
+seen_data_version = storage.data_version()
+
+
+def refresh_shared_state():
+    """Reload the campaigns and jobs another worker has changed since the last call."""
+    global seen_data_version
+    data_version = storage.data_version()
+    if data_version == seen_data_version:
+        return
+    seen_data_version = data_version
+    # Lease renewals, broadcast checkpoints and persistence flushes bump no revision
+    changed = storage.changed_revisions()
+    if not changed:
+        return
+    campaigns.refresh(changed)
+    if JOBS_SCOPE in changed:
+        scheduler.reload()
+    storage.revisions.update(changed)
+
+
+async def sync_shared_state(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Bring this worker's view of the shared database up to date before handling an update."""
+    refresh_shared_state()
+
+
+if election is not None:
+    election.on_tick = refresh_shared_state
+    election.on_elected = scheduler.catch_up
+
+
+def schedule_campaign_jobs(campaign):
+    """Create deadline notification and daily reminder jobs of one campaign on first run."""
+    deadline_job = scheduler.ensure('deadline_notification', campaign.id, campaign.deadline.isoformat())
+    reminder_job = scheduler.ensure('daily_reminder', campaign.id, f"{REMINDER_TIME:%H:%M}")
+    if campaign.is_deadline_passed():
+        logger.info("Deadline of %s has already passed", campaign.id, extra={'campaign': campaign.id})
+        return
+    logger.info(
+        "Deadline notification of %s scheduled for %s, daily reminder for %s Moscow time",
+        campaign.id, deadline_job.at, reminder_job.schedule, extra={'campaign': campaign.id},
+    )
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /start is issued."""
+    # Deep link t.me/<bot>?start=<campaign_id> moves the chat to that campaign
+    if context.args:
+        joined = campaigns.get(context.args[0])
+        if joined is None:
+            await update.message.reply_text("🤷 Такой кампании нет, проверь ссылку")
+            return
+        campaigns.bind_chat(update.effective_chat.id, joined.id)
+    
     # Track user
-    active_users.add(update.effective_user.id)
+    campaign = get_campaign(update)
+    basket = campaign.basket
+    basket.add_user(update.effective_user.id)
     
     # Check deadline
-    if is_deadline_passed():
+    if campaign.is_deadline_passed():
         await send_deadline_message(update)
         return
     
-    welcome_message = """🎂 Аттракцион невиданной щедрости! 🎉
+    welcome_message = f"""🎂 Аттракцион невиданной щедрости! 🎉
 
 Лавэ не проблема, проблема что оно ограничено.
 
 Кидай ссылки и цену пока бот не начнет ругаться что деньги кончилсь.
 
-Заказы принимаются до 19.12 12:00, после чего все будет заказано и отправлено.
+Заказы принимаются до {campaign.deadline:%d.%m %H:%M}, после чего все будет заказано и отправлено.
 
 Ссылки можно удалять если передумала.
 
@@ -146,122 +404,263 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     
     # Send saw-jigsaw GIF with welcome message as caption
     try:
-        gif_path = os.path.join(os.path.dirname(__file__), 'static', 'saw-jigsaw.gif')
-        if os.path.exists(gif_path):
-            with open(gif_path, 'rb') as gif_file:
-                await update.message.reply_animation(
-                    animation=gif_file,
-                    caption=welcome_message,
-                    reply_markup=get_menu_keyboard()
-                )
-                return
+        welcome_gif = media.get(WELCOME_GIF)
+        if welcome_gif is not None:
+            await reply_gif(
+                update,
+                welcome_gif,
+                caption=welcome_message,
+                reply_markup=MENU_KEYBOARD
+            )
+            return
     except Exception as e:
-        print(f"Error sending GIF: {e}", flush=True)
+        logger.error("Error sending GIF: %s", e)
     
     # Fallback: send text only if GIF fails
-    await update.message.reply_text(welcome_message, reply_markup=get_menu_keyboard())
+    await update.message.reply_text(welcome_message, reply_markup=MENU_KEYBOARD)
 
 
 async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show menu."""
     # Track user
-    active_users.add(update.effective_user.id)
+    campaign = get_campaign(update)
+    basket = campaign.basket
+    basket.add_user(update.effective_user.id)
     
     # Check deadline
-    if is_deadline_passed():
+    if campaign.is_deadline_passed():
         await send_deadline_message(update)
         return
     
-    await update.message.reply_text("📌 Выбери действие:", reply_markup=get_menu_keyboard())
+    await update.message.reply_text("📌 Выбери действие:", reply_markup=MENU_KEYBOARD)
+
+
+def budget_header(campaign):
+    """Budget summary shown above the admin order list."""
+    stats = campaign.stats
+    status_message = f"""
+📊 Статус бюджета «{campaign.title}»:
+
+💰 Потрачено: {stats.spent:.0f} ₽
+💵 Осталось: {campaign.remaining:.0f} ₽
+🎯 Лимит: {campaign.budget_limit:.0f} ₽
+📦 Заказов: {stats.count}
+👥 Заказывали: {len(stats.users)}
+    """
+    if stats.count:
+        status_message += "\n📋 Заказы:\n"
+    return status_message
+
+
+# Paginated basket views: name -> (line format, header, footer, parse mode); None header is built per call
+PAGE_VIEWS = {
+    'items': ('items', "📋 **Че я там накидала в корзину:**\n\n", '', 'Markdown'),
+    'remove': ('pick', "❌ Че удаляем?\n\n", "\nТыкни кнопку или напиши номер ссылки:", None),
+    'edit': ('pick', "✏️ Для чего изменить ссылку?\n\n", "\nТыкни кнопку или напиши номер ссылки:", None),
+    'admin': ('admin', None, '', None),
+}
+
+
+def render_page(campaign, name, page=0):
+    """Render one page of a basket view; returns (text, inline keyboard or None, parse mode).
+
+    Remove and edit pages get a button per item on the page above the navigation.
+    """
+    line_format, header, footer, parse_mode = PAGE_VIEWS[name]
+    if header is None:
+        header = budget_header(campaign)
+    text, page, pages = campaign.view.render(line_format, page, header, footer)
+    if name not in ITEM_CALLBACK_PREFIXES:
+        return text, BasketView.navigation(name, page, pages), parse_mode
+    rows = campaign.view.item_buttons(name, page)
+    navigation = BasketView.navigation_row(name, page, pages)
+    if navigation:
+        rows.append(navigation)
+    return text, InlineKeyboardMarkup(rows), parse_mode
+
+
+async def reply_page(update: Update, campaign, name):
+    """Reply with the first page of a basket view."""
+    text, navigation, parse_mode = render_page(campaign, name)
+    if navigation is None and name == 'items':
+        navigation = MENU_KEYBOARD
+    await update.message.reply_text(text, reply_markup=navigation, parse_mode=parse_mode)
+
+
+async def handle_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Switch a paginated basket view to another page in place."""
+    query = update.callback_query
+    _, name, page = query.data.split(':')
+    campaign = get_campaign(update)
+    await query.answer()
+    if name not in PAGE_VIEWS or (name == 'admin' and not campaign.is_admin(update.effective_user.id)):
+        return
+    
+    text, navigation, parse_mode = render_page(campaign, name, int(page))
+    try:
+        await query.edit_message_text(text, reply_markup=navigation, parse_mode=parse_mode)
+    except BadRequest as e:
+        # Pressing the current page number leaves the message unchanged
+        if 'not modified' not in str(e):
+            raise
 
 
 async def show_items(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show added items."""
-    global added_items
-    
     # Track user (viewing is allowed after deadline)
-    active_users.add(update.effective_user.id)
+    basket = get_campaign(update).basket
+    basket.add_user(update.effective_user.id)
     
-    if not added_items:
+    if not basket.items:
         await update.message.reply_text(
             "📋 Так тут пусто, что смотреть-то!\n\n"
             "Тыкай в меню «🛒 Закинуть в корзину» чтобы начать",
-            reply_markup=get_menu_keyboard()
+            reply_markup=MENU_KEYBOARD
         )
         return
     
-    items_text = "📋 **Че я там накидала в корзину:**\n\n"
-    for i, item in enumerate(added_items, 1):
-        items_text += f"{i}. {item['name']} — {item['price']:.0f} ₽\n   🔗 {item['link']}\n"
+    await reply_page(update, get_campaign(update), 'items')
+
+
+async def menu_add(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Menu: start adding an item."""
+    if get_campaign(update).is_deadline_passed():
+        await send_deadline_message(update)
+        return ConversationHandler.END
+    await update.message.reply_text("🔗 Будьте добры ссылку:", reply_markup=MENU_KEYBOARD)
+    return ConversationHandler.END
+
+
+async def menu_items(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Menu: show added items."""
+    await show_items(update, context)
+    return ConversationHandler.END
+
+
+async def menu_remove(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Menu: ask which item to remove."""
+    campaign = get_campaign(update)
+    if campaign.is_deadline_passed():
+        await send_deadline_message(update)
+        return ConversationHandler.END
+    if not campaign.basket.items:
+        await update.message.reply_text(
+            "📋 Список пуст, нечего удалять!",
+            reply_markup=MENU_KEYBOARD
+        )
+        return ConversationHandler.END
+    
+    await reply_page(update, campaign, 'remove')
+    return WAITING_FOR_REMOVE
+
+
+async def menu_edit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Menu: ask which item's link to change."""
+    campaign = get_campaign(update)
+    if campaign.is_deadline_passed():
+        await send_deadline_message(update)
+        return ConversationHandler.END
+    if not campaign.basket.items:
+        await update.message.reply_text(
+            "📋 Список пуст, нечего изменять!",
+            reply_markup=MENU_KEYBOARD
+        )
+        return ConversationHandler.END
+    
+    await reply_page(update, campaign, 'edit')
+    return WAITING_FOR_EDIT_ITEM
+
+
+def release_reservation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Give back the budget reserved by an add flow that will not be finished."""
+    campaign = campaigns.get(context.user_data.pop('reserved_campaign', None))
+    if campaign is not None:
+        campaign.release(update.effective_user.id)
+
+
+# Every menu button, in any conversation state, goes through this table
+menu_router = MenuRouter({
+    BUTTON_ADD: menu_add,
+    BUTTON_ITEMS: menu_items,
+    BUTTON_REMOVE: menu_remove,
+    BUTTON_EDIT: menu_edit,
+}, on_abandon=release_reservation)
+
+
+async def handle_bulk(update: Update, campaign, entries, unparsed) -> None:
+    """Add every valid "link price name" line of one message and reply with a single summary."""
+    if campaign.is_deadline_passed():
+        await send_deadline_message(update)
+        return
     
-    await update.message.reply_text(items_text, reply_markup=get_menu_keyboard(), parse_mode='Markdown')
+    user = update.effective_user
+    rejected = [(number, "не понял строку, нужно: ссылка цена название") for number in unparsed]
+    accepted = []
+    # Validation and the insert happen under the lock, so the batch is checked against the
+    # same budget and duplicates it is committed to
+    async with campaign.lock:
+        remaining = campaign.remaining
+        seen = set()
+        for number, link, price_text, name in entries:
+            price = float(price_text.replace(',', '.'))
+            key = canonical_key(link)
+            if price <= 0 or price > 1000000:
+                rejected.append((number, "что-то не так с ценой"))
+            elif key in seen or key in campaign.basket.link_index:
+                rejected.append((number, "уже в корзине"))
+            elif price > remaining:
+                rejected.append((number, "деньги не бесконечные"))
+            else:
+                accepted.append((number, link, price, name))
+                seen.add(key)
+                remaining -= price
+        username = user.username or f"User_{user.id}"
+        try:
+            added = campaign.basket.add_items(
+                [entry[1:] for entry in accepted], username, user.id, campaign.budget_limit
+            ) if accepted else []
+        except BudgetExceeded:
+            # Another worker spent the money after this one last read the basket
+            added = []
+            rejected += [(entry[0], "деньги не бесконечные") for entry in accepted]
+    
+    lines = []
+    if added:
+        lines.append(f"✅ Добавлено в корзину: {len(added)} шт. на {sum(item['price'] for item in added):.0f} ₽:")
+        lines += [f"🏷 {item['name']} — {item['price']:.0f} ₽" for item in added]
+    else:
+        lines.append("❌ Ничего не добавлено")
+    if rejected:
+        lines.append("\n⚠️ Не добавлено:")
+        lines += [f"Строка {number}: {reason}" for number, reason in sorted(rejected)]
+    summary = "\n".join(lines)
+    if len(summary) > MESSAGE_LIMIT:
+        summary = summary[:MESSAGE_LIMIT - 1] + "…"
+    await update.message.reply_text(summary, reply_markup=MENU_KEYBOARD)
 
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle incoming messages."""
-    global added_items
-    
     # Track user
-    active_users.add(update.effective_user.id)
+    campaign = get_campaign(update)
+    basket = campaign.basket
+    basket.add_user(update.effective_user.id)
     
     message_text = update.message.text.strip()
     
     # Handle menu buttons
-    if message_text == "🛒 Закинуть в корзину":
-        if is_deadline_passed():
-            await send_deadline_message(update)
-            return ConversationHandler.END
-        await update.message.reply_text(
-            "🔗 Будьте добры ссылку:",
-            reply_markup=get_menu_keyboard()
-        )
-        return ConversationHandler.END
-    
-    if message_text == "📋 Мои ссылки":
-        await show_items(update, context)
+    state = await menu_router.interrupt(update, context)
+    if state is not None:
+        return state
+    
+    # A wishlist of "link price name" lines is added in one go, without the three-step flow
+    entries, unparsed = parse_bulk_lines(message_text)
+    if entries:
+        await handle_bulk(update, campaign, entries, unparsed)
         return ConversationHandler.END
     
-    if message_text == "❌ Удалить ссылку":
-        if is_deadline_passed():
-            await send_deadline_message(update)
-            return ConversationHandler.END
-        if not added_items:
-            await update.message.reply_text(
-                "📋 Список пуст, нечего удалять!",
-                reply_markup=get_menu_keyboard()
-            )
-            return ConversationHandler.END
-        
-        items_text = "❌ Че удаляем?\n\n"
-        for i, item in enumerate(added_items, 1):
-            items_text += f"{i}. {item['name']} — {item['price']:.0f} ₽\n"
-        items_text += "\nНапиши номер ссылки:"
-        
-        await update.message.reply_text(items_text)
-        return WAITING_FOR_REMOVE
-    
-    if message_text == "✏️ Изменить ссылку":
-        if is_deadline_passed():
-            await send_deadline_message(update)
-            return ConversationHandler.END
-        if not added_items:
-            await update.message.reply_text(
-                "📋 Список пуст, нечего изменять!",
-                reply_markup=get_menu_keyboard()
-            )
-            return ConversationHandler.END
-        
-        items_text = "✏️ Для чего изменить ссылку?\n\n"
-        for i, item in enumerate(added_items, 1):
-            items_text += f"{i}. {item['name']} — {item['price']:.0f} ₽\n"
-        items_text += "\nНапиши номер ссылки:"
-        
-        await update.message.reply_text(items_text)
-        return WAITING_FOR_EDIT_ITEM
-    
     # Check if message contains a URL
-    url_pattern = r'https?://[^\s]+'
-    urls = re.findall(url_pattern, message_text)
+    urls = URL_RE.findall(message_text)
     
     if not urls:
         await update.message.reply_text(
@@ -269,26 +668,25 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             "Например:\n"
             "https://www.ozon.ru/product/...\n"
             "https://www.wildberries.ru/catalog/...",
-            reply_markup=get_menu_keyboard()
+            reply_markup=MENU_KEYBOARD
         )
         return ConversationHandler.END
     
     product_link = urls[0]
     
     # Check deadline before adding
-    if is_deadline_passed():
+    if campaign.is_deadline_passed():
         await send_deadline_message(update)
         return ConversationHandler.END
     
-    # Check if link already exists in basket
-    for item in added_items:
-        if item['link'] == product_link:
-            await update.message.reply_text(
-                "⚠️ Так это уже в корзине, ссылка точно правильная?\n\n"
-                "Отправь другую ссылку",
-                reply_markup=get_menu_keyboard()
-            )
-            return ConversationHandler.END
+    # Check if the same product is already in basket
+    if basket.find_by_link(product_link):
+        await update.message.reply_text(
+            "⚠️ Так это уже в корзине, ссылка точно правильная?\n\n"
+            "Отправь другую ссылку",
+            reply_markup=MENU_KEYBOARD
+        )
+        return ConversationHandler.END
     
     # Save the link in user data
     context.user_data['product_link'] = product_link
@@ -303,31 +701,25 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 async def handle_price(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle price input."""
-    global current_spent, added_items
-    
     # Track user
-    active_users.add(update.effective_user.id)
+    campaign = get_campaign(update)
+    basket = campaign.basket
+    basket.add_user(update.effective_user.id)
     
     # Check deadline
-    if is_deadline_passed():
+    if campaign.is_deadline_passed():
         await send_deadline_message(update)
         return ConversationHandler.END
     
     message_text = update.message.text.strip()
     
-    # Handle menu buttons during price input
-    if message_text in ["🛒 Закинуть в корзину", "📋 Мои ссылки", "❌ Удалить ссылку", "✏️ Изменить ссылку"]:
-        context.user_data.pop('product_link', None)
-        if message_text == "📋 Мои ссылки":
-            await show_items(update, context)
-        elif message_text == "❌ Удалить ссылку" or message_text == "✏️ Изменить ссылку":
-            return await handle_message(update, context)
-        else:
-            await update.message.reply_text("🔗 Будьте добры ссылку:", reply_markup=get_menu_keyboard())
-        return ConversationHandler.END
+    # Handle menu buttons
+    state = await menu_router.interrupt(update, context)
+    if state is not None:
+        return state
     
     # Try to extract price
-    price_match = re.search(r'(\d+(?:[.,]\d{1,2})?)', message_text)
+    price_match = PRICE_RE.search(message_text)
     
     if not price_match:
         await update.message.reply_text(
@@ -346,12 +738,15 @@ async def handle_price(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         await update.message.reply_text("❌ Что-то тут не так")
         return WAITING_FOR_PRICE
     
-    # Check budget limit (hidden from user)
-    remaining_budget = BUDGET_LIMIT - current_spent
+    # Check budget limit (hidden from user); the price stays reserved until the name arrives,
+    # so parallel add flows can never overspend together
+    async with campaign.lock:
+        reserved = campaign.reserve(update.effective_user.id, price)
 
-    if price <= remaining_budget:
+    if reserved:
         # Save price and ask for name
         context.user_data['product_price'] = price
+        context.user_data['reserved_campaign'] = campaign.id
         
         await update.message.reply_text(
             "📝 Как называется?"
@@ -364,50 +759,62 @@ async def handle_price(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
 💰 Цена: {price:.0f} ₽
 😔 Придется поменять на что-то подешевле (а сколько денег осталось ты не знаешь АХААХХАХАХАХА)
         """
-        await update.message.reply_text(over_limit_message, reply_markup=get_menu_keyboard())
+        await update.message.reply_text(over_limit_message, reply_markup=MENU_KEYBOARD)
         context.user_data.pop('product_link', None)
         return ConversationHandler.END
 
 
 async def handle_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle product name input."""
-    global current_spent, added_items
-    
     # Track user
-    active_users.add(update.effective_user.id)
+    campaign = get_campaign(update)
+    basket = campaign.basket
+    basket.add_user(update.effective_user.id)
     
     # Check deadline
-    if is_deadline_passed():
+    if campaign.is_deadline_passed():
+        release_reservation(update, context)
         await send_deadline_message(update)
         return ConversationHandler.END
     
     message_text = update.message.text.strip()
     
     # Handle menu buttons
-    if message_text in ["🛒 Закинуть в корзину", "📋 Мои ссылки", "❌ Удалить ссылку", "✏️ Изменить ссылку"]:
-        context.user_data.pop('product_link', None)
-        context.user_data.pop('product_price', None)
-        if message_text == "📋 Мои ссылки":
-            await show_items(update, context)
-        elif message_text == "❌ Удалить ссылку" or message_text == "✏️ Изменить ссылку":
-            return await handle_message(update, context)
-        else:
-            await update.message.reply_text("🔗 Будьте добры ссылку:", reply_markup=get_menu_keyboard())
-        return ConversationHandler.END
+    state = await menu_router.interrupt(update, context)
+    if state is not None:
+        return state
     
     product_name = message_text
     product_link = context.user_data.get('product_link', '')
     price = context.user_data.get('product_price', 0)
     
-    # Add to current spent and save item
-    current_spent += price
-    added_items.append({
-        "link": product_link,
-        "price": price,
-        "name": product_name,
-        "username": update.effective_user.username or f"User_{update.effective_user.id}",
-        "user_id": update.effective_user.id
-    })
+    # Turn the reservation made in handle_price into spending and save item
+    campaign = campaigns.get(context.user_data.pop('reserved_campaign', None)) or campaign
+    basket = campaign.basket
+    async with campaign.lock:
+        added = campaign.claim(update.effective_user.id, price)
+        if added:
+            try:
+                basket.add_item(
+                    link=product_link,
+                    price=price,
+                    name=product_name,
+                    username=update.effective_user.username or f"User_{update.effective_user.id}",
+                    user_id=update.effective_user.id,
+                    budget_limit=campaign.budget_limit
+                )
+            except BudgetExceeded:
+                added = False
+    
+    if not added:
+        # The reservation expired (or another worker spent the money) and the budget ran out
+        context.user_data.pop('product_link', None)
+        context.user_data.pop('product_price', None)
+        await update.message.reply_text(
+            "❌ Пока ты думала над названием, деньги кончились. Попробуй что-то подешевле",
+            reply_markup=MENU_KEYBOARD
+        )
+        return ConversationHandler.END
 
     success_message = f"""✅ Лавэха потрачена, заказ в корзине!
 
@@ -417,21 +824,19 @@ async def handle_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     
     # Send random meme GIF with success message as caption
     try:
-        meme_files = ['meme1.gif', 'meme2.gif', 'meme3.gif', 'meme4.gif', 'meme5.gif', 'meme7.gif', 'meme8.gif']
-        random_meme = random.choice(meme_files)
-        gif_path = os.path.join(os.path.dirname(__file__), 'static', random_meme)
-        if os.path.exists(gif_path):
-            with open(gif_path, 'rb') as gif_file:
-                await update.message.reply_animation(
-                    animation=gif_file,
-                    caption=success_message,
-                    reply_markup=get_menu_keyboard()
-                )
+        meme = media.choice(MEME_GIFS)
+        if meme is not None:
+            await reply_gif(
+                update,
+                meme,
+                caption=success_message,
+                reply_markup=MENU_KEYBOARD
+            )
         else:
-            await update.message.reply_text(success_message, reply_markup=get_menu_keyboard())
+            await update.message.reply_text(success_message, reply_markup=MENU_KEYBOARD)
     except Exception as e:
-        print(f"Error sending meme GIF: {e}", flush=True)
-        await update.message.reply_text(success_message, reply_markup=get_menu_keyboard())
+        logger.error("Error sending meme GIF: %s", e)
+        await update.message.reply_text(success_message, reply_markup=MENU_KEYBOARD)
     
     # Clear saved data
     context.user_data.pop('product_link', None)
@@ -442,27 +847,22 @@ async def handle_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
 
 async def handle_remove(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle item removal."""
-    global current_spent, added_items
-    
     # Track user
-    active_users.add(update.effective_user.id)
+    campaign = get_campaign(update)
+    basket = campaign.basket
+    basket.add_user(update.effective_user.id)
     
     # Check deadline
-    if is_deadline_passed():
+    if campaign.is_deadline_passed():
         await send_deadline_message(update)
         return ConversationHandler.END
     
     message_text = update.message.text.strip()
     
-    # Handle menu buttons during remove
-    if message_text in ["🛒 Закинуть в корзину", "📋 Мои ссылки", "❌ Удалить ссылку", "✏️ Изменить ссылку"]:
-        if message_text == "📋 Мои ссылки":
-            await show_items(update, context)
-        elif message_text == "🛒 Закинуть в корзину":
-            await update.message.reply_text("🔗 Будьте добры ссылку:", reply_markup=get_menu_keyboard())
-        else:
-            return await handle_message(update, context)
-        return ConversationHandler.END
+    # Handle menu buttons
+    state = await menu_router.interrupt(update, context)
+    if state is not None:
+        return state
     
     # Try to get item number
     try:
@@ -470,65 +870,60 @@ async def handle_remove(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     except ValueError:
         await update.message.reply_text(
             "❌ Напиши номер ссылки (число)!",
-            reply_markup=get_menu_keyboard()
+            reply_markup=MENU_KEYBOARD
         )
         return ConversationHandler.END
     
-    if item_num < 1 or item_num > len(added_items):
+    # Remove item (range is checked under the lock, another participant may have changed the list)
+    async with campaign.lock:
+        removed_item = basket.remove_item(item_num - 1) if 1 <= item_num <= len(basket.items) else None
+    
+    if removed_item is None:
         await update.message.reply_text(
             f"❌ Нет ссылки с номером {item_num}!",
-            reply_markup=get_menu_keyboard()
+            reply_markup=MENU_KEYBOARD
         )
         return ConversationHandler.END
     
-    # Remove item
-    removed_item = added_items.pop(item_num - 1)
-    current_spent -= removed_item['price']
-    
     refund_message = f"✅ {removed_item['name']} за {removed_item['price']:.0f} ₽ удалён!\n\n💸 {removed_item['price']:.0f} ₽ вернулись в бюджет"
     
-    # Send meme6 GIF with refund message as caption
+    # Send refund GIF with refund message as caption
     try:
-        gif_path = os.path.join(os.path.dirname(__file__), 'static', 'meme6.gif')
-        if os.path.exists(gif_path):
-            with open(gif_path, 'rb') as gif_file:
-                await update.message.reply_animation(
-                    animation=gif_file,
-                    caption=refund_message,
-                    reply_markup=get_menu_keyboard()
-                )
+        refund_gif = media.get(REFUND_GIF)
+        if refund_gif is not None:
+            await reply_gif(
+                update,
+                refund_gif,
+                caption=refund_message,
+                reply_markup=MENU_KEYBOARD
+            )
         else:
-            await update.message.reply_text(refund_message, reply_markup=get_menu_keyboard())
+            await update.message.reply_text(refund_message, reply_markup=MENU_KEYBOARD)
     except Exception as e:
-        print(f"Error sending meme6 GIF: {e}", flush=True)
-        await update.message.reply_text(refund_message, reply_markup=get_menu_keyboard())
+        logger.error("Error sending refund GIF: %s", e)
+        await update.message.reply_text(refund_message, reply_markup=MENU_KEYBOARD)
     
     return ConversationHandler.END
 
 
 async def handle_edit_item(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle selecting item to edit."""
-    global added_items
-    
     # Track user
-    active_users.add(update.effective_user.id)
+    campaign = get_campaign(update)
+    basket = campaign.basket
+    basket.add_user(update.effective_user.id)
     
     # Check deadline
-    if is_deadline_passed():
+    if campaign.is_deadline_passed():
         await send_deadline_message(update)
         return ConversationHandler.END
     
     message_text = update.message.text.strip()
     
     # Handle menu buttons
-    if message_text in ["🛒 Закинуть в корзину", "📋 Мои ссылки", "❌ Удалить ссылку", "✏️ Изменить ссылку"]:
-        if message_text == "📋 Мои ссылки":
-            await show_items(update, context)
-        elif message_text == "🛒 Закинуть в корзину":
-            await update.message.reply_text("🔗 Будьте добры ссылку:", reply_markup=get_menu_keyboard())
-        else:
-            return await handle_message(update, context)
-        return ConversationHandler.END
+    state = await menu_router.interrupt(update, context)
+    if state is not None:
+        return state
     
     # Try to get item number
     try:
@@ -536,20 +931,20 @@ async def handle_edit_item(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     except ValueError:
         await update.message.reply_text(
             "❌ Напиши номер ссылки (число)!",
-            reply_markup=get_menu_keyboard()
+            reply_markup=MENU_KEYBOARD
         )
         return ConversationHandler.END
     
-    if item_num < 1 or item_num > len(added_items):
+    if item_num < 1 or item_num > len(basket.items):
         await update.message.reply_text(
             f"❌ Нет ссылки с номером {item_num}!",
-            reply_markup=get_menu_keyboard()
+            reply_markup=MENU_KEYBOARD
         )
         return ConversationHandler.END
     
-    # Save item index for editing
-    context.user_data['edit_item_index'] = item_num - 1
-    item = added_items[item_num - 1]
+    # Save the item ID, its position may shift while the new link is being typed
+    item = basket.items[item_num - 1]
+    context.user_data['edit_item_id'] = item['id']
     
     await update.message.reply_text(
         f"🔗 Отправь новую ссылку для «{item['name']}» ({item['price']:.0f} ₽):"
@@ -560,32 +955,25 @@ async def handle_edit_item(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 
 async def handle_new_link(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle new link input for editing."""
-    global added_items
-    
     # Track user
-    active_users.add(update.effective_user.id)
+    campaign = get_campaign(update)
+    basket = campaign.basket
+    basket.add_user(update.effective_user.id)
     
     # Check deadline
-    if is_deadline_passed():
+    if campaign.is_deadline_passed():
         await send_deadline_message(update)
         return ConversationHandler.END
     
     message_text = update.message.text.strip()
     
     # Handle menu buttons
-    if message_text in ["🛒 Закинуть в корзину", "📋 Мои ссылки", "❌ Удалить ссылку", "✏️ Изменить ссылку"]:
-        context.user_data.pop('edit_item_index', None)
-        if message_text == "📋 Мои ссылки":
-            await show_items(update, context)
-        elif message_text == "🛒 Закинуть в корзину":
-            await update.message.reply_text("🔗 Будьте добры ссылку:", reply_markup=get_menu_keyboard())
-        else:
-            return await handle_message(update, context)
-        return ConversationHandler.END
+    state = await menu_router.interrupt(update, context)
+    if state is not None:
+        return state
     
     # Check if message contains a URL
-    url_pattern = r'https?://[^\s]+'
-    urls = re.findall(url_pattern, message_text)
+    urls = URL_RE.findall(message_text)
     
     if not urls:
         await update.message.reply_text(
@@ -596,37 +984,92 @@ async def handle_new_link(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return WAITING_FOR_NEW_LINK
     
     new_link = urls[0]
-    item_index = context.user_data.get('edit_item_index', 0)
-    
-    # Check if link already exists in basket (except current item)
-    for i, item in enumerate(added_items):
-        if i != item_index and item['link'] == new_link:
-            await update.message.reply_text(
-                "⚠️ Так это уже в корзине, ссылка точно правильная?\n\n"
-                "Отправь другую ссылку 😊"
-            )
-            return WAITING_FOR_NEW_LINK
     
-    # Update the link
-    item_name = added_items[item_index]['name']
-    added_items[item_index]['link'] = new_link
+    # Check if the same product is already in basket (except current item) and update the link
+    async with campaign.lock:
+        item_index = basket.position(context.user_data.get('edit_item_id'))
+        if item_index is not None:
+            existing = basket.find_by_link(new_link)
+            is_duplicate = existing is not None and existing is not basket.items[item_index]
+            if not is_duplicate:
+                item_name = basket.update_link(item_index, new_link)['name']
+    
+    if item_index is None:
+        context.user_data.pop('edit_item_id', None)
+        await update.message.reply_text(ITEM_GONE_MESSAGE, reply_markup=MENU_KEYBOARD)
+        return ConversationHandler.END
+    
+    if is_duplicate:
+        await update.message.reply_text(
+            "⚠️ Так это уже в корзине, ссылка точно правильная?\n\n"
+            "Отправь другую ссылку 😊"
+        )
+        return WAITING_FOR_NEW_LINK
     
     await update.message.reply_text(
         f"✅ Ссылка для «{item_name}» обновлена!",
-        reply_markup=get_menu_keyboard()
+        reply_markup=MENU_KEYBOARD
     )
     
-    context.user_data.pop('edit_item_index', None)
+    context.user_data.pop('edit_item_id', None)
     
     return ConversationHandler.END
 
 
+async def handle_item_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Remove or start editing the item of a pressed inline button, editing the list message in place."""
+    query = update.callback_query
+    prefix, item_id, version = query.data.split(':')
+    name = 'remove' if prefix == ITEM_CALLBACK_PREFIXES['remove'] else 'edit'
+    item_id, version = int(item_id), int(version)
+    campaign = get_campaign(update)
+    basket = campaign.basket
+    basket.add_user(update.effective_user.id)
+    
+    # A button press leaves whatever flow was in progress, like a menu button
+    menu_router.abandon(update, context)
+    
+    if campaign.is_deadline_passed():
+        await query.answer()
+        await send_deadline_message(update)
+        return ConversationHandler.END
+    
+    # Buttons are stamped with the basket version they were rendered for; numbers and
+    # positions may have shifted since, so a stale list is refreshed instead of acted on
+    async with campaign.lock:
+        index = basket.position(item_id) if version == basket.version else None
+        item = basket.items[index] if index is not None else None
+        if item is not None and name == 'remove':
+            basket.remove_item(index)
+    
+    if item is None:
+        await query.answer("Список уже поменялся, вот свежий 👇")
+        if not basket.items:
+            await query.edit_message_text(ITEM_GONE_MESSAGE)
+            return ConversationHandler.END
+        text, keyboard, parse_mode = render_page(campaign, name)
+        await query.edit_message_text(text, reply_markup=keyboard, parse_mode=parse_mode)
+        return WAITING_FOR_REMOVE if name == 'remove' else WAITING_FOR_EDIT_ITEM
+    
+    await query.answer()
+    if name == 'remove':
+        await query.edit_message_text(
+            f"✅ {item['name']} за {item['price']:.0f} ₽ удалён!\n\n💸 {item['price']:.0f} ₽ вернулись в бюджет"
+        )
+        return ConversationHandler.END
+    
+    context.user_data['edit_item_id'] = item['id']
+    await query.edit_message_text(f"🔗 Отправь новую ссылку для «{item['name']}» ({item['price']:.0f} ₽):")
+    return WAITING_FOR_NEW_LINK
+
+
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancel the conversation."""
+    release_reservation(update, context)
     context.user_data.pop('product_link', None)
     context.user_data.pop('product_price', None)
-    context.user_data.pop('edit_item_index', None)
-    await update.message.reply_text("👌 Хорошо!", reply_markup=get_menu_keyboard())
+    context.user_data.pop('edit_item_id', None)
+    await update.message.reply_text("👌 Хорошо!", reply_markup=MENU_KEYBOARD)
     return ConversationHandler.END
 
 
@@ -637,157 +1080,395 @@ async def myid(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 
 async def budget_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Show current budget status (for admin only - not visible to sister)"""
-    if update.effective_user.id != ADMIN_ID:
+    """Show current budget status (for campaign admin only - not visible to sister)"""
+    campaign = get_campaign(update)
+    if not campaign.is_admin(update.effective_user.id):
         return  # Ignore if not admin
     
-    global current_spent, added_items
+    await reply_page(update, campaign, 'admin')
 
-    remaining = BUDGET_LIMIT - current_spent
-    status_message = f"""
-📊 Статус бюджета:
 
-💰 Потрачено: {current_spent:.0f} ₽
-💵 Осталось: {remaining:.0f} ₽
-🎯 Лимит: {BUDGET_LIMIT} ₽
-📦 Заказов: {len(added_items)}
-    """
+async def budget_by_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Spending per participant, biggest spender first (for campaign admin only)"""
+    campaign = get_campaign(update)
+    if not campaign.is_admin(update.effective_user.id):
+        return  # Ignore if not admin
     
-    if added_items:
-        status_message += "\n📋 Заказы:\n"
-        for i, item in enumerate(added_items, 1):
-            status_message += f"{i}. {item['name']} — {item['price']:.0f} ₽\n   👤 @{item['username']}\n   🔗 {item['link']}\n"
+    stats = campaign.stats
+    if not stats.count:
+        await update.message.reply_text("📭 Пока никто ничего не заказал")
+        return
+    lines = [f"👥 Траты по участникам «{campaign.title}»:\n"]
+    for number, totals in enumerate(stats.by_user(), 1):
+        who = f"@{totals.username}" if totals.username else f"ID {totals.user_id}"
+        lines.append(
+            f"{number}. {who} — {totals.spent:.0f} ₽ за {totals.count} шт., самый дорогой {totals.largest:.0f} ₽"
+        )
+    lines.append(f"\n💰 Всего: {stats.spent:.0f} ₽ за {stats.count} шт.")
+    text = "\n".join(lines)
+    if len(text) > MESSAGE_LIMIT:
+        text = text[:MESSAGE_LIMIT - 1] + "…"
+    await update.message.reply_text(text)
+
+
+async def export_basket(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Send the basket as a CSV or JSONL document: /export [csv|jsonl] (for campaign admin only)"""
+    campaign = get_campaign(update)
+    if not campaign.is_admin(update.effective_user.id):
+        return  # Ignore if not admin
     
-    await update.message.reply_text(status_message)
+    export_format = context.args[0].lower() if context.args else 'csv'
+    if export_format not in EXPORT_FORMATS:
+        await update.message.reply_text("Использование: /export [csv|jsonl]")
+        return
+    
+    # Rows go from the database cursor straight into a spooled file, never all in memory at once
+    export_file = export_rows(storage.iter_items(campaign.id), export_format)
+    try:
+        await update.message.reply_document(
+            document=InputFile(export_file, filename=f"{campaign.id}_{datetime.now(MOSCOW_TZ):%Y%m%d_%H%M}.{export_format}"),
+            caption=f"📦 {len(campaign.basket.items)} товаров на {campaign.basket.spent:.0f} ₽"
+        )
+    finally:
+        export_file.close()
 
 
 async def reset_budget(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Reset budget counter (for admin only)"""
-    if update.effective_user.id != ADMIN_ID:
+    """Reset budget counter (for campaign admin only)"""
+    campaign = get_campaign(update)
+    if not campaign.is_admin(update.effective_user.id):
         return  # Ignore if not admin
     
-    global current_spent, added_items
-    current_spent = 0
-    added_items = []
+    async with campaign.lock:
+        campaign.basket.reset()
     await update.message.reply_text("✅ Бюджет и список ссылок сброшены!")
 
 
 async def test_reminder(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Send test daily reminder (for admin only)"""
-    if update.effective_user.id != ADMIN_ID:
+    """Send test daily reminder (for campaign admin only)"""
+    campaign = get_campaign(update)
+    if not campaign.is_admin(update.effective_user.id):
+        return  # Ignore if not admin
+    
+    # Send reminder to all active users including admin for testing; an interrupted test
+    # (e.g. by a restart) is resumed instead of starting over
+    recipients = campaign.basket.active_users.copy()
+    prefix = f"test_reminder:{campaign.id}@"
+    broadcast_id = storage.unfinished_broadcast(prefix) or f"{prefix}{utc_now()}"
+    result = await broadcast_reminder(
+        context, campaign, f"test_reminder:{campaign.id}", recipients, broadcast_id=broadcast_id
+    )
+    
+    await update.message.reply_text(
+        f"✅ Тестовое напоминание отправлено {result.sent} пользователям!\n"
+        f"⏭ Уже получили раньше: {result.skipped}, 🚫 заблокировали бота: {result.pruned}\n"
+        f"❌ Ошибок: {result.failed}, 🔁 повторов: {result.retried}, ⏱ {result.duration:.1f} с"
+    )
+
+
+def format_job_time(value):
+    return f"{value:%d.%m %H:%M}" if value else "—"
+
+
+async def list_jobs(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show scheduled jobs of the campaign with their last and next run (for campaign admin only)"""
+    campaign = get_campaign(update)
+    if not campaign.is_admin(update.effective_user.id):
         return  # Ignore if not admin
     
-    # Send reminder to all active users including admin for testing
     now = datetime.now(MOSCOW_TZ)
-    time_left = DEADLINE_DATETIME - now
-    days_left = time_left.days
-    hours_left = time_left.seconds // 3600
+    lines = [f"🗓 Задачи кампании {campaign.id}:\n"]
+    for job in scheduler.for_campaign(campaign.id):
+        state = "" if job.enabled else " (выключена)"
+        lines.append(f"• {job.kind}{state}: {job.schedule}\n"
+                     f"  последний запуск: {format_job_time(job.last_run)}, "
+                     f"следующий: {format_job_time(job.next_run(now))}")
+    await update.message.reply_text("\n".join(lines))
+
+
+async def set_reminder(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Change or disable the daily reminder: /setreminder <HH:MM|off> (for campaign admin only)"""
+    campaign = get_campaign(update)
+    if not campaign.is_admin(update.effective_user.id):
+        return  # Ignore if not admin
     
-    if days_left > 0:
-        if days_left == 1:
-            reminder_text = f"⏰ Остался {days_left} день до окончания приёма заявок!\n\nУспей выбрать подарки! 🎁"
-        elif days_left < 5:
-            reminder_text = f"⏰ Осталось {days_left} дня до окончания приёма заявок!\n\nУспей выбрать подарки! 🎁"
-        else:
-            reminder_text = f"⏰ Осталось {days_left} дней до окончания приёма заявок!\n\nУспей выбрать подарки! 🎁"
-    else:
-        reminder_text = f"⏰ Остались последние часы! До окончания приёма заявок: {hours_left} ч.\n\nСкорее выбирай подарки! 🎁"
+    usage = "Использование: /setreminder <ЧЧ:ММ> или /setreminder off"
+    if len(context.args) != 1:
+        await update.message.reply_text(usage)
+        return
+    name = scheduler.ensure('daily_reminder', campaign.id, f"{REMINDER_TIME:%H:%M}").name
+    if context.args[0].lower() == 'off':
+        scheduler.set_enabled(name, False)
+        await update.message.reply_text("🔕 Ежедневное напоминание выключено")
+        return
+    try:
+        reminder_time = datetime.strptime(context.args[0], "%H:%M")
+    except ValueError:
+        await update.message.reply_text(f"❌ Не понял время\n\n{usage}")
+        return
+    scheduler.set_schedule(name, f"{reminder_time:%H:%M}")
+    await update.message.reply_text(f"🔔 Напоминание каждый день в {reminder_time:%H:%M} по Москве")
+
+
+async def set_deadline(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Move the campaign deadline: /setdeadline <DD.MM.YYYY> [HH:MM] (for campaign admin only)"""
+    campaign = get_campaign(update)
+    if not campaign.is_admin(update.effective_user.id):
+        return  # Ignore if not admin
     
-    # Load reminder GIF
-    reminder_gif_path = os.path.join(os.path.dirname(__file__), 'static', 'time1.gif')
-    print(f"Reminder GIF path: {reminder_gif_path}", flush=True)
-    print(f"File exists: {os.path.exists(reminder_gif_path)}", flush=True)
+    usage = "Использование: /setdeadline <ДД.ММ.ГГГГ> [ЧЧ:ММ]"
+    if len(context.args) not in (1, 2):
+        await update.message.reply_text(usage)
+        return
+    time_text = context.args[1] if len(context.args) == 2 else f"{campaign.deadline:%H:%M}"
+    try:
+        deadline = datetime.strptime(f"{context.args[0]} {time_text}", "%d.%m.%Y %H:%M").replace(tzinfo=MOSCOW_TZ)
+    except ValueError:
+        await update.message.reply_text(f"❌ Не понял дату\n\n{usage}")
+        return
     
-    # Send to all active users for testing
-    sent_count = 0
-    for user_id in active_users.copy():
-        try:
-            if os.path.exists(reminder_gif_path):
-                with open(reminder_gif_path, 'rb') as gif_file:
-                    await context.bot.send_animation(
-                        chat_id=user_id,
-                        animation=gif_file,
-                        caption=reminder_text
-                    )
-                sent_count += 1
-                print(f"Sent reminder with GIF to {user_id}", flush=True)
+    campaigns.set_deadline(campaign.id, deadline)
+    job = scheduler.ensure('deadline_notification', campaign.id, deadline.isoformat())
+    scheduler.set_schedule(job.name, deadline.isoformat())
+    await update.message.reply_text(f"⏰ Новый дедлайн: {deadline:%d.%m.%Y %H:%M}")
+
+
+async def new_campaign(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Create a new campaign: /newcampaign <id> <budget> <DD.MM.YYYY> [HH:MM] [admin id] (for bot owner only)"""
+    if update.effective_user.id != ADMIN_ID:
+        return  # Ignore if not bot owner
+    
+    usage = "Использование: /newcampaign <id> <бюджет> <ДД.ММ.ГГГГ> [ЧЧ:ММ] [id админа]"
+    if not 3 <= len(context.args) <= 5:
+        await update.message.reply_text(usage)
+        return
+    
+    campaign_id, budget_text, date_text = context.args[:3]
+    time_text = "12:00"
+    # The campaign's admin defaults to the owner; the optional time is told apart by its colon
+    admin_id = update.effective_user.id
+    try:
+        for extra in context.args[3:]:
+            if ':' in extra:
+                time_text = extra
             else:
-                await context.bot.send_message(chat_id=user_id, text=reminder_text)
-                sent_count += 1
-                print(f"GIF not found, sent text to {user_id}", flush=True)
-        except Exception as e:
-            print(f"Error sending test reminder to {user_id}: {e}", flush=True)
-            # Fallback to text
-            try:
-                await context.bot.send_message(chat_id=user_id, text=reminder_text)
-                sent_count += 1
-            except:
-                pass
+                admin_id = int(extra)
+        budget_limit = float(budget_text.replace(',', '.'))
+        deadline = datetime.strptime(f"{date_text} {time_text}", "%d.%m.%Y %H:%M").replace(tzinfo=MOSCOW_TZ)
+    except ValueError:
+        await update.message.reply_text(f"❌ Не понял бюджет, дату или id админа\n\n{usage}")
+        return
+    if not CAMPAIGN_ID_PATTERN.match(campaign_id) or campaigns.get(campaign_id):
+        await update.message.reply_text("❌ Такой id не подходит или уже занят (латиница, цифры, _ и -)")
+        return
+    
+    campaign = campaigns.create(campaign_id, campaign_id, budget_limit, deadline, admin_id)
+    schedule_campaign_jobs(campaign)
     
-    await update.message.reply_text(f"✅ Тестовое напоминание отправлено {sent_count} пользователям!")
+    await update.message.reply_text(
+        f"✅ Кампания {campaign.id} создана!\n\n"
+        f"💰 Бюджет: {campaign.budget_limit:.0f} ₽\n"
+        f"⏰ Дедлайн: {campaign.deadline:%d.%m.%Y %H:%M}\n"
+        f"👑 Админ: {campaign.admin_id}\n\n"
+        f"🔗 Ссылка для участников: https://t.me/{context.bot.username}?start={campaign.id}"
+    )
+
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show handler, Bot API and broadcast metrics (for bot owner only)"""
+    if update.effective_user.id != ADMIN_ID:
+        return  # Ignore if not bot owner
+    
+    lines = ["📈 Статистика\n", "⚙️ Обработчики (вызовов, сред. / p95 мс):"]
+    for labels, histogram in sorted(metrics.histograms.get('bot_handler_latency_seconds', {}).items()):
+        lines.append(f"  {labels[0][1]}: {histogram.count}, {histogram.sum / histogram.count * 1000:.1f} / "
+                     f"{histogram.quantile(0.95) * 1000:.0f}")
+    
+    lines.append("\n📡 Bot API (вызовов, КиБ отправлено, сред. мс):")
+    sent_bytes = metrics.counters.get('bot_api_bytes_sent_total', {})
+    for labels, histogram in sorted(metrics.histograms.get('bot_api_latency_seconds', {}).items()):
+        lines.append(f"  {labels[0][1]}: {histogram.count}, {sent_bytes.get(labels, 0) / 1024:.0f}, "
+                     f"{histogram.sum / histogram.count * 1000:.0f}")
+    
+    lines.append("\n📢 Рассылки:")
+    for labels, value in sorted(metrics.counters.get('bot_broadcast_messages_total', {}).items()):
+        lines.append(f"  {labels[0][1]} {labels[1][1]}: {value}")
+    
+    lines.append("\n🐢 Антифлуд:")
+    for labels, value in sorted(metrics.counters.get('bot_throttled_updates_total', {}).items()):
+        lines.append(f"  {labels[0][1]} {labels[1][1]}: {value}")
+    
+    lines.append("\n👥 Кампании (участников, товаров):")
+    for campaign in campaigns:
+        lines.append(f"  {campaign.id}: {len(campaign.basket.active_users)}, {len(campaign.basket.items)}")
+    
+    await update.message.reply_text("\n".join(lines))
+
+
+async def handle_metrics(request):
+    return text_response(200, metrics.render(), 'text/plain; version=0.0.4; charset=utf-8')
+
+
+async def post_init(application: Application) -> None:
+    """Start the metrics endpoint and pre-warm the GIF file_id cache once the bot is initialized."""
+    global metrics_server
+    if METRICS_PORT:
+        metrics_server = HttpServer(METRICS_LISTEN, int(METRICS_PORT))
+        metrics_server.add_route('GET', '/metrics', handle_metrics)
+        await metrics_server.start()
+        logger.info("Metrics available on http://%s:%s/metrics", METRICS_LISTEN, metrics_server.port)
+    
+    if not MEDIA_PREWARM_CHAT_ID:
+        return
+    warmed = await prewarm(media_cache, application.bot, int(MEDIA_PREWARM_CHAT_ID), media)
+    logger.info("Media cache pre-warmed: %d GIFs uploaded", warmed)
+
+
+async def post_shutdown(application: Application) -> None:
+    """Stop the metrics endpoint, hand over the leadership and release the mapped GIFs."""
+    if election is not None:
+        election.release()
+    if metrics_server is not None:
+        await metrics_server.stop()
+    media.close()
+
+
+def build_application(builder) -> Application:
+    """Build the application with all handlers and jobs from a configured ApplicationBuilder."""
+    # Users are served in parallel, each user's own updates strictly in order; flood protection
+    # delays or drops updates before they take a slot
+    builder = builder.concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES, throttle_update))
+    # Unfinished flows (conversation state and user_data) survive restarts
+    builder = builder.persistence(SQLitePersistence(storage, update_interval=PERSISTENCE_INTERVAL))
+    application = builder.post_init(post_init).post_shutdown(post_shutdown).build()
+    
+    def add_handler(handler, group=0):
+        # Every handler registered here is instrumented for latency/error/state metrics
+        application.add_handler(instrument_handler(handler, STATE_NAMES), group)
+    
+    # Set up deadline notifications and daily reminders of every campaign, catching up missed runs
+    if application.job_queue:
+        scheduler.attach(application.job_queue)
+        if election is not None:
+            application.job_queue.run_repeating(election.tick, interval=election.interval, first=0, name='leader_election')
+    for campaign in campaigns:
+        schedule_campaign_jobs(campaign)
+
+    # Conversation handler for link -> price -> name flow, remove flow, and edit flow
+    item_pattern = f"^({'|'.join(ITEM_CALLBACK_PREFIXES.values())}):"
+    # Item buttons are meant to work from any list message of the chat, not per message
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', message=r".*per_message=False", category=PTBUserWarning)
+        conv_handler = ConversationHandler(
+            entry_points=[
+                MessageHandler(TEXT_MESSAGES, handle_message),
+                CallbackQueryHandler(handle_item_button, pattern=item_pattern),
+            ],
+            states={
+                WAITING_FOR_PRICE: [MessageHandler(TEXT_MESSAGES, handle_price)],
+                WAITING_FOR_NAME: [MessageHandler(TEXT_MESSAGES, handle_name)],
+                WAITING_FOR_REMOVE: [MessageHandler(TEXT_MESSAGES, handle_remove)],
+                WAITING_FOR_EDIT_ITEM: [MessageHandler(TEXT_MESSAGES, handle_edit_item)],
+                WAITING_FOR_NEW_LINK: [MessageHandler(TEXT_MESSAGES, handle_new_link)],
+            },
+            # Item buttons of an older list message work from any state; a handler instance of
+            # its own, so the callback is instrumented once per position
+            fallbacks=[
+                CommandHandler("cancel", cancel),
+                CallbackQueryHandler(handle_item_button, pattern=item_pattern),
+            ],
+            name="basket_flow",
+            persistent=True,
+        )
+
+    # Add handlers
+    if election is not None:
+        add_handler(TypeHandler(Update, sync_shared_state), group=-1)
+    add_handler(CommandHandler("start", start))
+    add_handler(CommandHandler("menu", menu))
+    add_handler(CommandHandler("myid", myid))
+    add_handler(CommandHandler("budget", budget_status))
+    add_handler(CommandHandler("budget_by_user", budget_by_user))
+    add_handler(CommandHandler("reset", reset_budget))
+    add_handler(CommandHandler("export", export_basket))
+    add_handler(CommandHandler("testreminder", test_reminder))
+    add_handler(CommandHandler("jobs", list_jobs))
+    add_handler(CommandHandler("setreminder", set_reminder))
+    add_handler(CommandHandler("setdeadline", set_deadline))
+    add_handler(CommandHandler("newcampaign", new_campaign))
+    add_handler(CommandHandler("stats", stats))
+    add_handler(CallbackQueryHandler(handle_page, pattern=f"^{PAGE_CALLBACK_PREFIX}:"))
+    add_handler(conv_handler)
+    return application
 
 
 def main() -> None:
     """Start the bot."""
     if not BOT_TOKEN:
-        print("Error: BOT_TOKEN not found in environment variables!")
-        print("Please create a .env file with your BOT_TOKEN")
+        logger.error("Error: BOT_TOKEN not found in environment variables!")
+        logger.error("Please create a .env file with your BOT_TOKEN")
         return
 
-    # Create application
-    application = Application.builder().token(BOT_TOKEN).build()
-    
-    # Set up deadline notification using bot's job queue
-    job_queue = application.job_queue
-    if job_queue:
-        now = datetime.now(MOSCOW_TZ)
-        if DEADLINE_DATETIME > now:
-            # Schedule the deadline notification
-            job_queue.run_once(
-                notify_all_users_deadline_job,
-                when=DEADLINE_DATETIME,
-                name="deadline_notification"
-            )
-            print(f"Deadline notification scheduled for {DEADLINE_DATETIME}", flush=True)
-            
-            # Schedule daily reminder at 12:00 Moscow time
-            from datetime import time as dt_time
-            reminder_time = dt_time(hour=12, minute=0, second=0, tzinfo=MOSCOW_TZ)
-            job_queue.run_daily(
-                send_daily_reminder,
-                time=reminder_time,
-                name="daily_reminder"
-            )
-            print(f"Daily reminder scheduled for 12:00 Moscow time", flush=True)
-        else:
-            print("Deadline has already passed", flush=True)
+    if (WORKER_URLS or WORKER_PORT) and not os.getenv('WEBHOOK_SECRET'):
+        logger.error("Error: WEBHOOK_SECRET must be set when running as a router or worker")
+        return
+    if WORKER_URLS and not WEBHOOK_URL:
+        logger.error("Error: the router needs WEBHOOK_URL to register the webhook")
+        return
 
-    # Conversation handler for link -> price -> name flow, remove flow, and edit flow
-    conv_handler = ConversationHandler(
-        entry_points=[MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message)],
-        states={
-            WAITING_FOR_PRICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_price)],
-            WAITING_FOR_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_name)],
-            WAITING_FOR_REMOVE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_remove)],
-            WAITING_FOR_EDIT_ITEM: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_edit_item)],
-            WAITING_FOR_NEW_LINK: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_new_link)],
-        },
-        fallbacks=[CommandHandler("cancel", cancel)],
+    # Create application
+    bot = PollingBot(
+        BOT_TOKEN,
+        base_url=f"{BOT_API_URL}/bot",
+        base_file_url=f"{BOT_API_URL}/file/bot",
+        # Count calls, bytes and latency of every Bot API method
+        request=InstrumentedRequest(transport.split_request(HTTP_POOL_SIZE, HTTP_TIMEOUT, MEDIA_POOL_SIZE, MEDIA_TIMEOUT)),
+        get_updates_request=InstrumentedRequest(HTTPXRequest()),
+        poll_limit=POLL_LIMIT,
     )
+    application = build_application(Application.builder().bot(bot))
+    # Subscribe only to the update types some handler consumes (the router for its workers too)
+    allowed_updates = transport.allowed_updates(application)
 
-    # Add handlers
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("menu", menu))
-    application.add_handler(CommandHandler("myid", myid))
-    application.add_handler(CommandHandler("budget", budget_status))
-    application.add_handler(CommandHandler("reset", reset_budget))
-    application.add_handler(CommandHandler("testreminder", test_reminder))
-    application.add_handler(conv_handler)
+    if WORKER_URLS:
+        # The router only forwards updates; handlers and jobs run in the workers
+        asyncio.run(serve_router(
+            Bot(BOT_TOKEN, base_url=f"{BOT_API_URL}/bot", base_file_url=f"{BOT_API_URL}/file/bot"),
+            WORKER_URLS,
+            url=WEBHOOK_URL,
+            host=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            path=WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=allowed_updates
+        ))
+        return
 
     # Start the bot
-    print("Bot is starting...", flush=True)
-    print("Send /start to your bot in Telegram!", flush=True)
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    logger.info("Bot is starting...")
+    logger.info("Send /start to your bot in Telegram!")
+    if WORKER_PORT:
+        asyncio.run(serve_webhook(
+            application,
+            url=None,
+            host=WORKER_LISTEN,
+            port=int(WORKER_PORT),
+            path=WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET
+        ))
+    elif WEBHOOK_URL:
+        asyncio.run(serve_webhook(
+            application,
+            url=WEBHOOK_URL,
+            host=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            path=WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=allowed_updates
+        ))
+    else:
+        # Long polling fallback
+        application.run_polling(timeout=POLL_TIMEOUT, allowed_updates=allowed_updates)
 
 
 if __name__ == '__main__':
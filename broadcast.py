@@ -0,0 +1,214 @@
+import logging
+import time
+import asyncio
+from dataclasses import dataclass
+from telegram.error import BadRequest, Forbidden, RetryAfter, TimedOut, NetworkError
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows about 30 messages per second overall and 1 per second to the same chat
+GLOBAL_RATE = 25
+PER_CHAT_INTERVAL = 1.0
+MAX_CONCURRENCY = 20
+MAX_RETRIES = 3
+BACKOFF_BASE = 0.5
+# Delivered chats are written to the journal in batches: at most this many, or this often
+CHECKPOINT_BATCH = 200
+CHECKPOINT_INTERVAL = 1.0
+
+
+def is_unreachable(error):
+    """True for errors meaning the chat will not accept messages from the bot again."""
+    if isinstance(error, Forbidden):
+        return True
+    return isinstance(error, BadRequest) and 'chat not found' in error.message.lower()
+
+
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, bursts up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Stop handing out tokens for `seconds` (used for Telegram flood waits)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+@dataclass
+class BroadcastResult:
+    name: str
+    sent: int = 0
+    failed: int = 0
+    retried: int = 0
+    skipped: int = 0  # Already delivered before a restart
+    pruned: int = 0  # Blocked the bot or no longer exist
+    duration: float = 0.0
+
+    def __str__(self):
+        return (f"{self.name}: sent={self.sent} failed={self.failed} retried={self.retried} "
+                f"skipped={self.skipped} pruned={self.pruned} in {self.duration:.2f}s")
+
+
+class Checkpoint:
+    """Batches delivered chat IDs of one broadcast into the journal."""
+
+    def __init__(self, journal, broadcast_id):
+        self.journal = journal
+        self.broadcast_id = broadcast_id
+        self.pending = []
+        self.flushed_at = time.monotonic()
+
+    def add(self, chat_id):
+        self.pending.append(chat_id)
+        if len(self.pending) >= CHECKPOINT_BATCH or time.monotonic() - self.flushed_at >= CHECKPOINT_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.journal.record_deliveries(self.broadcast_id, self.pending)
+            self.pending = []
+        self.flushed_at = time.monotonic()
+
+
+class Broadcaster:
+    """Fans a message out to many chats with bounded concurrency and Telegram rate limits.
+
+    With a `journal` (Storage), broadcasts given a broadcast_id checkpoint every delivered
+    chat and resume from there when started again with the same ID.
+    """
+
+    def __init__(self, max_concurrency=MAX_CONCURRENCY, global_rate=GLOBAL_RATE,
+                 per_chat_interval=PER_CHAT_INTERVAL, max_retries=MAX_RETRIES, journal=None):
+        self.journal = journal
+        self.max_concurrency = max_concurrency
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(global_rate)
+        self._chat_last_sent = {}
+
+    async def _throttle(self, chat_id):
+        wait = self._chat_last_sent.get(chat_id, 0.0) + self.per_chat_interval - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        await self.bucket.acquire()
+        self._chat_last_sent[chat_id] = time.monotonic()
+
+    async def _attempt(self, chat_id, send, result):
+        """Run `send(chat_id)` honouring RetryAfter and retrying transient errors with backoff."""
+        for attempt in range(self.max_retries + 1):
+            await self._throttle(chat_id)
+            try:
+                await send(chat_id)
+                return
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+                self.bucket.pause(retry_after)
+            except BadRequest:
+                raise
+            except (TimedOut, NetworkError):
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(BACKOFF_BASE * 2 ** attempt)
+            result.retried += 1
+
+    async def _deliver(self, chat_id, send, fallback, result, on_unreachable):
+        """Send to one chat, trying `fallback` after `send` fails; returns True if delivered."""
+        for attempt_send, label in ((send, ''), (fallback, ' fallback')):
+            if attempt_send is None:
+                break
+            try:
+                await self._attempt(chat_id, attempt_send, result)
+                result.sent += 1
+                return True
+            except Exception as e:
+                if is_unreachable(e):
+                    # No point in a fallback or in ever messaging this chat again
+                    result.pruned += 1
+                    if on_unreachable is not None:
+                        on_unreachable(chat_id)
+                    return False
+                logger.warning(
+                    "Error sending %s%s to %s: %s", result.name, label, chat_id, e,
+                    extra={'event': 'broadcast_error', 'chat_id': chat_id, 'broadcast': result.name},
+                )
+        result.failed += 1
+        return False
+
+    async def broadcast(self, name, recipients, send, fallback=None, broadcast_id=None, on_unreachable=None):
+        """Deliver to every chat in `recipients`.
+
+        `send` and the optional `fallback` are coroutines taking a chat_id; the fallback runs
+        once `send` has failed for a chat. `on_unreachable(chat_id)` is called for chats that
+        blocked the bot or no longer exist. A `broadcast_id` makes the broadcast resumable:
+        chats that already got it are skipped, and a finished one is not repeated.
+        """
+        result = BroadcastResult(name)
+        started = time.monotonic()
+        recipients = list(recipients)
+        checkpoint = None
+        if broadcast_id is not None and self.journal is not None:
+            finished, delivered = self.journal.start_broadcast(broadcast_id)
+            if finished:
+                logger.info("Broadcast %s already finished", broadcast_id, extra={'broadcast': name})
+                delivered = set(recipients)
+            elif delivered:
+                logger.info(
+                    "Resuming broadcast %s: %d chats already done", broadcast_id, len(delivered), extra={'broadcast': name}
+                )
+            if delivered:
+                before = len(recipients)
+                recipients = [chat_id for chat_id in recipients if chat_id not in delivered]
+                result.skipped = before - len(recipients)
+            if not finished:
+                checkpoint = Checkpoint(self.journal, broadcast_id)
+        queue = iter(recipients)
+
+        async def worker():
+            for chat_id in queue:
+                if await self._deliver(chat_id, send, fallback, result, on_unreachable) and checkpoint:
+                    checkpoint.add(chat_id)
+
+        workers = min(self.max_concurrency, max(1, len(recipients)))
+        try:
+            await asyncio.gather(*(worker() for _ in range(workers)))
+        finally:
+            if checkpoint is not None:
+                checkpoint.flush()
+        if checkpoint is not None:
+            self.journal.finish_broadcast(broadcast_id)
+
+        # Forget chats whose per-chat interval has already elapsed
+        cutoff = time.monotonic() - self.per_chat_interval
+        self._chat_last_sent = {chat: ts for chat, ts in self._chat_last_sent.items() if ts > cutoff}
+
+        result.duration = time.monotonic() - started
+        logger.info("Broadcast %s", result, extra={'broadcast': name, 'latency_ms': round(result.duration * 1000)})
+        kind = (('broadcast', name.split(':', 1)[0]),)
+        metrics.observe('bot_broadcast_duration_seconds', result.duration, kind)
+        for outcome in ('sent', 'failed', 'retried', 'skipped', 'pruned'):
+            metrics.inc('bot_broadcast_messages_total', kind + (('outcome', outcome),), getattr(result, outcome))
+        return result
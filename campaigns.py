@@ -0,0 +1,174 @@
+import re
+import time
+import asyncio
+from datetime import datetime
+from storage import Basket, CHATS_SCOPE
+from views import BasketView
+from aggregates import BasketStats
+
+DEFAULT_CAMPAIGN_ID = 'default'
+CAMPAIGN_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')  # Telegram deep-link payload alphabet
+RESERVATION_TTL = 30 * 60  # Seconds an abandoned add flow keeps its price reserved
+
+
+class Campaign:
+    """One gift campaign: its own budget, deadline, admin, basket and lock."""
+
+    def __init__(self, campaign_id, title, budget_limit, deadline, admin_id, basket):
+        self.id = campaign_id
+        self.title = title
+        self.budget_limit = budget_limit
+        self.deadline = deadline
+        self.admin_id = admin_id
+        self.basket = basket
+        self.view = BasketView(basket)
+        self.stats = BasketStats(basket)
+        # Serializes basket mutations of this campaign only; other campaigns never wait on it
+        self.lock = asyncio.Lock()
+        self._deadline_passed = False
+        self._reservations = {}  # user_id -> (amount, monotonic expiry)
+
+    def is_admin(self, user_id):
+        return user_id == self.admin_id
+
+    def is_deadline_passed(self, now=None):
+        """Check if deadline has passed."""
+        if not self._deadline_passed:
+            now = now or datetime.now(self.deadline.tzinfo)
+            if now >= self.deadline:
+                self._deadline_passed = True
+        return self._deadline_passed
+
+    def mark_deadline_passed(self):
+        self._deadline_passed = True
+
+    @property
+    def reserved(self):
+        now = time.monotonic()
+        expired = [user_id for user_id, (_, expires) in self._reservations.items() if expires <= now]
+        for user_id in expired:
+            del self._reservations[user_id]
+        return sum(amount for amount, _ in self._reservations.values())
+
+    @property
+    def remaining(self):
+        """Budget left for new items, prices reserved by unfinished add flows excluded."""
+        return self.budget_limit - self.basket.spent - self.reserved
+
+    def reserve(self, user_id, amount):
+        """Hold `amount` of the budget for the user's item until claim() or release().
+
+        Replaces an earlier reservation of the same user; returns False if the budget is short.
+        """
+        self.release(user_id)
+        if amount > self.remaining:
+            return False
+        self._reservations[user_id] = (amount, time.monotonic() + RESERVATION_TTL)
+        return True
+
+    def release(self, user_id):
+        self._reservations.pop(user_id, None)
+
+    def claim(self, user_id, amount):
+        """Turn the user's reservation into spending; re-checks the budget if it has expired.
+
+        The caller adds the item right away, before anything else can touch the budget.
+        """
+        self.release(user_id)
+        return amount <= self.remaining
+
+
+class CampaignRegistry:
+    """All campaigns hosted by the bot, sharded by campaign ID, plus chat -> campaign routing."""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self._campaigns = {}
+        self._chats = {}
+        self.load()
+
+    def load(self):
+        baskets = self.storage.load_baskets()
+        self._campaigns = {}
+        for campaign_id, title, budget_limit, deadline, admin_id in self.storage.load_campaigns():
+            items, users = baskets.get(campaign_id, ((), ()))
+            basket = Basket(self.storage, campaign_id, items, users)
+            self._campaigns[campaign_id] = Campaign(
+                campaign_id, title, budget_limit, datetime.fromisoformat(deadline), admin_id, basket
+            )
+        self._chats = self.storage.load_chats()
+
+    def refresh(self, changed):
+        """Re-read what another worker changed, given `changed` revision scopes (see Storage).
+
+        Only the campaigns named in `changed` are reloaded; their objects (locks, reservations,
+        views and stats) are kept, and new campaigns appear.
+        """
+        for scope in changed:
+            kind, _, campaign_id = scope.partition(':')
+            if kind == 'campaign':
+                self._reload(campaign_id)
+            elif kind == 'participants' and campaign_id in self._campaigns:
+                self._campaigns[campaign_id].basket.reload_users(self.storage.load_participants(campaign_id))
+        if CHATS_SCOPE in changed:
+            self._chats = self.storage.load_chats()
+
+    def _reload(self, campaign_id):
+        row = self.storage.load_campaign(campaign_id)
+        if row is None:
+            return
+        _, title, budget_limit, deadline, admin_id = row
+        items = list(self.storage.iter_items(campaign_id))
+        users = self.storage.load_participants(campaign_id)
+        deadline = datetime.fromisoformat(deadline)
+        campaign = self._campaigns.get(campaign_id)
+        if campaign is None:
+            basket = Basket(self.storage, campaign_id, items, users)
+            self._campaigns[campaign_id] = Campaign(campaign_id, title, budget_limit, deadline, admin_id, basket)
+            return
+        campaign.title = title
+        campaign.budget_limit = budget_limit
+        if deadline != campaign.deadline:
+            campaign.deadline = deadline
+            campaign._deadline_passed = False
+        campaign.basket.reload(items, users)
+
+    def __iter__(self):
+        return iter(list(self._campaigns.values()))
+
+    def __len__(self):
+        return len(self._campaigns)
+
+    def get(self, campaign_id):
+        return self._campaigns.get(campaign_id)
+
+    def create(self, campaign_id, title, budget_limit, deadline, admin_id):
+        if not CAMPAIGN_ID_PATTERN.match(campaign_id):
+            raise ValueError(f"Invalid campaign id: {campaign_id!r}")
+        if campaign_id in self._campaigns:
+            raise ValueError(f"Campaign {campaign_id!r} already exists")
+        self.storage.insert_campaign(campaign_id, title, budget_limit, deadline, admin_id)
+        campaign = Campaign(campaign_id, title, budget_limit, deadline, admin_id, Basket(self.storage, campaign_id))
+        self._campaigns[campaign_id] = campaign
+        return campaign
+
+    def ensure(self, campaign_id, title, budget_limit, deadline, admin_id):
+        """Return campaign `campaign_id`, creating it with the given settings on first run."""
+        return self.get(campaign_id) or self.create(campaign_id, title, budget_limit, deadline, admin_id)
+
+    def for_chat(self, chat_id):
+        """Route a chat to its campaign; chats that never joined one use the default campaign."""
+        campaign = self._campaigns.get(self._chats.get(chat_id, DEFAULT_CAMPAIGN_ID))
+        return campaign or self._campaigns[DEFAULT_CAMPAIGN_ID]
+
+    def set_deadline(self, campaign_id, deadline):
+        campaign = self._campaigns[campaign_id]
+        self.storage.update_campaign_deadline(campaign_id, deadline)
+        campaign.deadline = deadline
+        campaign._deadline_passed = False
+
+    def bind_chat(self, chat_id, campaign_id):
+        if self._chats.get(chat_id) == campaign_id:
+            return
+        self.storage.bind_chat(chat_id, campaign_id)
+        self._chats[chat_id] = campaign_id
@@ -0,0 +1,61 @@
+import logging
+import os
+import socket
+
+logger = logging.getLogger(__name__)
+
+LEASE_NAME = 'scheduler'
+LEASE_TTL = 30  # Seconds a dead leader keeps the lease before another worker takes over
+
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class LeaderElection:
+    """Lease-based leader election between worker processes sharing one database.
+
+    Every worker calls tick() about three times per `ttl`; the holder renews the lease, the
+    others take it over once it has expired. `on_elected` is called when this worker becomes
+    the leader, `on_tick` before every attempt (used to pick up other workers' writes).
+    """
+
+    def __init__(self, storage, holder=None, name=LEASE_NAME, ttl=LEASE_TTL, on_elected=None, on_tick=None):
+        self.storage = storage
+        self.holder = holder or worker_id()
+        self.name = name
+        self.ttl = ttl
+        self.on_elected = on_elected
+        self.on_tick = on_tick
+        self.leader = False
+
+    @property
+    def interval(self):
+        return self.ttl / 3
+
+    def is_leader(self):
+        return self.leader
+
+    async def tick(self, context=None):
+        if self.on_tick is not None:
+            self.on_tick()
+        try:
+            leader = self.storage.acquire_lease(self.name, self.holder, self.ttl)
+        except Exception as e:
+            # Unable to renew: step down rather than risk two leaders
+            logger.error("Lease %s renewal failed: %s", self.name, e)
+            leader = False
+        if leader == self.leader:
+            return
+        self.leader = leader
+        if leader:
+            logger.info("Worker %s is now the leader", self.holder)
+            if self.on_elected is not None:
+                self.on_elected()
+        else:
+            logger.warning("Worker %s lost the leadership", self.holder)
+
+    def release(self):
+        if self.leader:
+            self.storage.release_lease(self.name, self.holder)
+            self.leader = False
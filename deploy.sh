@@ -20,7 +20,8 @@ mkdir -p /home/birthdaybot/bot
 mkdir -p /home/birthdaybot/logs
 
 # Copy files
-cp birthday_bot.py /home/birthdaybot/bot/
+cp *.py /home/birthdaybot/bot/
+cp -r static /home/birthdaybot/bot/
 cp requirements.txt /home/birthdaybot/bot/
 cp sample_env.txt /home/birthdaybot/bot/.env
 
@@ -0,0 +1,32 @@
+import io
+import csv
+import json
+import tempfile
+
+EXPORT_FORMATS = ('csv', 'jsonl')
+EXPORT_FIELDS = ('id', 'user_id', 'username', 'name', 'link', 'link_key', 'price', 'created_at', 'updated_at')
+# Exports stay in memory up to this size and spill to a temporary file beyond it
+SPOOL_MAX_SIZE = 1024 * 1024
+
+
+def export_rows(rows, export_format):
+    """Write `rows` (dicts with EXPORT_FIELDS) one by one to a spooled file, rewound for reading.
+
+    JSONL uses the json.dumps defaults, one object per line, the same layout as requests.jsonl.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {export_format!r}")
+    spooled = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    text = io.TextIOWrapper(spooled, encoding='utf-8', newline='' if export_format == 'csv' else '\n')
+    if export_format == 'csv':
+        writer = csv.DictWriter(text, fieldnames=EXPORT_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+    else:
+        for row in rows:
+            text.write(json.dumps({field: row[field] for field in EXPORT_FIELDS}) + '\n')
+    text.flush()
+    text.detach()  # Hand the binary file back without closing it
+    spooled.seek(0)
+    return spooled
@@ -0,0 +1,160 @@
+"""Shrink the GIFs of static/ to a byte and dimension budget, offline.
+
+Variants are cached under <cache dir>/<budget>/<sha256 of the original>.gif, so reruns only
+process new or changed files. MediaRegistry sends a variant instead of the original when it
+is smaller.
+
+    python gif_optimizer.py --max-bytes 1048576 --max-side 480
+
+Needs Pillow (pip install Pillow); the bot itself runs without it.
+"""
+import logging
+import io
+import os
+import sys
+import hashlib
+import argparse
+
+logger = logging.getLogger(__name__)
+
+try:
+    from PIL import Image, ImageSequence
+except ImportError:  # Optional: without Pillow the bot sends the original files
+    Image = None
+
+DEFAULT_MAX_BYTES = 1024 * 1024
+DEFAULT_MAX_SIDE = 480
+MIN_SIDE = 120  # Never shrink below this, an unreadable meme is worse than a slow one
+MAX_FRAME_STEP = 4  # Keep at least every 4th frame
+SCALE_STEP = 0.85
+
+
+def available():
+    return Image is not None
+
+
+def budget_dir(cache_dir, max_bytes, max_side):
+    """Directory holding the variants produced for one budget."""
+    return os.path.join(cache_dir, f"{max_side}px_{max_bytes // 1024}k")
+
+
+def _load_frames(data):
+    with Image.open(io.BytesIO(data)) as image:
+        default_duration = image.info.get('duration', 100)
+        loop = image.info.get('loop', 0)
+        frames = []
+        for frame in ImageSequence.Iterator(image):
+            frames.append((frame.convert('RGBA'), frame.info.get('duration', default_duration)))
+    return frames, loop
+
+
+def _encode(frames, loop, scale, step):
+    """Encode every `step`-th frame scaled by `scale`; dropped frames add their time to the kept one."""
+    kept = []
+    for index, (frame, duration) in enumerate(frames):
+        if index % step == 0:
+            kept.append([frame, duration])
+        else:
+            kept[-1][1] += duration
+    width, height = kept[0][0].size
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    images = [frame if scale == 1 else frame.resize(size, Image.LANCZOS) for frame, _ in kept]
+    buffer = io.BytesIO()
+    images[0].save(
+        buffer, 'GIF', save_all=True, append_images=images[1:], duration=[duration for _, duration in kept],
+        loop=loop, optimize=True, disposal=2,
+    )
+    return buffer.getvalue()
+
+
+def optimize(data, max_bytes=DEFAULT_MAX_BYTES, max_side=DEFAULT_MAX_SIDE):
+    """Return the smallest encoding of GIF `data` tried on the way to fitting the budget.
+
+    Downscales to `max_side` first, then alternately drops frames and shrinks further
+    until the result fits `max_bytes` or the quality floor is reached.
+    """
+    frames, loop = _load_frames(data)
+    width, height = frames[0][0].size
+    scale = min(1.0, max_side / max(width, height))
+    step = 1
+    shrink_next = False
+    best = None
+    while True:
+        encoded = _encode(frames, loop, scale, step)
+        if best is None or len(encoded) < len(best):
+            best = encoded
+        if len(best) <= max_bytes:
+            return best
+        can_shrink = min(width, height) * scale * SCALE_STEP >= MIN_SIDE
+        can_drop = step < MAX_FRAME_STEP
+        if can_shrink and (shrink_next or not can_drop):
+            scale *= SCALE_STEP
+        elif can_drop:
+            step += 1
+        else:
+            return best
+        shrink_next = not shrink_next
+
+
+def optimize_directory(source_dir, cache_dir, max_bytes=DEFAULT_MAX_BYTES, max_side=DEFAULT_MAX_SIDE):
+    """Produce missing variants for every GIF of `source_dir`.
+
+    Returns report rows (name, original bytes, variant bytes, cached) for every GIF.
+    """
+    target_dir = budget_dir(cache_dir, max_bytes, max_side)
+    os.makedirs(target_dir, exist_ok=True)
+    report = []
+    for name in sorted(os.listdir(source_dir)):
+        if not name.lower().endswith('.gif'):
+            continue
+        with open(os.path.join(source_dir, name), 'rb') as f:
+            data = f.read()
+        variant_path = os.path.join(target_dir, f"{hashlib.sha256(data).hexdigest()}.gif")
+        if os.path.exists(variant_path):
+            report.append((name, len(data), os.path.getsize(variant_path), True))
+            continue
+        try:
+            variant = optimize(data, max_bytes, max_side)
+        except Exception as e:
+            logger.error("Error optimizing %s: %s", name, e)
+            continue
+        # A variant is kept even when larger so the file is not re-encoded on every run;
+        # MediaRegistry only sends it when it is actually smaller
+        tmp_path = f"{variant_path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(variant)
+        os.replace(tmp_path, variant_path)
+        report.append((name, len(data), len(variant), False))
+    return report
+
+
+def format_report(report):
+    lines = [f"{'file':20} {'original':>10} {'sent':>10} {'saved':>10}"]
+    total_original = total_sent = 0
+    for name, original, variant, cached in report:
+        sent = min(original, variant)
+        total_original += original
+        total_sent += sent
+        note = ' (cached)' if cached else ''
+        lines.append(f"{name:20} {original:>10} {sent:>10} {original - sent:>10}{note}")
+    lines.append(f"{'total':20} {total_original:>10} {total_sent:>10} {total_original - total_sent:>10}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    default_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+    parser.add_argument('--source', default=default_dir, help='directory with the original GIFs')
+    parser.add_argument('--cache-dir', default=os.path.join(default_dir, '.optimized'))
+    parser.add_argument('--max-bytes', type=int, default=DEFAULT_MAX_BYTES)
+    parser.add_argument('--max-side', type=int, default=DEFAULT_MAX_SIDE)
+    args = parser.parse_args()
+    if not available():
+        print("Pillow is not installed: pip install Pillow", flush=True)
+        sys.exit(1)
+    report = optimize_directory(args.source, args.cache_dir, args.max_bytes, args.max_side)
+    print(format_report(report), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+import logging
+import json
+import asyncio
+from dataclasses import dataclass, field
+from urllib.parse import urlsplit, parse_qsl
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_SIZE = 1024 * 1024  # Telegram updates are far smaller than this
+HEADER_TIMEOUT = 30
+
+REASONS = {
+    200: 'OK', 204: 'No Content', 400: 'Bad Request', 401: 'Unauthorized', 403: 'Forbidden',
+    404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large', 429: 'Too Many Requests',
+    500: 'Internal Server Error', 503: 'Service Unavailable',
+}
+
+
+@dataclass
+class Request:
+    method: str
+    path: str
+    query: dict
+    headers: dict  # lower-cased names
+    body: bytes = b''
+    params: dict = field(default_factory=dict)  # filled for prefix routes
+
+    def json(self):
+        return json.loads(self.body or b'{}')
+
+
+def text_response(status, text, content_type='text/plain; charset=utf-8'):
+    return status, content_type, text.encode('utf-8')
+
+
+def json_response(payload, status=200):
+    return status, 'application/json', json.dumps(payload, ensure_ascii=False).encode('utf-8')
+
+
+class HttpServer:
+    """Tiny asyncio HTTP/1.1 server with keep-alive, enough for webhooks and local endpoints.
+
+    Handlers are coroutines `handler(request) -> (status, content_type, body)`. Each connection
+    runs in its own task, so slow requests never block the others.
+    """
+
+    def __init__(self, host, port, reuse_port=False, max_body_size=MAX_BODY_SIZE):
+        self.host = host
+        self.port = port
+        self.reuse_port = reuse_port
+        self.max_body_size = max_body_size
+        self._routes = {}
+        self._prefix_routes = []
+        self._server = None
+
+    def add_route(self, method, path, handler):
+        self._routes[(method, path)] = handler
+
+    def add_prefix_route(self, method, prefix, handler):
+        """Route every path starting with `prefix`; the remainder is passed as request.params['tail']."""
+        self._prefix_routes.append((method, prefix, handler))
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._handle_connection, self.host, self.port, reuse_port=self.reuse_port or None
+        )
+        # Port 0 asks the OS for a free port; report the real one
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    def _resolve(self, method, path):
+        handler = self._routes.get((method, path))
+        if handler is not None:
+            return handler, {}
+        for route_method, prefix, prefix_handler in self._prefix_routes:
+            if route_method == method and path.startswith(prefix):
+                return prefix_handler, {'tail': path[len(prefix):]}
+        if any(route_path == path for _, route_path in self._routes):
+            return None, {'status': 405}
+        return None, {'status': 404}
+
+    async def _read_request(self, reader):
+        request_line = await asyncio.wait_for(reader.readline(), HEADER_TIMEOUT)
+        if not request_line:
+            return None
+        method, target, version = request_line.decode('latin-1').split()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', 0))
+        if length > self.max_body_size:
+            raise OverflowError(length)
+        body = await reader.readexactly(length) if length else b''
+        parts = urlsplit(target)
+        request = Request(method, parts.path, dict(parse_qsl(parts.query)), headers, body)
+        return request, version
+
+    async def _dispatch(self, request):
+        handler, params = self._resolve(request.method, request.path)
+        if handler is None:
+            return text_response(params['status'], REASONS[params['status']])
+        request.params = params
+        try:
+            return await handler(request)
+        except Exception as e:
+            logger.exception("Error handling %s %s: %s", request.method, request.path, e)
+            return text_response(500, REASONS[500])
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    parsed = await self._read_request(reader)
+                except OverflowError:
+                    self._write(writer, *text_response(413, REASONS[413]), keep_alive=False)
+                    break
+                if parsed is None:
+                    break
+                request, version = parsed
+                status, content_type, body = await self._dispatch(request)
+                keep_alive = version == 'HTTP/1.1' and request.headers.get('connection', '').lower() != 'close'
+                self._write(writer, status, content_type, body, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _write(writer, status, content_type, body, keep_alive):
+        head = (
+            f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode('latin-1') + body)
@@ -0,0 +1,74 @@
+import re
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+# Query parameters that only track where a click came from (referral and click ids) and never
+# change the product. Variant or destination selectors (sku_id, targetUrl, ...) must not be here:
+# stripping them would make different variants of one product look like duplicates.
+TRACKING_PARAMS = frozenset({
+    'fbclid', 'gclid', 'yclid', 'ysclid', 'msclkid', 'ref', 'referrer', 'from', 'source',
+    'sh', 'asb', 'asb2', 'keywords', 'avtc', 'avte', 'avts', 'abt_att', 'oos_search', 'miniapp',
+    'spm', 'scm', 'pvid', 'algo_pvid', 'share', 'share_id', '_bctx',
+})
+TRACKING_PREFIXES = ('utm_', '_openstat', 'ab_')
+
+# Marketplace rules: host suffix -> (key prefix, regexes extracting the product id from the path)
+MARKETPLACE_RULES = (
+    ('ozon.ru', 'ozon', (
+        re.compile(r'/product/(?:[^/]*-)?(\d+)(?:/|$)'),
+        re.compile(r'/context/detail/id/(\d+)'),
+    )),
+    ('wildberries.ru', 'wb', (
+        re.compile(r'/catalog/(\d+)(?:/|$)'),
+    )),
+    ('wb.ru', 'wb', (
+        re.compile(r'/catalog/(\d+)(?:/|$)'),
+    )),
+    ('market.yandex.ru', 'ymarket', (
+        re.compile(r'/(?:product|card)(?:--[^/]*)?/(?:[^/]+/)?(\d+)(?:/|$)'),
+    )),
+    ('aliexpress.ru', 'ali', (
+        re.compile(r'/item/(\d+)\.html'),
+    )),
+    ('aliexpress.com', 'ali', (
+        re.compile(r'/item/(\d+)\.html'),
+    )),
+)
+
+HOST_PREFIXES = ('www.', 'm.', 'mobile.')
+
+
+def _normalize_host(netloc):
+    host = netloc.lower().rsplit('@', 1)[-1].split(':', 1)[0].rstrip('.')
+    for prefix in HOST_PREFIXES:
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    return host
+
+
+def _is_tracking(param):
+    return param in TRACKING_PARAMS or param.startswith(TRACKING_PREFIXES)
+
+
+def canonical_key(url):
+    """Return a key that is equal for links pointing to the same product.
+
+    Marketplace links collapse to `<marketplace>:<product id>`; other links drop the scheme,
+    `www.`, trailing slashes, fragments and tracking parameters.
+    """
+    parts = urlsplit(url.strip())
+    host = _normalize_host(parts.netloc)
+    path = re.sub(r'/{2,}', '/', parts.path).rstrip('/')
+
+    for suffix, prefix, patterns in MARKETPLACE_RULES:
+        if host == suffix or host.endswith('.' + suffix):
+            for pattern in patterns:
+                match = pattern.search(path + '/')
+                if match:
+                    return f"{prefix}:{match.group(1)}"
+            break
+
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if not _is_tracking(k))
+    key = host + path
+    if query:
+        key += '?' + urlencode(query)
+    return key
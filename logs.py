@@ -0,0 +1,119 @@
+import os
+import sys
+import json
+import queue
+import atexit
+import logging
+import itertools
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOG_FILE = 'bot.log'
+MAX_BYTES = 10 * 1024 * 1024
+BACKUP_COUNT = 5
+# Structured fields copied from `extra` into every JSON record that has them
+FIELDS = ('event', 'user_id', 'chat_id', 'campaign', 'handler', 'state', 'latency_ms', 'broadcast', 'sampled')
+# High-volume events: keep one record in N (per event name)
+SAMPLE_RATES = {'handler': 100, 'broadcast_error': 10}
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message and the structured FIELDS."""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Let through every Nth record of each sampled event; the kept ones carry `sampled=N`.
+
+    Warnings and errors of a sampled event are sampled too: a broadcast to a thousand blocked
+    chats should not write a thousand lines. Records without an `event` always pass.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self._counters = {event: itertools.count() for event in rates}
+
+    def filter(self, record):
+        event = getattr(record, 'event', None)
+        rate = self.rates.get(event, 1)
+        if rate <= 1:
+            return True
+        if next(self._counters[event]) % rate:
+            return False
+        record.sampled = rate
+        return True
+
+
+def parse_rates(text, defaults=SAMPLE_RATES):
+    """Parse "event=N,..." overrides on top of `defaults`."""
+    rates = dict(defaults)
+    for override in filter(None, text.split(',')):
+        event, rate = override.split('=')
+        rates[event.strip()] = int(rate)
+    return rates
+
+
+def setup(log_dir=None, level='INFO', max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT, sample_rates=SAMPLE_RATES):
+    """Route all logging through a queue to a background writer thread.
+
+    The event loop never waits on a write: records are put on an in-memory queue and the
+    listener thread writes them as JSON lines to stdout and, with `log_dir`, to a size-rotated
+    `log_dir/bot.log`. Safe to call again (the previous listener is stopped).
+    """
+    global _listener
+    stop()
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+        handlers.append(RotatingFileHandler(
+            os.path.join(log_dir, LOG_FILE), maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8'
+        ))
+    formatter = JsonFormatter()
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    # Sampled records are dropped before they are queued
+    queue_handler.addFilter(SamplingFilter(sample_rates))
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    # httpx logs every Bot API request at INFO
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def stop():
+    """Flush queued records and stop the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+atexit.register(stop)
@@ -0,0 +1,226 @@
+import logging
+import os
+import mmap
+import json
+import random
+import asyncio
+import hashlib
+from telegram import InputFile
+from telegram.error import BadRequest
+
+logger = logging.getLogger(__name__)
+
+# Files at least this large are memory-mapped instead of copied into the heap
+MMAP_THRESHOLD = 1024 * 1024
+
+
+class MediaFile:
+    """One GIF from the static directory, held in memory (or mapped) with its content hash."""
+
+    def __init__(self, name, path, data, digest):
+        self.name = name
+        self.path = path
+        self.data = data
+        self.digest = digest
+
+    @property
+    def size(self):
+        return len(self.data)
+
+    def input_file(self):
+        # Only first uploads get here, a mapped file is copied just for the duration of the request
+        return InputFile(bytes(self.data), filename=self.name)
+
+
+class MediaRegistry:
+    """GIFs of a directory, loaded once at startup so handlers never touch the disk.
+
+    When `variant_dir` holds a smaller <sha256 of the original>.gif (see gif_optimizer),
+    that variant is sent instead of the original.
+    """
+
+    def __init__(self, directory, mmap_threshold=MMAP_THRESHOLD, variant_dir=None):
+        self.directory = directory
+        self.mmap_threshold = mmap_threshold
+        self.variant_dir = variant_dir
+        self._files = {}
+        self._mapped = []
+
+    def scan(self):
+        """Load every GIF of the directory; call once before the event loop starts."""
+        self.close()
+        files = {}
+        try:
+            names = sorted(os.listdir(self.directory))
+        except OSError as e:
+            logger.error("Error scanning media directory %s: %s", self.directory, e)
+            names = []
+        for name in names:
+            if not name.lower().endswith('.gif'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                data = self._load(path)
+                digest = hashlib.sha256(data).hexdigest()
+                path, data, digest = self._smallest_variant(path, data, digest)
+            except OSError as e:
+                logger.error("Error loading %s: %s", name, e)
+                continue
+            if isinstance(data, mmap.mmap):
+                self._mapped.append(data)
+            files[name] = MediaFile(name, path, data, digest)
+        self._files = files
+        return self
+
+    def _load(self, path):
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < self.mmap_threshold or size == 0:
+                return f.read()
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _smallest_variant(self, path, data, digest):
+        if not self.variant_dir:
+            return path, data, digest
+        variant_path = os.path.join(self.variant_dir, f"{digest}.gif")
+        if not os.path.exists(variant_path) or os.path.getsize(variant_path) >= len(data):
+            return path, data, digest
+        variant = self._load(variant_path)
+        if isinstance(data, mmap.mmap):
+            data.close()
+        return variant_path, variant, hashlib.sha256(variant).hexdigest()
+
+    def get(self, name):
+        return self._files.get(name)
+
+    def __iter__(self):
+        return iter(self._files.values())
+
+    def __len__(self):
+        return len(self._files)
+
+    def names(self, prefix=''):
+        return [name for name in self._files if name.startswith(prefix)]
+
+    def choice(self, names):
+        """Random file among `names` that actually exist, or None."""
+        available = [self._files[name] for name in names if name in self._files]
+        return random.choice(available) if available else None
+
+    def close(self):
+        for mapped in self._mapped:
+            mapped.close()
+        self._mapped = []
+        self._files = {}
+
+
+class FileIdCache:
+    """Persistent map from GIF content hash to the Telegram file_id of its first upload."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file_ids = {}
+        self._upload_locks = {}
+        self._save_lock = asyncio.Lock()
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as cache_file:
+                    self._file_ids = json.load(cache_file)
+            except (OSError, ValueError) as e:
+                logger.error("Error loading media cache %s: %s", path, e)
+
+    def get(self, digest):
+        return self._file_ids.get(digest)
+
+    async def set(self, digest, file_id):
+        if self._file_ids.get(digest) == file_id:
+            return
+        self._file_ids[digest] = file_id
+        await self._save()
+
+    async def discard(self, digest):
+        if self._file_ids.pop(digest, None) is not None:
+            await self._save()
+
+    async def _save(self):
+        # Disk writes run in the default thread pool; the lock keeps them in order
+        async with self._save_lock:
+            await asyncio.to_thread(self._write, dict(self._file_ids))
+
+    def _write(self, file_ids):
+        # Write to a temp file first so a crash never leaves a truncated cache behind
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as cache_file:
+                json.dump(file_ids, cache_file, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error("Error saving media cache %s: %s", self.path, e)
+
+    def upload_lock(self, digest):
+        """Serialize first uploads of the same file so a broadcast uploads it only once."""
+        lock = self._upload_locks.get(digest)
+        if lock is None:
+            lock = self._upload_locks[digest] = asyncio.Lock()
+        return lock
+
+
+def _sent_file_id(message):
+    """Extract file_id of the animation Telegram stored for a sent message."""
+    if message is None:
+        return None
+    # Telegram sometimes stores GIFs as documents instead of animations
+    media = message.animation or message.document
+    return media.file_id if media else None
+
+
+def _is_stale_file_id(error):
+    """True for errors meaning Telegram no longer accepts the file_id we sent."""
+    message = error.message.lower()
+    return 'wrong file identifier' in message or 'wrong remote file identifier' in message
+
+
+async def send_animation_cached(cache, send, media, **kwargs):
+    """Send a MediaFile via `send` (reply_animation / bot.send_animation), reusing the cached file_id.
+
+    Falls back to uploading the file when there is no cached id or Telegram rejects it as stale.
+    Any other BadRequest (e.g. "Chat not found") is raised with the cache left untouched.
+    """
+    digest = media.digest
+    file_id = cache.get(digest)
+    if file_id:
+        try:
+            return await send(animation=file_id, **kwargs)
+        except BadRequest as e:
+            if not _is_stale_file_id(e):
+                raise
+            logger.warning("Cached file_id for %s rejected (%s), re-uploading", media.name, e)
+            await cache.discard(digest)
+
+    async with cache.upload_lock(digest):
+        # Another sender may have uploaded the file while we were waiting
+        file_id = cache.get(digest)
+        if file_id:
+            return await send(animation=file_id, **kwargs)
+        message = await send(animation=media.input_file(), **kwargs)
+        new_file_id = _sent_file_id(message)
+        if new_file_id:
+            await cache.set(digest, new_file_id)
+        return message
+
+
+async def prewarm(cache, bot, chat_id, media_files):
+    """Upload every GIF missing from the cache to `chat_id` once, then delete the messages."""
+    warmed = 0
+    for media in media_files:
+        if cache.get(media.digest):
+            continue
+        try:
+            message = await send_animation_cached(
+                cache, bot.send_animation, media, chat_id=chat_id, disable_notification=True
+            )
+            warmed += 1
+            await bot.delete_message(chat_id=chat_id, message_id=message.message_id)
+        except Exception as e:
+            logger.error("Error pre-warming %s: %s", media.name, e)
+    return warmed
@@ -0,0 +1,213 @@
+import time
+import logging
+import functools
+from telegram.ext import ConversationHandler
+from telegram.request import BaseRequest
+
+# Latency buckets in seconds, from a cached text reply up to a slow multi-megabyte upload
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+logger = logging.getLogger(__name__)
+
+
+def _labels_text(labels):
+    if not labels:
+        return ''
+    escaped = (f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+               for key, value in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def quantile(self, q):
+        """Upper bucket bound below which `q` of the observations fall."""
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return self.max
+
+
+class Metrics:
+    """In-process metrics registry rendered in the Prometheus text format.
+
+    Metric names map to {labels: value}; labels are tuples of (name, value) pairs.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}  # name -> callable returning [(labels, value), ...]
+        self.help = {}
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, labels=(), value=1):
+        series = self.counters.setdefault(name, {})
+        series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name, value, labels=()):
+        series = self.histograms.setdefault(name, {})
+        histogram = series.get(labels)
+        if histogram is None:
+            histogram = series[labels] = Histogram()
+        histogram.observe(value)
+
+    def gauge(self, name, collect):
+        self.gauges[name] = collect
+
+    def _header(self, name, kind):
+        lines = [f"# HELP {name} {self.help[name]}"] if name in self.help else []
+        lines.append(f"# TYPE {name} {kind}")
+        return lines
+
+    def render(self):
+        lines = []
+        for name, series in sorted(self.counters.items()):
+            lines += self._header(name, 'counter')
+            lines += [f"{name}{_labels_text(labels)} {value}" for labels, value in sorted(series.items())]
+        for name, series in sorted(self.histograms.items()):
+            lines += self._header(name, 'histogram')
+            for labels, histogram in sorted(series.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels_text(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_bucket{_labels_text(labels + (('le', '+Inf'),))} {histogram.count}")
+                lines.append(f"{name}_sum{_labels_text(labels)} {histogram.sum:.6f}")
+                lines.append(f"{name}_count{_labels_text(labels)} {histogram.count}")
+        for name, collect in sorted(self.gauges.items()):
+            lines += self._header(name, 'gauge')
+            lines += [f"{name}{_labels_text(labels)} {value}" for labels, value in collect()]
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.describe('bot_handler_latency_seconds', 'Time spent in update handlers')
+metrics.describe('bot_handler_errors_total', 'Handler invocations that raised')
+metrics.describe('bot_conversation_updates_total', 'Updates handled per conversation state')
+metrics.describe('bot_api_calls_total', 'Outbound Bot API calls')
+metrics.describe('bot_api_errors_total', 'Outbound Bot API calls answered with an error status')
+metrics.describe('bot_api_latency_seconds', 'Outbound Bot API call latency')
+metrics.describe('bot_api_bytes_sent_total', 'Request payload bytes sent to the Bot API')
+metrics.describe('bot_api_bytes_received_total', 'Response bytes received from the Bot API')
+metrics.describe('bot_broadcast_duration_seconds', 'Broadcast wall time')
+metrics.describe('bot_broadcast_messages_total', 'Broadcast deliveries by outcome')
+
+
+def instrument_callback(callback, handler_name, state=None):
+    """Wrap a handler callback to record its latency, errors and conversation state.
+
+    Every call also yields an `event=handler` log record (sampled by the logging setup).
+    """
+
+    @functools.wraps(callback)
+    async def instrumented(update, context):
+        started = time.perf_counter()
+        level = logging.INFO
+        try:
+            return await callback(update, context)
+        except Exception:
+            metrics.inc('bot_handler_errors_total', (('handler', handler_name),))
+            level = logging.ERROR
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.observe('bot_handler_latency_seconds', elapsed, (('handler', handler_name),))
+            if state is not None:
+                metrics.inc('bot_conversation_updates_total', (('state', state),))
+            user = getattr(update, 'effective_user', None)
+            chat = getattr(update, 'effective_chat', None)
+            logger.log(level, "Handled %s", handler_name, extra={
+                'event': 'handler', 'handler': handler_name, 'state': state,
+                'user_id': user.id if user else None, 'chat_id': chat.id if chat else None,
+                'latency_ms': round(elapsed * 1000, 2),
+            })
+
+    return instrumented
+
+
+def instrument_handler(handler, state_names=None):
+    """Instrument `handler` in place (including every handler inside a ConversationHandler)."""
+    if isinstance(handler, ConversationHandler):
+        state_names = state_names or {}
+        for entry in handler.entry_points:
+            instrument_handler_callback(entry, 'entry')
+        for state, handlers in handler.states.items():
+            for state_handler in handlers:
+                instrument_handler_callback(state_handler, state_names.get(state, str(state)))
+        for fallback in handler.fallbacks:
+            instrument_handler_callback(fallback, 'fallback')
+    else:
+        instrument_handler_callback(handler)
+    return handler
+
+
+def instrument_handler_callback(handler, state=None):
+    handler.callback = instrument_callback(handler.callback, handler.callback.__name__, state)
+
+
+class InstrumentedRequest(BaseRequest):
+    """BaseRequest decorator counting calls, bytes and latency per Bot API method."""
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    @property
+    def read_timeout(self):
+        return self.inner.read_timeout
+
+    async def initialize(self):
+        await self.inner.initialize()
+
+    async def shutdown(self):
+        await self.inner.shutdown()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        api_method = url.rsplit('/', 1)[-1]
+        labels = (('method', api_method),)
+        sent = 0
+        if request_data is not None:
+            sent = len(request_data.json_payload)
+            if request_data.contains_files:
+                sent += sum(len(part[1]) for part in request_data.multipart_data.values() if isinstance(part, tuple))
+
+        started = time.perf_counter()
+        try:
+            code, payload = await self.inner.do_request(
+                url, method, request_data, read_timeout=read_timeout, write_timeout=write_timeout,
+                connect_timeout=connect_timeout, pool_timeout=pool_timeout,
+            )
+        except Exception:
+            metrics.inc('bot_api_errors_total', labels + (('code', 'network'),))
+            raise
+        finally:
+            metrics.observe('bot_api_latency_seconds', time.perf_counter() - started, labels)
+            metrics.inc('bot_api_calls_total', labels)
+            metrics.inc('bot_api_bytes_sent_total', labels, sent)
+
+        metrics.inc('bot_api_bytes_received_total', labels, len(payload))
+        if code >= 400:
+            metrics.inc('bot_api_errors_total', labels + (('code', str(code)),))
+        return code, payload
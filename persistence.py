@@ -0,0 +1,128 @@
+import logging
+import json
+import asyncio
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+# Flush right away once this many entries are dirty, instead of waiting for the end of the batch
+FLUSH_SIZE = 500
+
+
+class SQLitePersistence(BasePersistence):
+    """Conversation states and user_data in the bot's SQLite database.
+
+    PTB hands over changed entries every `update_interval` seconds; they are coalesced in
+    memory (later writes of the same key replace earlier ones) and written in a single
+    transaction once the batch is complete or FLUSH_SIZE entries are pending. Stored data is
+    read on first access only.
+    """
+
+    def __init__(self, storage, update_interval=60, flush_size=FLUSH_SIZE):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.storage = storage
+        self.flush_size = flush_size
+        self._user_data = None
+        self._conversations = {}
+        self._dirty_conversations = {}  # (name, key JSON) -> state JSON, None to delete
+        self._dirty_user_data = {}  # user_id -> data JSON, None to delete
+        self._flush_scheduled = False
+
+    async def get_user_data(self):
+        if self._user_data is None:
+            self._user_data = {user_id: json.loads(data) for user_id, data in self.storage.load_user_data()}
+        return {user_id: dict(data) for user_id, data in self._user_data.items()}
+
+    async def get_conversations(self, name):
+        if name not in self._conversations:
+            self._conversations[name] = {
+                tuple(json.loads(key)): json.loads(state) for key, state in self.storage.load_conversations(name)
+            }
+        return dict(self._conversations[name])
+
+    async def update_conversation(self, name, key, new_state):
+        conversations = self._conversations.setdefault(name, {})
+        if conversations.get(key) == new_state:
+            return
+        if new_state is None:
+            conversations.pop(key, None)
+        else:
+            conversations[key] = new_state
+        self._mark_dirty(self._dirty_conversations, (name, json.dumps(key)), new_state)
+
+    async def update_user_data(self, user_id, data):
+        if self._user_data is None:
+            await self.get_user_data()
+        if self._user_data.get(user_id, {}) == data:
+            return
+        if not data:
+            # Most users are between flows with nothing stored, keep no row for them
+            await self.drop_user_data(user_id)
+            return
+        self._user_data[user_id] = data
+        self._mark_dirty(self._dirty_user_data, user_id, data)
+
+    async def drop_user_data(self, user_id):
+        if self._user_data is not None:
+            self._user_data.pop(user_id, None)
+        self._mark_dirty(self._dirty_user_data, user_id, None)
+
+    def _mark_dirty(self, dirty, key, value):
+        dirty[key] = None if value is None else json.dumps(value, ensure_ascii=False)
+        if len(self._dirty_conversations) + len(self._dirty_user_data) >= self.flush_size:
+            self._write()
+        elif not self._flush_scheduled:
+            # PTB gathers all updates of one persistence run, the callback fires after them
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._write)
+
+    def _write(self):
+        self._flush_scheduled = False
+        if not self._dirty_conversations and not self._dirty_user_data:
+            return
+        conversations, self._dirty_conversations = self._dirty_conversations, {}
+        user_data, self._dirty_user_data = self._dirty_user_data, {}
+        try:
+            self.storage.save_persistence(conversations, user_data)
+        except Exception as e:
+            logger.error("Error saving conversation state: %s", e)
+            # Keep the entries for the next attempt unless they were changed meanwhile
+            self._dirty_conversations = {**conversations, **self._dirty_conversations}
+            self._dirty_user_data = {**user_data, **self._dirty_user_data}
+
+    async def flush(self):
+        self._write()
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    # Only user_data and conversations are persisted
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
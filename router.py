@@ -0,0 +1,91 @@
+import re
+from types import MappingProxyType
+from telegram import ReplyKeyboardMarkup, KeyboardButton
+from telegram.ext import filters
+
+# Menu buttons
+BUTTON_ADD = "🛒 Закинуть в корзину"
+BUTTON_ITEMS = "📋 Мои ссылки"
+BUTTON_EDIT = "✏️ Изменить ссылку"
+BUTTON_REMOVE = "❌ Удалить ссылку"
+
+# Prebuilt once: telegram objects are immutable, so one markup can be shared by every reply
+MENU_KEYBOARD = ReplyKeyboardMarkup(
+    [
+        [KeyboardButton(BUTTON_ADD)],
+        [KeyboardButton(BUTTON_ITEMS), KeyboardButton(BUTTON_EDIT)],
+        [KeyboardButton(BUTTON_REMOVE)],
+    ],
+    resize_keyboard=True,
+)
+
+# Plain text messages (no commands), the input of every conversation state
+TEXT_MESSAGES = filters.TEXT & ~filters.COMMAND
+
+URL_RE = re.compile(r'https?://[^\s]+')
+PRICE_RE = re.compile(r'(\d+(?:[.,]\d{1,2})?)')
+CURRENCY = r'(?:₽|руб\.?|р\.?)'
+# One wishlist line of a bulk message: "<link> <price> <name>", price optionally followed by ₽/р/руб.
+# A lone currency marker is never taken for the name: "<link> 1500 руб" does not parse.
+BULK_LINE_RE = re.compile(
+    rf'^(https?://\S+)\s+(\d+(?:[.,]\d{{1,2}})?)\s*(?:{CURRENCY}(?=\s))?\s+(?!{CURRENCY}(?:\s|$))(\S.*)$', re.IGNORECASE
+)
+# Bulk adds need at least this many non-empty lines; a single "<link> <number> <text>" line
+# (e.g. "... 2 шт пожалуйста") goes through the usual price and name prompts instead
+BULK_MIN_LINES = 2
+
+
+def parse_bulk_lines(text):
+    """Split a bulk message into ([(line number, link, price, name)], [unparsed line numbers]).
+
+    Empty lines are ignored; the price is returned as the matched text. Messages with fewer
+    than BULK_MIN_LINES lines are not bulk messages and give ([], []).
+    """
+    entries = []
+    unparsed = []
+    lines = [(number, line.strip()) for number, line in enumerate(text.splitlines(), 1) if line.strip()]
+    if len(lines) < BULK_MIN_LINES:
+        return entries, unparsed
+    for number, line in lines:
+        match = BULK_LINE_RE.match(line)
+        if match:
+            entries.append((number, match.group(1), match.group(2), match.group(3).strip()))
+        else:
+            unparsed.append(number)
+    return entries, unparsed
+
+# user_data keys of an unfinished add/edit flow
+CONVERSATION_KEYS = ('product_link', 'product_price', 'edit_item_id', 'reserved_campaign')
+
+
+class MenuRouter:
+    """Frozen dispatch table from menu button text to its action coroutine.
+
+    Actions take (update, context) and return the next conversation state. `on_abandon`,
+    if given, is called with (update, context) before an unfinished flow is dropped.
+    """
+
+    def __init__(self, actions, on_abandon=None):
+        self.actions = MappingProxyType(dict(actions))
+        self.on_abandon = on_abandon
+
+    def match(self, text):
+        return self.actions.get(text)
+
+    async def interrupt(self, update, context):
+        """Run the action of a pressed menu button, abandoning whatever flow was in progress.
+
+        Shared by every conversation state; returns None when the message is not a menu button.
+        """
+        action = self.actions.get(update.message.text.strip())
+        if action is None:
+            return None
+        self.abandon(update, context)
+        return await action(update, context)
+
+    def abandon(self, update, context):
+        """Drop the flow in progress, if any, and everything it kept in user_data."""
+        if self.on_abandon is not None:
+            self.on_abandon(update, context)
+        for key in CONVERSATION_KEYS:
+            context.user_data.pop(key, None)
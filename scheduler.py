@@ -0,0 +1,175 @@
+import logging
+from datetime import datetime, timedelta, time as dt_time
+
+logger = logging.getLogger(__name__)
+
+# Missed runs older than this are recorded as skipped instead of being delivered late
+CATCH_UP_WINDOW = timedelta(hours=24)
+
+
+def parse_schedule(schedule, tz):
+    """Return ('once', datetime) for an ISO datetime or ('daily', time) for HH:MM."""
+    if len(schedule) == 5 and schedule[2] == ':':
+        hour, minute = int(schedule[:2]), int(schedule[3:])
+        return 'daily', dt_time(hour=hour, minute=minute, tzinfo=tz)
+    return 'once', datetime.fromisoformat(schedule)
+
+
+class ScheduledJob:
+    """One row of the jobs table."""
+
+    def __init__(self, name, kind, campaign_id, schedule, enabled, last_run, tz):
+        self.name = name
+        self.kind = kind
+        self.campaign_id = campaign_id
+        self.schedule = schedule
+        self.enabled = bool(enabled)
+        self.last_run = datetime.fromisoformat(last_run) if last_run else None
+        self.repeat, self.at = parse_schedule(schedule, tz)
+
+    def latest_slot(self, now):
+        """Most recent time the job was due at or before `now`, None if never."""
+        if self.repeat == 'once':
+            return self.at if self.at <= now else None
+        local = now.astimezone(self.at.tzinfo)
+        slot = datetime.combine(local.date(), self.at)
+        return slot if slot <= local else slot - timedelta(days=1)
+
+    def next_run(self, now):
+        if not self.enabled:
+            return None
+        if self.repeat == 'once':
+            return self.at if self.at > now else None
+        return self.latest_slot(now) + timedelta(days=1)
+
+    def is_due(self, slot):
+        return slot is not None and (self.last_run is None or slot > self.last_run)
+
+
+class Scheduler:
+    """Durable jobs on top of PTB's JobQueue.
+
+    Every job lives in the jobs table together with the scheduled time of its last delivered
+    run. On attach() each job is checked once against its latest due time, so a run missed
+    while the bot was down is delivered exactly once (if not older than CATCH_UP_WINDOW).
+    `callbacks` maps job kind to a coroutine taking (context, run_id), where context.job.data
+    is the campaign ID and run_id names this due time of the job, the same for a catch-up.
+
+    With several workers every one registers the jobs, but runs only happen where
+    `is_leader()` is true; the new leader calls catch_up() for runs its predecessor missed.
+    """
+
+    def __init__(self, storage, callbacks, tz, catch_up_window=CATCH_UP_WINDOW, is_leader=None):
+        self.storage = storage
+        self.callbacks = callbacks
+        self.tz = tz
+        self.catch_up_window = catch_up_window
+        self.is_leader = is_leader
+        self.job_queue = None
+        self._running = set()
+        self.jobs = {
+            row[0]: ScheduledJob(*row, tz) for row in storage.load_jobs()
+        }
+
+    def attach(self, job_queue):
+        """Register all enabled jobs with `job_queue` and queue one catch-up run per missed job."""
+        self.job_queue = job_queue
+        now = datetime.now(self.tz)
+        for job in self.jobs.values():
+            self._register(job, now)
+        self.catch_up(now)
+
+    def catch_up(self, now=None):
+        if self.is_leader is not None and not self.is_leader():
+            return
+        now = now or datetime.now(self.tz)
+        for job in self.jobs.values():
+            if not job.enabled:
+                continue
+            slot = job.latest_slot(now)
+            if not job.is_due(slot):
+                continue
+            if now - slot > self.catch_up_window:
+                logger.warning("Job %s missed its run at %s, too late to catch up", job.name, slot)
+                self._mark_run(job, slot)
+                continue
+            logger.info("Job %s missed its run at %s, catching up", job.name, slot)
+            self.job_queue.run_once(self._run, when=0, data=job.campaign_id, name=job.name)
+
+    def reload(self):
+        """Pick up jobs created or changed by another worker."""
+        now = datetime.now(self.tz)
+        for row in self.storage.load_jobs():
+            job = ScheduledJob(*row, self.tz)
+            old = self.jobs.get(job.name)
+            self.jobs[job.name] = job
+            if self.job_queue is not None and (old is None or (old.schedule, old.enabled) != (job.schedule, job.enabled)):
+                self._register(job, now)
+
+    def ensure(self, kind, campaign_id, schedule):
+        """Create job `kind:campaign_id` unless it exists; runtime changes to it are kept."""
+        name = f"{kind}:{campaign_id}"
+        if name not in self.jobs:
+            self._save(ScheduledJob(name, kind, campaign_id, schedule, True, None, self.tz))
+        return self.jobs[name]
+
+    def set_schedule(self, name, schedule, enabled=True):
+        """Change when job `name` runs; a due time already in the past is not run retroactively."""
+        job = self.jobs[name]
+        return self._save(ScheduledJob(name, job.kind, job.campaign_id, schedule, enabled, None, self.tz))
+
+    def set_enabled(self, name, enabled):
+        return self.set_schedule(name, self.jobs[name].schedule, enabled)
+
+    def for_campaign(self, campaign_id):
+        return [job for job in self.jobs.values() if job.campaign_id == campaign_id]
+
+    def _save(self, job):
+        now = datetime.now(self.tz)
+        # Times that were due before the job (or its new schedule) existed are never caught up
+        job.last_run = job.latest_slot(now)
+        self.storage.save_job(
+            job.name, job.kind, job.campaign_id, job.schedule, job.enabled,
+            job.last_run.isoformat() if job.last_run else None,
+        )
+        self.jobs[job.name] = job
+        if self.job_queue is not None:
+            self._register(job, now)
+        return job
+
+    def _register(self, job, now):
+        for queued in self.job_queue.get_jobs_by_name(job.name):
+            queued.schedule_removal()
+        if not job.enabled:
+            return
+        if job.repeat == 'daily':
+            self.job_queue.run_daily(self._run, time=job.at, data=job.campaign_id, name=job.name)
+        elif job.at > now:
+            self.job_queue.run_once(self._run, when=job.at, data=job.campaign_id, name=job.name)
+
+    def _mark_run(self, job, slot):
+        job.last_run = slot
+        self.storage.mark_job_run(job.name, slot.isoformat())
+
+    async def _run(self, context):
+        if self.is_leader is not None and not self.is_leader():
+            return
+        row = self.storage.load_job(context.job.name)
+        job = self.jobs.get(context.job.name)
+        if row is None or job is None or job.name in self._running:
+            return
+        # Another worker may have delivered this run while it was the leader
+        job.last_run = ScheduledJob(*row, self.tz).last_run
+        if not job.enabled:
+            return
+        slot = job.latest_slot(datetime.now(self.tz))
+        # A catch-up and the regular run may both fire for one due time
+        if not job.is_due(slot):
+            return
+        self._running.add(job.name)
+        try:
+            await self.callbacks[job.kind](context, f"{job.name}@{slot.isoformat()}")
+            # Only recorded after success: a crash mid-run is caught up on the next start
+            self._mark_run(job, slot)
+        finally:
+            self._running.discard(job.name)
@@ -0,0 +1,550 @@
+import time
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from links import canonical_key
+
+# Schema migrations, applied in order; PRAGMA user_version holds how many have run
+MIGRATIONS = (
+    """
+    CREATE TABLE IF NOT EXISTS items (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        link TEXT NOT NULL,
+        price REAL NOT NULL,
+        name TEXT NOT NULL,
+        username TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        first_seen TEXT NOT NULL
+    );
+    """,
+    # Multi-campaign: every item and participant belongs to a campaign
+    """
+    CREATE TABLE campaigns (
+        id TEXT PRIMARY KEY,
+        title TEXT NOT NULL,
+        budget_limit REAL NOT NULL,
+        deadline TEXT NOT NULL,
+        admin_id INTEGER NOT NULL,
+        created_at TEXT NOT NULL
+    );
+    CREATE TABLE chats (
+        chat_id INTEGER PRIMARY KEY,
+        campaign_id TEXT NOT NULL
+    );
+    ALTER TABLE items ADD COLUMN campaign_id TEXT NOT NULL DEFAULT 'default';
+    CREATE INDEX items_campaign ON items (campaign_id);
+    CREATE TABLE participants (
+        campaign_id TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        first_seen TEXT NOT NULL,
+        PRIMARY KEY (campaign_id, user_id)
+    );
+    INSERT INTO participants (campaign_id, user_id, first_seen)
+        SELECT 'default', user_id, first_seen FROM users;
+    DROP TABLE users;
+    """,
+    # Durable scheduler: one row per job, last_run is the scheduled time of the last delivered run
+    """
+    CREATE TABLE jobs (
+        name TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        campaign_id TEXT NOT NULL,
+        schedule TEXT NOT NULL,
+        enabled INTEGER NOT NULL DEFAULT 1,
+        last_run TEXT,
+        updated_at TEXT NOT NULL
+    );
+    """,
+    # Broadcast checkpoints: chats already reached by an unfinished broadcast
+    """
+    CREATE TABLE broadcasts (
+        id TEXT PRIMARY KEY,
+        started_at TEXT NOT NULL,
+        finished_at TEXT
+    );
+    CREATE TABLE broadcast_deliveries (
+        broadcast_id TEXT NOT NULL,
+        chat_id INTEGER NOT NULL,
+        PRIMARY KEY (broadcast_id, chat_id)
+    ) WITHOUT ROWID;
+    """,
+    # Conversation states and user_data of SQLitePersistence, values stored as JSON
+    """
+    CREATE TABLE conversations (
+        name TEXT NOT NULL,
+        key TEXT NOT NULL,
+        state TEXT NOT NULL,
+        PRIMARY KEY (name, key)
+    ) WITHOUT ROWID;
+    CREATE TABLE user_data (
+        user_id INTEGER PRIMARY KEY,
+        data TEXT NOT NULL
+    );
+    """,
+    # Leases for leader election between worker processes sharing the database
+    """
+    CREATE TABLE leases (
+        name TEXT PRIMARY KEY,
+        holder TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    );
+    """,
+    # Revisions of shared state, bumped by the transaction that changes it, so workers reload
+    # only what another worker changed (and never for leases, checkpoints or persistence)
+    """
+    CREATE TABLE revisions (
+        scope TEXT PRIMARY KEY,
+        revision INTEGER NOT NULL
+    ) WITHOUT ROWID;
+    """,
+)
+
+# Revision scopes: a campaign's settings and items, its participants, chat routing and jobs
+CHATS_SCOPE = 'chats'
+JOBS_SCOPE = 'jobs'
+
+
+def campaign_scope(campaign_id):
+    return f"campaign:{campaign_id}"
+
+
+def participants_scope(campaign_id):
+    return f"participants:{campaign_id}"
+
+
+# Statements are kept as constants so sqlite3's statement cache reuses the prepared versions
+LOAD_CAMPAIGNS = "SELECT id, title, budget_limit, deadline, admin_id FROM campaigns ORDER BY created_at"
+LOAD_CAMPAIGN = "SELECT id, title, budget_limit, deadline, admin_id FROM campaigns WHERE id = ?"
+LOAD_CHATS = "SELECT chat_id, campaign_id FROM chats"
+LOAD_BASKETS = """
+SELECT 'item', campaign_id, id, link, price, name, username, user_id, created_at, updated_at FROM items
+UNION ALL
+SELECT 'user', campaign_id, NULL, NULL, NULL, NULL, NULL, user_id, first_seen, NULL FROM participants
+ORDER BY 1, 3
+"""
+INSERT_CAMPAIGN = """
+INSERT INTO campaigns (id, title, budget_limit, deadline, admin_id, created_at)
+VALUES (?, ?, ?, ?, ?, ?)
+"""
+UPSERT_CHAT = """
+INSERT INTO chats (chat_id, campaign_id) VALUES (?, ?)
+ON CONFLICT (chat_id) DO UPDATE SET campaign_id = excluded.campaign_id
+"""
+INSERT_ITEM = """
+INSERT INTO items (campaign_id, link, price, name, username, user_id, created_at, updated_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+DELETE_ITEM = "DELETE FROM items WHERE id = ?"
+UPDATE_ITEM_LINK = "UPDATE items SET link = ?, updated_at = ? WHERE id = ?"
+DELETE_CAMPAIGN_ITEMS = "DELETE FROM items WHERE campaign_id = ?"
+INSERT_PARTICIPANT = "INSERT OR IGNORE INTO participants (campaign_id, user_id, first_seen) VALUES (?, ?, ?)"
+DELETE_PARTICIPANT = "DELETE FROM participants WHERE campaign_id = ? AND user_id = ?"
+LOAD_PARTICIPANTS = "SELECT user_id FROM participants WHERE campaign_id = ?"
+UPDATE_CAMPAIGN_DEADLINE = "UPDATE campaigns SET deadline = ? WHERE id = ?"
+LOAD_JOBS = "SELECT name, kind, campaign_id, schedule, enabled, last_run FROM jobs"
+LOAD_JOB = LOAD_JOBS + " WHERE name = ?"
+UPSERT_JOB = """
+INSERT INTO jobs (name, kind, campaign_id, schedule, enabled, last_run, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (name) DO UPDATE SET
+    schedule = excluded.schedule, enabled = excluded.enabled, last_run = excluded.last_run,
+    updated_at = excluded.updated_at
+"""
+UPDATE_JOB_RUN = "UPDATE jobs SET last_run = ?, updated_at = ? WHERE name = ?"
+INSERT_BROADCAST = "INSERT OR IGNORE INTO broadcasts (id, started_at) VALUES (?, ?)"
+LOAD_BROADCAST = "SELECT finished_at FROM broadcasts WHERE id = ?"
+LOAD_BROADCAST_DELIVERIES = "SELECT chat_id FROM broadcast_deliveries WHERE broadcast_id = ?"
+INSERT_BROADCAST_DELIVERY = "INSERT OR IGNORE INTO broadcast_deliveries (broadcast_id, chat_id) VALUES (?, ?)"
+FINISH_BROADCAST = "UPDATE broadcasts SET finished_at = ? WHERE id = ?"
+DELETE_BROADCAST_DELIVERIES = "DELETE FROM broadcast_deliveries WHERE broadcast_id = ?"
+ITER_ITEMS = """
+SELECT id, user_id, username, name, link, price, created_at, updated_at FROM items
+WHERE campaign_id = ? ORDER BY id
+"""
+LOAD_CONVERSATIONS = "SELECT key, state FROM conversations WHERE name = ?"
+UPSERT_CONVERSATION = """
+INSERT INTO conversations (name, key, state) VALUES (?, ?, ?)
+ON CONFLICT (name, key) DO UPDATE SET state = excluded.state
+"""
+DELETE_CONVERSATION = "DELETE FROM conversations WHERE name = ? AND key = ?"
+LOAD_USER_DATA = "SELECT user_id, data FROM user_data"
+UPSERT_USER_DATA = """
+INSERT INTO user_data (user_id, data) VALUES (?, ?)
+ON CONFLICT (user_id) DO UPDATE SET data = excluded.data
+"""
+DELETE_USER_DATA = "DELETE FROM user_data WHERE user_id = ?"
+CAMPAIGN_SPENT = "SELECT COALESCE(SUM(price), 0) FROM items WHERE campaign_id = ?"
+# Taken over when expired, renewed by its holder
+ACQUIRE_LEASE = """
+INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?)
+ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+WHERE leases.holder = excluded.holder OR leases.expires_at < ?
+"""
+LOAD_LEASE_HOLDER = "SELECT holder FROM leases WHERE name = ?"
+RELEASE_LEASE = "DELETE FROM leases WHERE name = ? AND holder = ?"
+LOAD_REVISIONS = "SELECT scope, revision FROM revisions"
+BUMP_REVISION = """
+INSERT INTO revisions (scope, revision) VALUES (?, 1)
+ON CONFLICT (scope) DO UPDATE SET revision = revision + 1
+RETURNING revision
+"""
+LOAD_UNFINISHED_BROADCAST = """
+SELECT id FROM broadcasts WHERE substr(id, 1, ?) = ? AND finished_at IS NULL ORDER BY started_at DESC LIMIT 1
+"""
+
+
+class BudgetExceeded(Exception):
+    """Items were not added: the campaign's committed spending would exceed its budget."""
+
+
+def utc_now():
+    return datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+
+class Storage:
+    """SQLite database shared by all campaigns (WAL mode, prepared statements).
+
+    Several worker processes may open the same file; writers are serialized by SQLite and
+    `data_version()` tells whether another connection has committed since the last call.
+    Writes to shared state bump the revision of its scope; `revisions` holds the revision of
+    every scope this process's in-memory state reflects, and `changed_revisions()` lists the
+    scopes another connection has changed since.
+    """
+
+    def __init__(self, path, timeout=5.0):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode NORMAL only fsyncs on checkpoints, keeping commits sub-millisecond;
+        # a crash of the process never loses committed data, only a power loss might
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.migrate()
+        self.revisions = dict(self.conn.execute(LOAD_REVISIONS).fetchall())
+
+    def migrate(self):
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, script in enumerate(MIGRATIONS[version:], version + 1):
+            # executescript() commits on its own, so the version bump is part of the script
+            self.conn.executescript(f"BEGIN;\n{script}\nPRAGMA user_version = {number};\nCOMMIT;")
+
+    @contextmanager
+    def transaction(self, *scopes):
+        """Write transaction bumping the revision of every scope in `scopes` on commit."""
+        # Take the write lock up front: a read-then-write transaction of one process could
+        # otherwise fail instead of waiting when another process is writing
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.conn
+            bumped = [(scope, self.conn.execute(BUMP_REVISION, (scope,)).fetchall()[0][0]) for scope in scopes]
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+        for scope, revision in bumped:
+            # The caller applies its own change in memory; a gap means another worker wrote too
+            if self.revisions.get(scope, 0) == revision - 1:
+                self.revisions[scope] = revision
+
+    def data_version(self):
+        """Changes whenever another connection (e.g. another worker) commits to the database."""
+        return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def changed_revisions(self):
+        """{scope: revision} of every scope changed by another connection since it was last seen.
+
+        The caller reloads those scopes and then records them with `revisions.update()`.
+        """
+        return {
+            scope: revision for scope, revision in self.conn.execute(LOAD_REVISIONS)
+            if self.revisions.get(scope, 0) != revision
+        }
+
+    def load_campaigns(self):
+        return self.conn.execute(LOAD_CAMPAIGNS).fetchall()
+
+    def load_campaign(self, campaign_id):
+        return self.conn.execute(LOAD_CAMPAIGN, (campaign_id,)).fetchone()
+
+    def load_participants(self, campaign_id):
+        return {row[0] for row in self.conn.execute(LOAD_PARTICIPANTS, (campaign_id,))}
+
+    def load_chats(self):
+        return dict(self.conn.execute(LOAD_CHATS).fetchall())
+
+    def load_baskets(self):
+        """Load items and participants of every campaign with a single query."""
+        baskets = {}
+        for row in self.conn.execute(LOAD_BASKETS):
+            items, users = baskets.setdefault(row[1], ([], set()))
+            if row[0] == 'item':
+                items.append({
+                    "id": row[2],
+                    "link": row[3],
+                    "price": row[4],
+                    "name": row[5],
+                    "username": row[6],
+                    "user_id": row[7],
+                    "created_at": row[8],
+                    "updated_at": row[9],
+                    "link_key": canonical_key(row[3]),
+                })
+            else:
+                users.add(row[7])
+        return baskets
+
+    def insert_campaign(self, campaign_id, title, budget_limit, deadline, admin_id):
+        with self.transaction(campaign_scope(campaign_id)) as conn:
+            conn.execute(INSERT_CAMPAIGN, (campaign_id, title, budget_limit, deadline.isoformat(), admin_id, utc_now()))
+
+    def bind_chat(self, chat_id, campaign_id):
+        with self.transaction(CHATS_SCOPE) as conn:
+            conn.execute(UPSERT_CHAT, (chat_id, campaign_id))
+
+    def update_campaign_deadline(self, campaign_id, deadline):
+        with self.transaction(campaign_scope(campaign_id)) as conn:
+            conn.execute(UPDATE_CAMPAIGN_DEADLINE, (deadline.isoformat(), campaign_id))
+
+    def load_jobs(self):
+        return self.conn.execute(LOAD_JOBS).fetchall()
+
+    def load_job(self, name):
+        return self.conn.execute(LOAD_JOB, (name,)).fetchone()
+
+    def save_job(self, name, kind, campaign_id, schedule, enabled, last_run):
+        with self.transaction(JOBS_SCOPE) as conn:
+            conn.execute(UPSERT_JOB, (name, kind, campaign_id, schedule, int(enabled), last_run, utc_now()))
+
+    def mark_job_run(self, name, last_run):
+        with self.transaction(JOBS_SCOPE) as conn:
+            conn.execute(UPDATE_JOB_RUN, (last_run, utc_now(), name))
+
+    def acquire_lease(self, name, holder, ttl):
+        """Take or renew lease `name` for `ttl` seconds; True if `holder` holds it now."""
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute(ACQUIRE_LEASE, (name, holder, now + ttl, now))
+            return conn.execute(LOAD_LEASE_HOLDER, (name,)).fetchone()[0] == holder
+
+    def release_lease(self, name, holder):
+        with self.transaction() as conn:
+            conn.execute(RELEASE_LEASE, (name, holder))
+
+    def start_broadcast(self, broadcast_id):
+        """Register a broadcast; returns (finished, chat_ids already delivered) for a resumed one."""
+        with self.transaction() as conn:
+            conn.execute(INSERT_BROADCAST, (broadcast_id, utc_now()))
+            finished_at = conn.execute(LOAD_BROADCAST, (broadcast_id,)).fetchone()[0]
+            delivered = {row[0] for row in conn.execute(LOAD_BROADCAST_DELIVERIES, (broadcast_id,))}
+        return finished_at is not None, delivered
+
+    def record_deliveries(self, broadcast_id, chat_ids):
+        with self.transaction() as conn:
+            conn.executemany(INSERT_BROADCAST_DELIVERY, ((broadcast_id, chat_id) for chat_id in chat_ids))
+
+    def finish_broadcast(self, broadcast_id):
+        # The broadcast row alone is enough to never repeat it, per-chat checkpoints can go
+        with self.transaction() as conn:
+            conn.execute(FINISH_BROADCAST, (utc_now(), broadcast_id))
+            conn.execute(DELETE_BROADCAST_DELIVERIES, (broadcast_id,))
+
+    def unfinished_broadcast(self, prefix):
+        row = self.conn.execute(LOAD_UNFINISHED_BROADCAST, (len(prefix), prefix)).fetchone()
+        return row[0] if row else None
+
+    def iter_items(self, campaign_id):
+        """Yield items of a campaign straight from the database cursor, one dict at a time."""
+        for row in self.conn.execute(ITER_ITEMS, (campaign_id,)):
+            yield {
+                "id": row[0],
+                "user_id": row[1],
+                "username": row[2],
+                "name": row[3],
+                "link": row[4],
+                "link_key": canonical_key(row[4]),
+                "price": row[5],
+                "created_at": row[6],
+                "updated_at": row[7],
+            }
+
+    def load_conversations(self, name):
+        return self.conn.execute(LOAD_CONVERSATIONS, (name,)).fetchall()
+
+    def load_user_data(self):
+        return self.conn.execute(LOAD_USER_DATA).fetchall()
+
+    def save_persistence(self, conversations, user_data):
+        """Write a batch of {(name, key): state} and {user_id: data} in one transaction.
+
+        A value of None deletes the row.
+        """
+        with self.transaction() as conn:
+            conn.executemany(UPSERT_CONVERSATION, (
+                (name, key, state) for (name, key), state in conversations.items() if state is not None
+            ))
+            conn.executemany(DELETE_CONVERSATION, (
+                (name, key) for (name, key), state in conversations.items() if state is None
+            ))
+            conn.executemany(UPSERT_USER_DATA, (
+                (user_id, data) for user_id, data in user_data.items() if data is not None
+            ))
+            conn.executemany(DELETE_USER_DATA, (
+                (user_id,) for user_id, data in user_data.items() if data is None
+            ))
+
+    def close(self):
+        self.conn.close()
+
+
+class Basket:
+    """Items, spending and participants of one campaign with an in-memory read cache.
+
+    All reads (`items`, `spent`, `active_users`) are served from memory; every mutation is
+    committed to the database first and only then applied to the cache, so the two never
+    diverge. `link_index` maps the canonical key of every link to its item for O(1)
+    duplicate checks. Callables in `listeners` are called as `listener(event, item)` after
+    every basket change ('add', 'remove', 'update', or 'reset' with item None). `version` is
+    bumped on every change, so a view stamped with it can tell whether it is still current.
+    """
+
+    def __init__(self, storage, campaign_id, items=(), active_users=()):
+        self.storage = storage
+        self.campaign_id = campaign_id
+        self.scope = campaign_scope(campaign_id)
+        self.users_scope = participants_scope(campaign_id)
+        self.items = list(items)  # [{"id": 1, "link": "...", "price": 1500, "name": "...", ...}, ...]
+        self.spent = sum(item['price'] for item in self.items)
+        self.active_users = set(active_users)
+        self.link_index = {}  # canonical link key -> item
+        for item in self.items:
+            self.link_index.setdefault(item['link_key'], item)
+        self.listeners = []
+        self.version = 0
+
+    def _notify(self, event, item):
+        self.version += 1
+        for listener in self.listeners:
+            listener(event, item)
+
+    def find_by_link(self, link):
+        """Return the basket item pointing to the same product as `link`, if any."""
+        return self.link_index.get(canonical_key(link))
+
+    def position(self, item_id):
+        """Index of the item with `item_id` in `items`, None if it is gone."""
+        for index, item in enumerate(self.items):
+            if item['id'] == item_id:
+                return index
+        return None
+
+    def _unindex(self, item):
+        key = item['link_key']
+        if self.link_index.get(key) is not item:
+            return
+        del self.link_index[key]
+        # Older baskets may hold several links to one product; keep the next one indexed
+        for other in self.items:
+            if other is not item and other['link_key'] == key:
+                self.link_index[key] = other
+                break
+
+    def add_item(self, link, price, name, username, user_id, budget_limit=None):
+        return self.add_items([(link, price, name)], username, user_id, budget_limit)[0]
+
+    def add_items(self, entries, username, user_id, budget_limit=None):
+        """Add (link, price, name) entries of one user in a single transaction: all or none.
+
+        With `budget_limit`, spending committed by any process is re-checked inside the
+        transaction and BudgetExceeded is raised if the entries do not fit.
+        """
+        now = utc_now()
+        with self.storage.transaction(self.scope) as conn:
+            if budget_limit is not None:
+                spent = conn.execute(CAMPAIGN_SPENT, (self.campaign_id,)).fetchone()[0]
+                if spent + sum(price for _, price, _ in entries) > budget_limit:
+                    raise BudgetExceeded(self.campaign_id)
+            ids = [
+                conn.execute(INSERT_ITEM, (self.campaign_id, link, price, name, username, user_id, now, now)).lastrowid
+                for link, price, name in entries
+            ]
+        items = []
+        for item_id, (link, price, name) in zip(ids, entries):
+            item = {
+                "id": item_id,
+                "link": link,
+                "price": price,
+                "name": name,
+                "username": username,
+                "user_id": user_id,
+                "created_at": now,
+                "updated_at": now,
+                "link_key": canonical_key(link),
+            }
+            self.items.append(item)
+            self.link_index.setdefault(item['link_key'], item)
+            self.spent += price
+            self._notify('add', item)
+            items.append(item)
+        return items
+
+    def remove_item(self, index):
+        """Remove item by its position in the basket and return it."""
+        item = self.items[index]
+        with self.storage.transaction(self.scope) as conn:
+            conn.execute(DELETE_ITEM, (item['id'],))
+        self._unindex(item)
+        del self.items[index]
+        self.spent -= item['price']
+        self._notify('remove', item)
+        return item
+
+    def update_link(self, index, link):
+        item = self.items[index]
+        now = utc_now()
+        with self.storage.transaction(self.scope) as conn:
+            conn.execute(UPDATE_ITEM_LINK, (link, now, item['id']))
+        self._unindex(item)
+        item['link'] = link
+        item['link_key'] = canonical_key(link)
+        item['updated_at'] = now
+        self.link_index.setdefault(item['link_key'], item)
+        self._notify('update', item)
+        return item
+
+    def reload(self, items, active_users):
+        """Replace the cached contents with rows just read from the database."""
+        self.items = list(items)
+        self.spent = sum(item['price'] for item in self.items)
+        self.active_users = set(active_users)
+        self.link_index = {}
+        for item in self.items:
+            self.link_index.setdefault(item['link_key'], item)
+        self._notify('reset', None)
+
+    def reload_users(self, active_users):
+        """Replace the cached participants with rows just read from the database."""
+        self.active_users = set(active_users)
+
+    def reset(self):
+        """Clear the basket (participants are kept)."""
+        with self.storage.transaction(self.scope) as conn:
+            conn.execute(DELETE_CAMPAIGN_ITEMS, (self.campaign_id,))
+        self.items = []
+        self.spent = 0
+        self.link_index = {}
+        self._notify('reset', None)
+
+    def add_user(self, user_id):
+        if user_id in self.active_users:
+            return
+        with self.storage.transaction(self.users_scope) as conn:
+            conn.execute(INSERT_PARTICIPANT, (self.campaign_id, user_id, utc_now()))
+        self.active_users.add(user_id)
+
+    def remove_user(self, user_id):
+        with self.storage.transaction(self.users_scope) as conn:
+            conn.execute(DELETE_PARTICIPANT, (self.campaign_id, user_id))
+        self.active_users.discard(user_id)
@@ -0,0 +1,76 @@
+import time
+from collections import OrderedDict
+from metrics import metrics
+
+# A user may send BURST updates at once and RATE per second after that
+RATE = 1.0
+BURST = 10
+# Token cost per kind of update; 'gif' is charged on top when a reply carries an animation
+ACTION_COSTS = {'message': 1, 'command': 1, 'callback': 1, 'gif': 4}
+# Over-limit updates wait up to this long for tokens before being dropped (0 drops right away)
+MAX_DELAY = 2.0
+# Buckets of this many most recently seen users are kept; evicted users start with a full bucket
+MAX_TRACKED_USERS = 10000
+
+metrics.describe('bot_throttled_updates_total', 'Updates delayed or dropped by per-user flood protection')
+metrics.describe('bot_throttle_tracked_users', 'Users with a flood protection bucket')
+
+
+class UserBuckets:
+    """Per-user token buckets in a bounded LRU.
+
+    `take()` grants an update right away, after a delay, or not at all. A user's updates are
+    handled one at a time, so the waits of a burst happen back to back; once they add up to
+    `max_delay` without the bucket refilling in between, further updates are dropped.
+    `charge()` bills work that turned out to be expensive after the fact.
+    """
+
+    def __init__(self, rate=RATE, burst=BURST, max_delay=MAX_DELAY, max_users=MAX_TRACKED_USERS,
+                 clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.max_delay = max_delay
+        self.max_users = max_users
+        self.clock = clock
+        # user_id -> [tokens, last refill time, seconds waited in a row, updates dropped in a row]
+        self._buckets = OrderedDict()
+        metrics.gauge('bot_throttle_tracked_users', lambda: [((), len(self._buckets))])
+
+    def _bucket(self, user_id):
+        now = self.clock()
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = [self.burst, now, 0.0, 0]
+            if len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_id)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        return bucket
+
+    def take(self, user_id, cost):
+        """Seconds to wait before handling an update costing `cost`, or None to drop it."""
+        bucket = self._bucket(user_id)
+        delay = max(0.0, (cost - bucket[0]) / self.rate)
+        waited = bucket[2] + delay if delay else 0.0
+        if waited > self.max_delay:
+            bucket[3] += 1
+            return None
+        bucket[0] -= cost
+        bucket[2] = waited
+        bucket[3] = 0
+        return delay
+
+    def dropped(self, user_id):
+        """Updates of `user_id` dropped since the last one that was let through."""
+        bucket = self._buckets.get(user_id)
+        return bucket[3] if bucket else 0
+
+    def charge(self, user_id, cost):
+        # Debt is capped so a single expensive reply never locks a user out for long
+        bucket = self._bucket(user_id)
+        bucket[0] = max(-self.max_delay * self.rate, bucket[0] - cost)
+
+    def __len__(self):
+        return len(self._buckets)
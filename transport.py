@@ -0,0 +1,131 @@
+from telegram import Update
+from telegram.ext import ExtBot, CommandHandler, MessageHandler, CallbackQueryHandler, ConversationHandler, TypeHandler
+from telegram.request import BaseRequest, HTTPXRequest
+
+# Small API calls (replies, edits, callback answers): many at once, each should fail fast
+POOL_SIZE = 256
+TIMEOUT = 5.0
+# Uploads (GIFs not yet in the file_id cache): a few big bodies that take a while to send and
+# for Telegram to process; a pool of their own so they never hold up interactive replies
+MEDIA_POOL_SIZE = 8
+MEDIA_TIMEOUT = 60.0
+# getUpdates long poll: seconds Telegram holds the request open, and updates per batch (1-100)
+POLL_TIMEOUT = 10
+POLL_LIMIT = 100
+
+# Update types each kind of handler consumes. Edited messages are left out on purpose: a
+# flow step re-run for an edit would act twice on one message.
+HANDLER_UPDATE_TYPES = (
+    (CommandHandler, (Update.MESSAGE,)),
+    (MessageHandler, (Update.MESSAGE,)),
+    (CallbackQueryHandler, (Update.CALLBACK_QUERY,)),
+)
+
+
+def _handler_update_types(handler):
+    """Update types `handler` consumes, or None if that cannot be told."""
+    if isinstance(handler, ConversationHandler):
+        types = set()
+        nested = list(handler.entry_points) + list(handler.fallbacks)
+        for state_handlers in handler.states.values():
+            nested.extend(state_handlers)
+        for inner in nested:
+            inner_types = _handler_update_types(inner)
+            if inner_types is None:
+                return None
+            types |= inner_types
+        return types
+    if isinstance(handler, TypeHandler) and handler.type is Update:
+        # Gates like the shared state sync look at every update but act on none of their own
+        return set()
+    for handler_class, types in HANDLER_UPDATE_TYPES:
+        if isinstance(handler, handler_class):
+            return set(types)
+    return None
+
+
+def allowed_updates(application):
+    """Update types the application's handlers consume, for getUpdates and setWebhook.
+
+    Falls back to every type if a handler of an unknown kind is registered.
+    """
+    types = set()
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler_types = _handler_update_types(handler)
+            if handler_types is None:
+                return list(Update.ALL_TYPES)
+            types |= handler_types
+    return sorted(types)
+
+
+class SplitRequest(BaseRequest):
+    """Send uploads through `media` and every other Bot API call through `small`.
+
+    Uploads get `media_timeout` for reading and writing unless the caller set a timeout.
+    """
+
+    def __init__(self, small, media, media_timeout=MEDIA_TIMEOUT):
+        self.small = small
+        self.media = media
+        self.media_timeout = media_timeout
+
+    @property
+    def read_timeout(self):
+        return self.small.read_timeout
+
+    async def initialize(self):
+        await self.small.initialize()
+        await self.media.initialize()
+
+    async def shutdown(self):
+        await self.small.shutdown()
+        await self.media.shutdown()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        inner = self.small
+        if request_data is not None and request_data.contains_files:
+            inner = self.media
+            # HTTPXRequest would otherwise apply its own read timeout and a fixed 20 s write timeout
+            if read_timeout is BaseRequest.DEFAULT_NONE:
+                read_timeout = self.media_timeout
+            if write_timeout is BaseRequest.DEFAULT_NONE:
+                write_timeout = self.media_timeout
+        return await inner.do_request(
+            url, method, request_data, read_timeout=read_timeout, write_timeout=write_timeout,
+            connect_timeout=connect_timeout, pool_timeout=pool_timeout,
+        )
+
+
+def split_request(pool_size=POOL_SIZE, timeout=TIMEOUT, media_pool_size=MEDIA_POOL_SIZE, media_timeout=MEDIA_TIMEOUT):
+    """The request for every Bot API call but getUpdates: two HTTPX pools, small calls and uploads."""
+    small = HTTPXRequest(
+        connection_pool_size=pool_size, read_timeout=timeout, write_timeout=timeout, connect_timeout=timeout,
+        pool_timeout=timeout,
+    )
+    media = HTTPXRequest(
+        connection_pool_size=media_pool_size, read_timeout=media_timeout, write_timeout=media_timeout,
+        connect_timeout=timeout, pool_timeout=media_timeout,
+    )
+    return SplitRequest(small, media, media_timeout)
+
+
+class PollingBot(ExtBot):
+    """ExtBot asking getUpdates for at most `poll_limit` updates per batch.
+
+    Application.run_polling has no setting for the batch size, so it is applied here.
+    """
+
+    def __init__(self, *args, poll_limit=POLL_LIMIT, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Bots refuse new public attributes once initialized
+        self._poll_limit = poll_limit
+
+    @property
+    def poll_limit(self):
+        return self._poll_limit
+
+    async def get_updates(self, offset=None, limit=None, *args, **kwargs):
+        return await super().get_updates(offset, limit or self._poll_limit, *args, **kwargs)
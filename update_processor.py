@@ -0,0 +1,68 @@
+import asyncio
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+def ordering_key(update):
+    """Updates with the same key are processed one at a time, in arrival order."""
+    if not isinstance(update, Update):
+        return None
+    chat = update.effective_chat
+    user = update.effective_user
+    if chat is None and user is None:
+        return None
+    # Same key as ConversationHandler's default per_chat + per_user conversations
+    return (chat.id if chat else None, user.id if user else None)
+
+# Updates the processor holds at once, running or waiting for their user's lock or a slot.
+# PTB's own semaphore enforces it before do_process_update; past it, new updates of every user wait.
+MAX_PENDING_UPDATES = 10000
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Process updates of different users concurrently, each user's own updates in order.
+
+    An update first waits for its user's lock and only then for one of the
+    `max_concurrent_updates` slots, so a user who floods the bot queues behind their own lock
+    without taking slots away from everybody else. `gate(update)`, if given, is awaited in
+    between: it may delay the update or return False to drop it without handling.
+
+    BaseUpdateProcessor takes its semaphore before do_process_update, i.e. before the user's
+    lock, so it is sized to `max_pending_updates` and the slots are a semaphore of our own.
+    """
+
+    def __init__(self, max_concurrent_updates, gate=None, max_pending_updates=MAX_PENDING_UPDATES):
+        super().__init__(max(max_concurrent_updates, max_pending_updates))
+        self.gate = gate
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._locks = {}  # key -> [lock, updates holding or waiting for it]
+
+    async def do_process_update(self, update, coroutine):
+        key = ordering_key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # asyncio.Lock wakes waiters first-in first-out, which keeps arrival order
+            async with entry[0]:
+                if self.gate is not None and not await self.gate(update):
+                    coroutine.close()
+                    return
+                async with self._slots:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,98 @@
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+MESSAGE_LIMIT = 4096  # Telegram message length limit
+PAGE_SIZE = 10
+# Leaves room for the header/footer while keeping a full page under MESSAGE_LIMIT
+MAX_LINE_LENGTH = 350
+PAGE_CALLBACK_PREFIX = 'page'
+# Inline item buttons carry "<prefix>:<item id>:<basket version>", well under Telegram's 64 bytes
+ITEM_CALLBACK_PREFIXES = {'remove': 'rm', 'edit': 'ed'}
+BUTTON_LABEL_LENGTH = 40
+
+
+def _truncate(text, limit):
+    return text if len(text) <= limit else text[:limit - 1] + '…'
+
+
+# How one item is rendered in each view (without its number, which depends on position)
+VIEW_FORMATS = {
+    'items': lambda item: f"{item['name']} — {item['price']:.0f} ₽\n   🔗 {item['link']}",
+    'pick': lambda item: f"{item['name']} — {item['price']:.0f} ₽",
+    'admin': lambda item: f"{item['name']} — {item['price']:.0f} ₽\n   👤 @{item['username']}\n   🔗 {item['link']}",
+}
+
+
+class BasketView:
+    """Paginated rendering of a basket with a per-item line cache.
+
+    Lines are rendered once per item and view; basket change events drop only the lines of
+    the affected item, so rendering a page costs O(PAGE_SIZE) regardless of basket size.
+    """
+
+    def __init__(self, basket, page_size=PAGE_SIZE):
+        self.basket = basket
+        self.page_size = page_size
+        self._lines = {view: {} for view in VIEW_FORMATS}  # view -> item id -> rendered line
+        basket.listeners.append(self._on_change)
+
+    def _on_change(self, event, item):
+        if event == 'reset':
+            for lines in self._lines.values():
+                lines.clear()
+        elif event in ('remove', 'update'):
+            for lines in self._lines.values():
+                lines.pop(item['id'], None)
+
+    def _line(self, view, item):
+        lines = self._lines[view]
+        line = lines.get(item['id'])
+        if line is None:
+            line = lines[item['id']] = _truncate(VIEW_FORMATS[view](item), MAX_LINE_LENGTH)
+        return line
+
+    def page_count(self):
+        return max(1, -(-len(self.basket.items) // self.page_size))
+
+    def _page_items(self, page):
+        start = page * self.page_size
+        return start, self.basket.items[start:start + self.page_size]
+
+    def render(self, view, page=0, header='', footer=''):
+        """Render one page of `view`; returns (text, page, pages) with page clamped into range."""
+        pages = self.page_count()
+        page = min(max(page, 0), pages - 1)
+        start, items = self._page_items(page)
+        body = "\n".join(f"{number}. {self._line(view, item)}" for number, item in enumerate(items, start + 1))
+        text = f"{header}{body}\n{footer}" if footer else f"{header}{body}\n"
+        return _truncate(text, MESSAGE_LIMIT), page, pages
+
+    def item_buttons(self, view, page):
+        """One inline button per item on `page`, stamped with the current basket version."""
+        prefix = ITEM_CALLBACK_PREFIXES[view]
+        start, items = self._page_items(page)
+        return [
+            [InlineKeyboardButton(
+                _truncate(f"{number}. {self._line('pick', item)}", BUTTON_LABEL_LENGTH),
+                callback_data=f"{prefix}:{item['id']}:{self.basket.version}",
+            )]
+            for number, item in enumerate(items, start + 1)
+        ]
+
+    @staticmethod
+    def navigation_row(view, page, pages):
+        """Prev/current/next buttons, empty when everything fits on one page."""
+        if pages <= 1:
+            return []
+        buttons = []
+        if page > 0:
+            buttons.append(InlineKeyboardButton("◀️", callback_data=f"{PAGE_CALLBACK_PREFIX}:{view}:{page - 1}"))
+        buttons.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=f"{PAGE_CALLBACK_PREFIX}:{view}:{page}"))
+        if page < pages - 1:
+            buttons.append(InlineKeyboardButton("▶️", callback_data=f"{PAGE_CALLBACK_PREFIX}:{view}:{page + 1}"))
+        return buttons
+
+    @staticmethod
+    def navigation(view, page, pages):
+        """Inline prev/next buttons, or None when everything fits on one page."""
+        row = BasketView.navigation_row(view, page, pages)
+        return InlineKeyboardMarkup([row]) if row else None
@@ -0,0 +1,168 @@
+import logging
+import hmac
+import zlib
+import signal
+import asyncio
+import httpx
+from telegram import Update
+from http_server import HttpServer, text_response
+from update_processor import ordering_key
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+
+
+class WebhookServer(HttpServer):
+    """Receives Telegram updates over HTTP and hands them to the Application's update queue.
+
+    Also serves `/healthz` (process is up) and `/readyz` (application running and webhook
+    registered) for the reverse proxy / orchestrator.
+    """
+
+    def __init__(self, application, host, port, path, secret_token, reuse_port=False):
+        super().__init__(host, port, reuse_port=reuse_port)
+        self.application = application
+        self.path = path
+        self.secret_token = secret_token
+        self.ready = False
+        self.add_route('POST', path, self.handle_update)
+        self.add_route('GET', '/healthz', self.handle_health)
+        self.add_route('GET', '/readyz', self.handle_ready)
+
+    async def handle_update(self, request):
+        token = request.headers.get(SECRET_HEADER, '')
+        if not hmac.compare_digest(token.encode(), self.secret_token.encode()):
+            return text_response(403, 'Forbidden')
+        try:
+            update = Update.de_json(request.json(), self.application.bot)
+        except (ValueError, TypeError, AttributeError):
+            return text_response(400, 'Bad Request')
+        # Acknowledge right away; handlers run from the update queue, so Telegram never waits on them
+        await self.application.update_queue.put(update)
+        return text_response(200, 'OK')
+
+    async def handle_health(self, request):
+        return text_response(200, 'ok')
+
+    async def handle_ready(self, request):
+        if self.ready and self.application.running:
+            return text_response(200, 'ready')
+        return text_response(503, 'not ready')
+
+
+class UpdateRouter(HttpServer):
+    """Receives the Telegram webhook and forwards every update to one of several workers.
+
+    Updates are routed by a stable hash of their chat and user, so each user's conversation
+    always lives on the same worker and is handled there in order. A worker that cannot be
+    reached makes the request fail with 503, and Telegram delivers the update again later.
+    """
+
+    def __init__(self, worker_urls, host, port, path, secret_token):
+        super().__init__(host, port)
+        self.worker_urls = [url.rstrip('/') + path for url in worker_urls]
+        self.secret_token = secret_token
+        self.ready = False
+        self.client = None
+        self.add_route('POST', path, self.handle_update)
+        self.add_route('GET', '/healthz', self.handle_health)
+        self.add_route('GET', '/readyz', self.handle_ready)
+
+    def pick(self, update):
+        key = ordering_key(update)
+        if key is None:
+            return self.worker_urls[0]
+        return self.worker_urls[zlib.crc32(repr(key).encode()) % len(self.worker_urls)]
+
+    async def start(self):
+        self.client = httpx.AsyncClient(timeout=10)
+        await super().start()
+
+    async def stop(self):
+        await super().stop()
+        await self.client.aclose()
+
+    async def handle_update(self, request):
+        token = request.headers.get(SECRET_HEADER, '')
+        if not hmac.compare_digest(token.encode(), self.secret_token.encode()):
+            return text_response(403, 'Forbidden')
+        try:
+            update = Update.de_json(request.json(), None)
+        except (ValueError, TypeError, AttributeError):
+            return text_response(400, 'Bad Request')
+        url = self.pick(update)
+        try:
+            # Workers only enqueue the update, so waiting for their answer is cheap
+            response = await self.client.post(url, content=request.body, headers={
+                SECRET_HEADER: self.secret_token, 'content-type': 'application/json',
+            })
+        except httpx.HTTPError as e:
+            logger.error("Worker %s unreachable: %s", url, e)
+            return text_response(503, 'Service Unavailable')
+        return text_response(response.status_code, response.text)
+
+    async def handle_health(self, request):
+        return text_response(200, 'ok')
+
+    async def handle_ready(self, request):
+        return text_response(200, 'ready') if self.ready else text_response(503, 'not ready')
+
+
+def _stop_on_signals():
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    return stop_event
+
+
+async def serve_webhook(application, url, host, port, path, secret_token, allowed_updates=None):
+    """Run the application behind the embedded webhook server until SIGINT/SIGTERM.
+
+    With `url` None the webhook is not registered: the process is a worker behind UpdateRouter.
+    """
+    server = WebhookServer(application, host, port, path, secret_token)
+    stop_event = _stop_on_signals()
+
+    async with application:
+        # run_polling/run_webhook call these hooks themselves; the manual lifecycle has to as well
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        await server.start()
+        if url is not None:
+            await application.bot.set_webhook(
+                url=url.rstrip('/') + path,
+                secret_token=secret_token,
+                allowed_updates=allowed_updates,
+            )
+        server.ready = True
+        logger.info("Webhook server listening on %s:%s%s", host, server.port, path)
+
+        await stop_event.wait()
+
+        server.ready = False
+        await server.stop()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+
+async def serve_router(bot, worker_urls, url, host, port, path, secret_token, allowed_updates=None):
+    """Register the webhook and forward updates to `worker_urls` until SIGINT/SIGTERM."""
+    router = UpdateRouter(worker_urls, host, port, path, secret_token)
+    stop_event = _stop_on_signals()
+
+    async with bot:
+        await router.start()
+        await bot.set_webhook(url=url.rstrip('/') + path, secret_token=secret_token, allowed_updates=allowed_updates)
+        router.ready = True
+        logger.info("Update router listening on %s:%s%s, %d workers", host, router.port, path, len(worker_urls))
+
+        await stop_event.wait()
+
+        router.ready = False
+        await router.stop()